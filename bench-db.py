@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+
+# Database benchmarks for loki-sn-bot.
+#
+# These connect to the database configured in loki_sn_bot_config.py (which must already have the
+# tables from database.pgsql loaded) but only ever touch session-local TEMPORARY copies of the tables,
+# which shadow the real ones for the unqualified table names used by the bot code, so nothing real
+# gets read or modified.
+#
+# Usage: ./bench-db.py [BENCHMARK ...]    (with no arguments, all benchmarks are run)
+
+import sys
+import os
+import time
+import random
+
+import loki_sn_bot_config as config
+
+import lokisnbot
+lokisnbot.config = config
+import lokisnbot.pgsql as pgsql
+from lokisnbot.servicenode import ServiceNode
+from lokisnbot.network import NetworkContext
+import lokisnbot.alerts as alerts
+import lokisnbot.sqleval as sqleval
+import lokisnbot.snapshot as snapshot
+from lokisnbot.constants import COIN
+
+
+def temp_tables():
+    """Creates (or empties) temporary copies of the bot's tables, with their own sequences"""
+    cur = pgsql.cursor()
+    for t in ('users', 'service_nodes', 'wallet_prefixes', 'sn_snapshot'):
+        cur.execute("CREATE TEMPORARY TABLE IF NOT EXISTS {0} (LIKE public.{0} INCLUDING ALL)".format(t))
+        cur.execute("TRUNCATE {}".format(t))
+    for t in ('users', 'service_nodes'):
+        cur.execute("CREATE TEMPORARY SEQUENCE IF NOT EXISTS {0}_id_seq".format(t))
+        cur.execute("ALTER TABLE {0} ALTER COLUMN id SET DEFAULT nextval('pg_temp.{0}_id_seq')".format(t))
+
+
+def random_pubkey():
+    return os.urandom(32).hex()
+
+
+def timeit(name, f, setup=None, reps=10):
+    """Runs f() `reps` times and prints the mean time per run.  If given, setup() is called
+    (untimed) before each run."""
+    times = []
+    for _ in range(reps):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    print("{:>40}: {:8.3f} ms (min {:.3f} ms)".format(name, sum(times) / len(times) * 1000, min(times) * 1000))
+
+
+class BenchContext(NetworkContext):
+    """Minimal network context that discards all replies"""
+    def __init__(self, uid):
+        self.uid = uid
+
+    def send_reply(self, message, **kwargs):
+        pass
+
+    def get_uid(self):
+        return self.uid
+
+    def is_dm(self):
+        return True
+
+    def wallets_menu(self, reply_text=''):
+        pass
+
+
+def bench_plain_input(n=100):
+    """Pasting `n` pubkeys in add mode: one query per key vs. the batched plain_input path"""
+    temp_tables()
+    cur = pgsql.cursor()
+    cur.execute("INSERT INTO users (telegram_id) VALUES (1) RETURNING id")
+    uid = cur.fetchone()[0]
+    # Half of the pasted keys are already monitored, half are new:
+    pubkeys = [random_pubkey() for _ in range(n)]
+
+    def reset():
+        cur.execute("DELETE FROM service_nodes")
+        ServiceNode.insert_many([ServiceNode({ 'pubkey': pk, 'uid': uid }) for pk in pubkeys[0::2]])
+
+    def per_key():
+        for pk in pubkeys:
+            try:
+                ServiceNode(uid=uid, pubkey=pk)
+            except ValueError:
+                ServiceNode({ 'pubkey': pk, 'uid': uid }).insert()
+
+    def batched():
+        BenchContext(uid).plain_input(' '.join(pubkeys), add_sn=True)
+
+    timeit('{} keys, per-key queries'.format(n), per_key, setup=reset)
+    timeit('{} keys, batched plain_input'.format(n), batched, setup=reset)
+
+
+def bench_pubkey_storage(rows=500000, users=50000, registered=5000):
+    """character(64) hex vs. bytea pubkeys: index sizes and join speed on a large synthetic table"""
+    cur = pgsql.cursor()
+    for name, pktype, check, pkexpr in (
+            ('hex', 'character(64)', "pubkey ~ similar_escape('[0-9a-f]{64}', NULL)", "md5({i}::text) || md5((-{i})::text)"),
+            ('bin', 'bytea', "length(pubkey) = 32", "decode(md5({i}::text) || md5((-{i})::text), 'hex')")):
+        cur.execute("DROP TABLE IF EXISTS pg_temp.bench_sns_{0}, pg_temp.bench_reg_{0}".format(name))
+        cur.execute("CREATE TEMPORARY TABLE bench_sns_{0} (id bigserial PRIMARY KEY, uid bigint NOT NULL, pubkey {1} NOT NULL "
+                "CHECK ({2}), UNIQUE (uid, pubkey))".format(name, pktype, check))
+        cur.execute("CREATE INDEX ON bench_sns_{} (pubkey)".format(name))
+        # Each row's pubkey is one of `rows/4` distinct pubkeys, so most SNs are monitored by several
+        # users; the uid comes from the row number (the pubkey's copy number, j / (rows/4), offsets
+        # it) so that the copies of a pubkey go to different users:
+        cur.execute("INSERT INTO bench_sns_{0} (uid, pubkey) SELECT mod(i * 7919 + j / %s, %s), {1} "
+                "FROM generate_series(1, %s) AS g(j), LATERAL (SELECT mod(j, %s) AS i) x".format(name, pkexpr.format(i='i')),
+                (rows // 4, users, rows, rows // 4))
+        # The "registered" set that gets joined against (like the network's current SN list):
+        cur.execute("CREATE TEMPORARY TABLE bench_reg_{0} AS SELECT {1} AS pubkey FROM generate_series(1, %s) AS g(i)".format(name, pkexpr.format(i='i')),
+                (registered,))
+        cur.execute("ANALYZE bench_sns_{0}; ANALYZE bench_reg_{0}".format(name))
+
+        cur.execute("SELECT c.relname, pg_relation_size(c.oid) FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE i.indrelid = 'pg_temp.bench_sns_{}'::regclass ORDER BY c.relname".format(name))
+        for idx, size in cur.fetchall():
+            print("{:>40}: {:8.1f} MiB".format(idx, size / 1048576))
+
+        timeit('{} join ({} rows x {} registered)'.format(name, rows, registered), lambda: cur.execute(
+            "SELECT COUNT(*) FROM bench_sns_{0} JOIN bench_reg_{0} USING (pubkey)".format(name)))
+        timeit('{} single-pubkey lookup x 1000'.format(name), lambda: [cur.execute(
+            "SELECT id FROM bench_sns_{0} WHERE uid = %s AND pubkey = {1}".format(name, pkexpr.format(i='%s')),
+            ((j % (rows // 4) * 7919 + j // (rows // 4)) % users, j % (rows // 4), j % (rows // 4)))
+            for j in range(1, 1001)], reps=3)
+
+
+def fake_states(n, height):
+    """Generates `n` synthetic, fully staked, active mainnet SN states"""
+    states = {}
+    for _ in range(n):
+        pubkey = os.urandom(32)
+        states[pubkey] = {
+                'service_node_pubkey': pubkey.hex(),
+                'registration_height': height - random.randint(1000, 100000),
+                'requested_unlock_height': 0,
+                'active': True,
+                'total_contributed': 15000 * COIN,
+                'staking_requirement': 15000 * COIN,
+                'portions_for_operator': 18446744073709551612,
+                'operator_address': 'L' + random_pubkey(),
+                'contributors': [],
+                'last_uptime_proof': int(time.time()) - random.randint(0, 3600),
+                'earned_downtime_blocks': 60,
+                'service_node_version': [8, 1, 5],
+                'last_reward_block_height': height - random.randint(1, 2000),
+                'state_height': height - 100000,
+                }
+    return states
+
+
+def bench_evaluator(subs=10000, nodes=2000):
+    """Per-subscription Python evaluation (alerts.check) vs. the set-based sqleval evaluator, over
+    every subscription of a steady-state network where ~5% of nodes earned a reward, ~1% have an
+    old uptime proof, and ~1% started an unlock since the last poll"""
+    temp_tables()
+    cur = pgsql.cursor()
+    height = 700000
+    states = fake_states(nodes, height)
+    snapshot.publish(({ 'height': height }, states, {}), ({ 'height': height }, {}, {}))
+    pubkeys = list(states.keys())
+
+    cur.execute("INSERT INTO users (telegram_id) SELECT g FROM generate_series(1, %s) g", (subs // 2,))
+    cur.execute("SELECT id FROM users")
+    uids = [row[0] for row in cur]
+    seen = set()
+    rows = []
+    while len(rows) < subs:
+        uid, pk = random.choice(uids), random.choice(pubkeys)
+        if (uid, pk) not in seen:
+            seen.add((uid, pk))
+            rows.append(ServiceNode({ 'uid': uid, 'pubkey': pk, 'active': True, 'complete': True }))
+    ServiceNode.insert_many(rows)
+
+    sent = [0]
+    def notify(sn, msg, is_update=True):
+        sent[0] += 1
+        return True
+
+    now = time.time()
+    # Bring everything up to date, then save that as the starting point for each run:
+    sqleval.evaluate(((False, states, height),), notify, now, {}, {})
+    cur.execute("DROP TABLE IF EXISTS pg_temp.bench_pristine")
+    cur.execute("CREATE TEMPORARY TABLE bench_pristine AS SELECT * FROM service_nodes")
+
+    for pk in random.sample(pubkeys, nodes // 20):
+        states[pk]['last_reward_block_height'] += 1
+    for pk in random.sample(pubkeys, nodes // 100):
+        states[pk]['last_uptime_proof'] -= 2 * 3600
+    for pk in random.sample(pubkeys, nodes // 100):
+        states[pk]['requested_unlock_height'] = height + 720
+
+    def reset():
+        sent[0] = 0
+        cur.execute("DELETE FROM service_nodes")
+        cur.execute("INSERT INTO service_nodes SELECT * FROM bench_pristine")
+
+    def per_row():
+        cur = pgsql.dict_cursor()
+        cur.execute("SELECT service_nodes.*, users.telegram_id, users.discord_id FROM users JOIN service_nodes ON uid = users.id")
+        for row in cur.fetchall():
+            alerts.check(ServiceNode(row), notify, now, height, {}, {})
+
+    def set_based():
+        sqleval.evaluate(((False, states, height),), notify, now, {}, {})
+
+    timeit('{} subs, per-row Python'.format(subs), per_row, setup=reset, reps=3)
+    print("{:>40}: {}".format('alerts sent', sent[0]))
+    timeit('{} subs, set-based SQL'.format(subs), set_based, setup=reset, reps=3)
+    print("{:>40}: {}".format('alerts sent', sent[0]))
+
+
+BENCHMARKS = {
+    'plain_input': bench_plain_input,
+    'pubkey_storage': bench_pubkey_storage,
+    'evaluator': bench_evaluator,
+}
+
+
+if __name__ == '__main__':
+    which = sys.argv[1:] or list(BENCHMARKS.keys())
+    unknown = [b for b in which if b not in BENCHMARKS]
+    if unknown:
+        print("Unknown benchmark(s): {}; available benchmarks: {}".format(', '.join(unknown), ', '.join(BENCHMARKS.keys())))
+        sys.exit(1)
+
+    pgsql.connect()
+    for b in which:
+        print("{}: {}".format(b, BENCHMARKS[b].__doc__))
+        BENCHMARKS[b]()
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+
+# Fake testnet wallet RPC for trying out the faucet without a real wallet.
+#
+# Answers `transfer` requests with a random tx hash (after a short delay, like a real wallet would
+# take) and prints the requested destinations, so that faucet batching can be checked by pointing
+# TESTNET_WALLET_URL at it and hitting the faucet from a few accounts at once.
+#
+# Usage: ./fake-wallet-rpc.py [PORT]    (default port 38083, i.e. TESTNET_WALLET_URL = 'http://localhost:38083')
+
+import sys
+import os
+import json
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+class FakeWallet(BaseHTTPRequestHandler):
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        if req.get('method') == 'transfer':
+            time.sleep(1)
+            dests = req['params']['destinations']
+            tx_hash = os.urandom(32).hex()
+            print("transfer {} to {} destinations:".format(tx_hash, len(dests)))
+            for d in dests:
+                print("    {} {}".format(d['address'], d['amount']))
+            resp = {"jsonrpc": "2.0", "id": req.get('id'), "result": {"tx_hash": tx_hash}}
+        else:
+            resp = {"jsonrpc": "2.0", "id": req.get('id'), "error": {"code": -32601, "message": "Method not found"}}
+
+        body = json.dumps(resp).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+port = int(sys.argv[1]) if len(sys.argv) > 1 else 38083
+print("Fake wallet RPC listening on port {}".format(port))
+ThreadingHTTPServer(('localhost', port), FakeWallet).serve_forever()
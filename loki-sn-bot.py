@@ -6,6 +6,7 @@ import requests
 import traceback
 import signal
 import asyncio
+import queue
 
 import loki_sn_bot_config as config
 
@@ -16,7 +17,19 @@ import lokisnbot.util as util
 from lokisnbot.telegram import TelegramNetwork
 from lokisnbot.discord import DiscordNetwork
 import lokisnbot.pgsql as pgsql
-from lokisnbot.servicenode import ServiceNode, reward
+import lokisnbot.uidcache as uidcache
+import lokisnbot.mirror as mirror
+import lokisnbot.alerts as alerts
+import lokisnbot.sqleval as sqleval
+import lokisnbot.rewards as rewards
+import lokisnbot.refresh as refresh
+import lokisnbot.snapshot as snapshot
+import lokisnbot.columns as columns
+import lokisnbot.expiry as expiry
+import lokisnbot.contributors as contributors
+import lokisnbot.history as history
+import lokisnbot.api as api
+from lokisnbot.servicenode import ServiceNode, lokinet_addresses
 #import lokisnbot.discord as dc
 
 if not hasattr(config, 'WELCOME'):
@@ -29,17 +42,90 @@ if not hasattr(config, 'WELCOME'):
             ('\n\n' + config.EXTRA if config.EXTRA else '')
             )
 
+if not hasattr(config, 'SQL_EVALUATOR'):
+    config.SQL_EVALUATOR = False
+if not hasattr(config, 'API_PORT'):
+    config.API_PORT = None
+if not hasattr(config, 'API_LISTEN'):
+    config.API_LISTEN = '127.0.0.1'
 
 
 
-tg, dc = None, None
-
 
+tg, dc = None, None
 
-def notify(sn, msg, is_update=True):
-    """Notify based on Telegram/Discord status.  Returns true if at least one notification went out.
-    is_update controls whether this is a status update, in which case extra info (a link to
-    oxen.observer) is added; True by default, should be false for boring notifications like rewards"""
+# The network state fields that subscription alerts depend on; a subscription only needs to be
+# re-evaluated before its next_check_at deadline if one of these changes for its SN (or the SN
+# appears or disappears).
+STATE_FIELDS = ('active', 'total_contributed', 'staking_requirement', 'last_uptime_proof', 'registration_height',
+        'requested_unlock_height', 'service_node_version', 'last_reward_block_height')
+
+
+def state_changes(states, previous):
+    """Compares the alert-relevant fields of a {pubkey: state} dict against the `previous`
+    {pubkey: fields} dict.  Updates `previous` to the new values and returns a list of the pubkeys
+    that changed, appeared, or disappeared."""
+    changed = []
+    for pubkey, x in states.items():
+        fields = tuple(x.get(f) for f in STATE_FIELDS)
+        if previous.get(pubkey) != fields:
+            previous[pubkey] = fields
+            changed.append(pubkey)
+    gone = [pubkey for pubkey in previous if pubkey not in states]
+    for pubkey in gone:
+        del previous[pubkey]
+    return changed + gone
+
+
+def next_check(sn, now):
+    """Returns the time at which the (just evaluated) subscription next needs to be looked at
+    even if nothing about its SN changes on the network: i.e. when the next repeat or time-driven
+    alert could fire.  Never later than MAX_CHECK_INTERVAL from now.  (Expiry thresholds move with
+    the network height rather than the clock; the updater finds the SNs crossing one of those with
+    expiry.crossed_thresholds() instead.)"""
+    deadlines = [now + MAX_CHECK_INTERVAL]
+    if not sn.active():
+        return deadlines[0]
+
+    if sn.decommissioned() and sn['notified_decomm']:
+        deadlines.append(sn['notified_decomm'] + 60*60)
+
+    lup = sn.state('last_uptime_proof')
+    if lup:
+        if not sn['notified_age']:
+            if lup + PROOF_AGE_WARNING > now:
+                deadlines.append(lup + PROOF_AGE_WARNING)
+            else:
+                # Late, but the warning was held back because the node is unstable:
+                deadlines.append(lup + UNSTABLE_PROOF_AGE)
+        else:
+            deadlines.append(lup + sn['notified_age'] + PROOF_AGE_REPEAT + 1)
+
+    if sn['notified_obsolete']:
+        deadlines.append(sn['notified_obsolete'] + 24*60*60)
+    if sn['notified_v305']:
+        deadlines.append(sn['notified_v305'] + 24*60*60)
+
+    return int(max(min(deadlines), now))
+
+
+def reschedule(sn, now):
+    """Stores the subscription's next_check_at deadline, if changed.  If a notification for it
+    failed this round then it is due again immediately so that it gets retried on the next poll."""
+    deadline = int(now) if sn['id'] in undelivered else next_check(sn, now)
+    if sn['next_check_at'] != deadline:
+        sn.update(next_check_at=deadline)
+
+
+
+def notify(sn, msg, is_update=True, also=()):
+    """Notify based on Telegram/Discord status.  Returns true if at least one notification went out
+    (Discord messages count once queued: they are delivered asynchronously, and if a Discord-only
+    notification turns out to have failed then the alert state of the subscription -- and of the
+    `also` subscriptions the message reports on -- gets put back by restore_undelivered() so that
+    the alert is sent again).  is_update controls whether this is a status update, in which case
+    extra info (a link to oxen.observer) is added; True by default, should be false for boring
+    notifications like rewards"""
     global tg, dc
 
     tgid, dcid = sn['telegram_id'], sn['discord_id']
@@ -50,18 +136,73 @@ def notify(sn, msg, is_update=True):
             good += 1
     if dcid:
         extra = dc.sn_update_extra(sn) if is_update else {}
-        if dc.try_message(dcid, msg, **extra):
+        ids = [x['id'] for x in (sn, *also) if 'id' in x] if not good else []
+        for i in ids:
+            if i not in pending_deliveries:
+                pending_deliveries[i] = [dict(mirror.subs[i]) if i in mirror.subs else None, 0, False]
+            pending_deliveries[i][1] += 1
+        if dc.try_message(dcid, msg, done=lambda error: delivery_results.put((ids, error)), **extra):
             good += 1
 
+    if not good and 'id' in sn:
+        undelivered.add(sn['id'])
     return good > 0
 
+undelivered = set()  # ids of subscriptions with a notification that failed during the current poll
+
+# Subscription id: [mirrored row as of its first outstanding Discord-only notification, number of
+# those notifications not yet reported back, whether any of them failed]
+pending_deliveries = {}
+delivery_results = queue.SimpleQueue()  # ([subscription id, ...], error or None) from the Discord loop
+
+# The columns that alerts set as they notify; put back (see restore_undelivered()) for subscriptions
+# whose Discord notification couldn't be delivered.
+ALERT_COLUMNS = ('active', 'notified_dereg', 'complete', 'last_contributions', 'expiry_notified', 'deregistered_at',
+        'notified_decomm', 'notified_age', 'notified_unstable', 'requested_unlock_height', 'unlock_notified',
+        'notified_obsolete', 'last_version', 'notified_v305', 'last_reward_block_height')
+
+
+def restore_undelivered(now):
+    """Collects the outcomes of the Discord notifications sent so far.  Once all of a subscription's
+    outstanding notifications are reported, if any of them failed then its alert columns are put
+    back to what they were before the first of them (so that the alerts get sent again) and it is
+    made due.  Returns the binary pubkeys of the restored subscriptions.  Must be called after
+    mirror.sync(), so that the mirror reflects what the notifications' alerts stored."""
+    while True:
+        try:
+            ids, error = delivery_results.get_nowait()
+        except queue.Empty:
+            break
+        for i in ids:
+            pending = pending_deliveries.get(i)
+            if pending:
+                pending[1] -= 1
+                pending[2] = pending[2] or error is not None
+
+    restored = []
+    for i in [i for i, pending in pending_deliveries.items() if pending[1] <= 0]:
+        before, outstanding, failed = pending_deliveries.pop(i)
+        row = mirror.subs.get(i)
+        if not failed or not before or not row or row['archived']:
+            continue
+        sn = ServiceNode(row, copy=False)
+        sn.update(next_check_at=int(now), **{ c: before[c] for c in ALERT_COLUMNS if row[c] != before[c] })
+        restored.append(sn.binary_pubkey())
+    return restored
+
 
 time_to_die = False
 def loki_updater():
     global time_to_die, tg, dc
     expected_dereg_height = {}
     checked_automon = set()
+    registered = { False: set(), True: set() }  # testnet: set(pubkey, ...) as of the last poll
+    state_fields = { False: {}, True: {} }  # testnet: {pubkey: (STATE_FIELDS values...)} as of the last poll
+    full_scan = True
+    history_pruned = False  # whether the loaded history has been checked against the networks
     last = 0
+    last_archive = 0
+    last_reconcile = time.time()
     while not time_to_die:
         now = time.time()
         if now - last < 10:
@@ -76,21 +217,34 @@ def loki_updater():
             print("An exception occured during oxen stats fetching: {}".format(e))
             continue
         last = now
-        sns = { x['service_node_pubkey']: x for x in sns }
-        lokisnbot.sn_states, lokisnbot.network_info = sns, status
+        sns = { bytes.fromhex(x['service_node_pubkey']): x for x in sns }
+        mainnet = (status, sns, lokinet_addresses(sns, snapshot.current.mainnet.lokinet_addrs))
 
-        tsns, tstatus = None, None
+        tsns, tstatus, testnet = None, None, None
         if config.TESTNET_NODE_URL:
             try:
                 tstatus = requests.get(config.TESTNET_NODE_URL + '/get_info', timeout=2).json()
                 tsns = requests.post(config.TESTNET_NODE_URL + '/json_rpc', json={"jsonrpc":"2.0","id":"0","method":"get_service_nodes"},
                         timeout=2).json()['result']['service_node_states']
-                tsns = { x['service_node_pubkey']: x for x in tsns }
-                lokisnbot.testnet_sn_states, lokisnbot.testnet_network_info = tsns, tstatus
+                tsns = { bytes.fromhex(x['service_node_pubkey']): x for x in tsns }
+                testnet = (tstatus, tsns, lokinet_addresses(tsns, snapshot.current.testnet.lokinet_addrs))
             except Exception as e:
                 print("An exception occured during oxen testnet stats fetching: {}; ignoring the error".format(e))
                 tsns, tstatus = None, None
 
+        # Publish both networks at once (keeping the previous testnet snapshot if testnet failed):
+        # and have everything below (e.g. ServiceNode states) use them:
+        prev_snap = snapshot.current
+        snap = snapshot.publish(mainnet, testnet, fetched_at=now)
+        snapshot.hold(snap)
+        refresh.clear()
+        for s in (sns, tsns):
+            if s:
+                history.observe(s, now)
+        if not history_pruned and (tsns or not config.TESTNET_NODE_URL):
+            history.forget_missing(sns, tsns or {})
+            history_pruned = True
+
         for s, infinite_from, finite_blocks in (
                 (tsns, TESTNET_INFINITE_FROM, TESTNET_STAKE_BLOCKS),
                 (sns, INFINITE_FROM, STAKE_BLOCKS)):
@@ -102,228 +256,114 @@ def loki_updater():
                 else:
                     expected_dereg_height[pubkey] = x['registration_height'] + TESTNET_STAKE_BLOCKS
 
-        monitoring = {} # uid: set(pubkey, ...)
-
         if not tg or not tg.ready() or not dc or not dc.ready:
             print("bots not ready yet!")
             continue
         try:
-            cur = pgsql.dict_cursor()
-            wallets = {}
-            cur.execute("SELECT uid, wallet FROM wallet_prefixes")
-            for row in cur:
-                if row[0] not in wallets:
-                    wallets[row[0]] = []
-                wallets[row[0]].append(row[1])
-            for uid in wallets:
-                wallets[uid] = tuple(wallets[uid])
+            mirror.sync()
+            if now - last_reconcile >= MIRROR_RECONCILE_INTERVAL:
+                reloaded = mirror.reconcile()
+                if reloaded:
+                    print("Subscription mirror was out of sync; reloaded {}".format(', '.join(reloaded)))
+                    full_scan = True
+                last_reconcile = now
+            wallets = mirror.wallet_prefixes()
+            restored = restore_undelivered(now)
+            if config.API_PORT:
+                api.publish_tokens(mirror.api_tokens())
 
             mainnet_height = status['height']
             testnet_height = tstatus['height'] if tsns else None
 
-            inactive = []
-            cur.execute("SELECT users.telegram_id, users.discord_id, service_nodes.* FROM users JOIN service_nodes ON uid = users.id ORDER BY uid")
-            for row in cur:
-                sn = ServiceNode(row)
-                if not sn['telegram_id'] and not sn['discord_id']:
+            # Revive any archived subscriptions for nodes that have (re-)appeared on the network:
+            for testnet, s in ((False, sns), (True, tsns)):
+                if s is None:
                     continue
-                if sn.testnet and not tsns:
-                    continue  # Ignore: testnet node didn't respond
-                uid = sn['uid']
-                chatid = sn['telegram_id']
-                pubkey = sn['pubkey']
-                name = sn.alias()
-                netheight = testnet_height if sn.testnet else mainnet_height
-                if uid not in monitoring:
-                    monitoring[uid] = set()
-                monitoring[uid].add(pubkey)
-
-                prefix = '🚧' if sn.testnet else ''
-
-                if not sn.active():
-                    if not sn['notified_dereg']:
-                        dereg_msg = ('📅 Service node _{}_ reached the end of its registration period and is no longer registered on the network.'.format(name)
-                                if pubkey in expected_dereg_height and 0 < expected_dereg_height[pubkey] <= netheight else
-                                '🛑 *UNEXPECTED DEREGISTRATION!* Service node _{}_ is no longer registered on the network! 😦'.format(name))
-                        if notify(sn, prefix + dereg_msg):
-                            sn.update(active=False, notified_dereg=True, complete=False, last_contributions=0, expiry_notified=None)
-                    elif sn['active']:
-                        sn.update(active=False)
-
-                    continue
-                elif sn['notified_dereg'] or not sn['active']:
-                    sn.update(active=True, notified_dereg=False)
-
-
-                if sn.decommissioned():
-                    if not sn['notified_decomm'] or sn['notified_decomm'] + 60*60 <= now:
-                        decomm_msg = '☣️ *WARNING*: Service node _{}_ has been *DECOMMISSIONED* for missing uptime proofs.'.format(name)
-                        if sn.decomm_credit_blocks():
-                            decomm_msg += '  It has {} to start sending uptime proofs again or else it will be deregistered!'.format(sn.format_decomm_credit())
-                        else:
-                            decomm_msg += '  It has *no* uptime credit left; *deregistration* is imminent!'
-                        if notify(sn, prefix+decomm_msg):
-                            sn.update(notified_decomm=now)
-                elif sn['notified_decomm'] and sn.active_on_network():
-                    if notify(sn, prefix+'😌 Service node _{}_ has been recommissioned and is now active on the network again! 💚'.format(name)):
-                        sn.update(notified_decomm=None)
-
-
-                proof_age = sn.proof_age()
-                if proof_age is not None:
-                    if proof_age >= PROOF_AGE_WARNING:
-                        if not sn['notified_age'] or proof_age - sn['notified_age'] > PROOF_AGE_REPEAT:
-                            if notify(sn, prefix+'⚠ *WARNING:* Service node _{}_ last uptime proof is *{}*'.format(name, sn.format_proof_age())):
-                                sn.update(notified_age=proof_age)
-                    elif sn['notified_age']:
-                        if notify(sn, prefix+'😌 Service node _{}_ last uptime proof received (now *{}*)'.format(name, sn.format_proof_age())):
-                            sn.update(notified_age=None)
-
-
-                just_completed = False
-                if not sn['complete']:
-                    if not sn['last_contributions'] or sn['last_contributions'] < sn.state('total_contributed'):
-                        pct = sn.state('total_contributed') / sn.state('staking_requirement') * 100
-                        msg_part_a = ('{} Service node _{}_ is awaiting contributions.' if not sn['last_contributions'] else
-                                '{} Service node _{}_ received a contribution.').format(sn.moon_symbol(pct), name)
-
-                        if notify(sn, prefix + msg_part_a + '  Total contributions: _{:.9f}_ (_{:.1f}%_ of required _{:.9f}_).  Additional contribution required: _{:.9f}_.'.format(
-                                sn.state('total_contributed')*1e-9, pct, sn.state('staking_requirement')*1e-9, (sn.state('staking_requirement') - sn.state('total_contributed'))*1e-9)):
-                            sn.update(last_contributions=sn.state('total_contributed'))
-
-                    if sn.state('total_contributed') >= sn.state('staking_requirement'):
-                        if notify(sn, prefix+'💚 Service node _{}_ is now fully staked and active!'.format(name)):
-                            sn.update(complete=True)
-                        just_completed = True
-
-
-                req_unlock = None
-                if sn.infinite_stake():
-                    req_height = sn.expiry_block()
-                    if req_height is None:
-                        if sn['requested_unlock_height'] is not None or sn['unlock_notified']:
-                            sn.update(requested_unlock_height=None, unlock_notified=False)
-                    elif not sn['unlock_notified']:
-                        if notify(sn, prefix+'📆 💔 Service node _{}_ has started a stake unlock.  Stakes will unlock in {} (at block _{}_)'.format(
-                                name, util.friendly_time((req_height - netheight) * AVERAGE_BLOCK_SECONDS), req_height)):
-                            sn.update(unlock_notified=True, requested_unlock_height=req_height)
-
-
-                snver = sn.version()
-                if snver and any(snver):
-                    if config.WARN_VERSION_MSG and config.WARN_VERSION_LESS_THAN and snver < config.WARN_VERSION_LESS_THAN:
-                        if not sn['notified_obsolete'] or sn['notified_obsolete'] + 24*60*60 <= now:
-                            if notify(sn, prefix+'⚠ *WARNING:* Service node _{}_ is running *v{}*\n{}\nIf not upgraded before the fork this service node will deregister!'.format(
-                                    name, sn.version_str(), config.WARN_VERSION_MSG)):
-                                sn.update(notified_obsolete=now)
-                    elif sn['notified_obsolete']:
-                        if notify(sn, prefix+'💖 Service node _{}_ is now running *v{}*.  Thanks for upgrading!'.format(name, ServiceNode.to_version_string(snver))):
-                            sn.update(notified_obsolete=None)
-
-                    update_lv = False
-                    if sn['last_version'] and sn['last_version'] > [0, 0, 0]:
-                        msg = None
-                        if snver > sn['last_version']:
-                            msg = prefix+'💖 Service node _{}_ upgraded to *v{}* (from *v{}*)'
-                            if snver >= [8,1,5] and sn['last_version'] < [8,1,5]:
-                                msg += '\n\n🐂 Welcome to OXEN! 🐂'
-                        elif [0, 0, 0] < snver < sn['last_version']:
-                            msg = prefix+'💔 Service node _{}_ *downgraded* to *v{}* (from *v{}*)!'
-
-                        if msg and notify(sn, msg.format(name, ServiceNode.to_version_string(snver), ServiceNode.to_version_string(sn['last_version']))):
-                            update_lv = True
-                    else:
-                        update_lv = True
-
-                    if update_lv:
-                        sn.update(last_version=snver)
-
-
-                if (snver and snver in ([3,0,0], [3,0,1], [3,0,2], [3,0,3], [3,0,4], [3,0,5])):
-                    if not sn['notified_v305'] or sn['notified_v305'] + 24*60*60 <= now:
-                        if notify(sn,
-                                '🛑 *WARNING* Service node _{}_ is running a version before *v3.0.6*; a bug has been found (and fixed in *v3.0.6*) that can cause service '
-                                'node deregistration; upgrading to v3.0.6 (now available on github) as soon as possible is strongly recommended.'.format(name)):
-                            sn.update(notified_v305=now)
-
-
-                if sn['expires_soon']:
-                    expires_at, expires_in = sn.expiry_block(), sn.expires_in()
-                    if sn.infinite_stake() and expires_at is None:
-                        if sn['expiry_notified']:
-                            sn.update(expiry_notified=None)
-                    else:
-                        notify_time = next((int(t*3600) for t in (config.TESTNET_EXPIRY_THRESHOLDS if sn.testnet else config.EXPIRY_THRESHOLDS) if expires_in <= t*3600), None)
-                        if notify_time and (not sn['expiry_notified'] or sn['expiry_notified'] > notify_time):
-                            hformat = '{:.0f}' if expires_in >= 7200 else '{:.1f}'
-                            if notify(sn, prefix+('⏱ Service node _{}_ registration expires in about '+hformat+' hour{} (block _{}_)').format(
-                                    name, expires_in/3600, '' if expires_in == 3600 else 's', expires_at)):
-                                sn.update(expiry_notified=notify_time)
-                        elif notify_time is None and sn['expiry_notified']:
-                            sn.update(expiry_notified=None)
-
-                lrbh = sn.state('last_reward_block_height')
-                if not sn['last_reward_block_height']:
-                    sn.update(last_reward_block_height=lrbh)
-                elif sn['last_reward_block_height'] and lrbh > sn['last_reward_block_height']:
-                    if (sn['rewards']
-                            and lrbh > sn.state('state_height') # will be == if the update was a recommission rather than a reward
-                            and not just_completed
-                            and sn.state('total_contributed') >= sn.state('staking_requirement')):
-                        snreward = reward(lrbh)
-                        my_rewards = []
-                        if sn['uid'] in wallets and len(sn.state('contributors')) > 1:
-                            for y in sn.state('contributors'):
-                                if y['address'].startswith(wallets[sn['uid']]):
-                                    operator_reward = snreward * sn.operator_fee()
-                                    mine = (snreward - operator_reward) * y['amount'] / sn.state('staking_requirement')
-                                    if y['address'] == sn.state('operator_address'):
-                                        mine += operator_reward
-                                    my_rewards.append('*{:.3f} OXEN* (_{}...{}_)'.format(mine, y['address'][0:7], y['address'][-3:]))
-
-                        if notify(sn, prefix+'💰 Service node _{}_ earned a reward of *{:.3f} OXEN* at height *{}*.'.format(name, snreward, lrbh) + (
-                                    '  Your share: ' + ', '.join(my_rewards) if my_rewards else ''), is_update=False):
-                            sn.update(last_reward_block_height=lrbh)
-                    else:
-                        sn.update(last_reward_block_height=lrbh)
+                appeared = s.keys() - registered[testnet]
+                if appeared:
+                    mirror.revive(appeared)
+                history.forget(registered[testnet] - s.keys())
+                registered[testnet] = set(s.keys())
+
+            # Report rewards from the blocks since the last poll (this has to come before the
+            # evaluation, which otherwise reports just the latest reward of each SN):
+            for testnet, url, s, st in ((False, config.NODE_URL, sns, status), (True, config.TESTNET_NODE_URL, tsns, tstatus)):
+                if s:
+                    rewards.backfill(url, testnet, st['height'], notify, wallets)
+
+            if config.SQL_EVALUATOR:
+                sqleval.evaluate(((False, sns, mainnet_height),) + (((True, tsns, testnet_height),) if tsns else ()),
+                        notify, now, wallets, expected_dereg_height)
+            else:
+                # Only look at subscriptions that are due or whose SN changed (except on the first
+                # pass, which looks at everything):
+                changed = [pubkey for testnet, s in ((False, sns), (True, tsns)) if s is not None
+                        for pubkey in state_changes(s, state_fields[testnet])]
+                # ... or that just crossed an expiry notification threshold:
+                for testnet, s, thresholds in ((False, sns, config.EXPIRY_THRESHOLDS), (True, tsns, config.TESTNET_EXPIRY_THRESHOLDS)):
+                    if s is not None:
+                        changed += expiry.crossed_thresholds(prev_snap.network(testnet), snap.network(testnet), thresholds)
+                # ... or that had an alert put back because it couldn't be delivered:
+                changed += restored
+                undelivered.clear()
+
+                for sn in mirror.subscriptions(now, None if full_scan else changed):
+                    if not sn['telegram_id'] and not sn['discord_id']:
+                        continue
+                    if sn.testnet and not tsns:
+                        continue  # Ignore: testnet node didn't respond
+                    netheight = testnet_height if sn.testnet else mainnet_height
+                    alerts.check(sn, notify, now, netheight, wallets, expected_dereg_height)
+                    reschedule(sn, now)
+
+                full_scan = False
 
             # Auto-monitor checking
-            sn_lists = (sns, tsns) if tsns else (sns,)
-            cur.execute("SELECT id, telegram_id, discord_id FROM users WHERE auto_monitor")
-            for row in cur:
-                uid = row[0]
+            nets = (snap.mainnet, snap.testnet) if tsns else (snap.mainnet,)
+            for uid, telegram_id, discord_id, monitoring in mirror.auto_monitor_users():
                 if uid not in wallets:
                     continue
-                if uid not in monitoring:
-                    monitoring[uid] = set()
-                for z in sn_lists:
-                    for pubkey, sn_data in z.items():
-                        if pubkey in checked_automon or pubkey in monitoring[uid]:
+                for net in nets:
+                    for pubkey in contributors.matching(net, wallets[uid]):
+                        if pubkey in checked_automon or pubkey in monitoring:
                             continue
-                        if any(c['address'].startswith(wallets[uid]) for c in sn_data['contributors']):
-                            sn = ServiceNode({
-                                'telegram_id': row[1],
-                                'discord_id': row[2],
-                                'pubkey': pubkey,
-                                'uid': uid,
-                                'active': True,
-                                'complete': sn_data['total_contributed'] >= sn_data['staking_requirement'],
-                                'last_reward_block_height': sn_data['last_reward_block_height']
-                            })
-                            sn.insert(exclude=('telegram_id', 'discord_id'))
-                            notify(sn, "{}Now monitoring a new service node of yours on the network: {} {}".format(
-                                '🚧' if sn.testnet else '', sn.status_icon(), sn.alias()))
+                        sn_data = net.states[pubkey]
+                        sn = ServiceNode({
+                            'telegram_id': telegram_id,
+                            'discord_id': discord_id,
+                            'pubkey': pubkey,
+                            'uid': uid,
+                            'active': True,
+                            'complete': sn_data['total_contributed'] >= sn_data['staking_requirement'],
+                            'last_reward_block_height': sn_data['last_reward_block_height']
+                        })
+                        sn.insert(exclude=('telegram_id', 'discord_id'))
+                        mirror.store(sn)
+                        notify(sn, "{}Now monitoring a new service node of yours on the network: {} {}".format(
+                            '🚧' if sn.testnet else '', sn.status_icon(), sn.alias()))
 
             # Everything is now checked, so don't bother checking any fully-staked SNs again:
-            checked_automon = set(pubkey for z in sn_lists for pubkey, sn in z.items() if sn['total_contributed'] >= sn['staking_requirement'])
+            checked_automon = set().union(*(columns.fully_staked(net) for net in nets))
+
+            # Move long-deregistered subscriptions out of the polled set:
+            if now - last_archive >= ARCHIVE_INTERVAL:
+                archived = ServiceNode.archive_deregistered(int(now) - ARCHIVE_AFTER)
+                if archived:
+                    print("Archived {} deregistered service node subscriptions".format(archived))
+                last_archive = now
 
+            history.persist(now)
 
         except Exception as e:
             print("An exception occured during updating/notifications: {}".format(e))
             import sys
             traceback.print_exc(file=sys.stdout)
+            # We may not have gotten to all the changed subscriptions, so look at everything next time:
+            full_scan = True
             continue
 
+    history.persist(time.time(), force=True)
+
 
 loki_thread = None
 def start_loki_update_thread():
@@ -331,7 +371,7 @@ def start_loki_update_thread():
     loki_thread = threading.Thread(target=loki_updater)
     loki_thread.start()
     while True:
-        if lokisnbot.network_info:
+        if snapshot.current.mainnet.generation:
             print("Oxen data fetched")
             return
         time.sleep(0.25)
@@ -344,6 +384,8 @@ def stop_threads(signum, frame):
     loki_thread.join()
     print("Stopped updater thread")
 
+    api.stop()
+
     global tg, dc
     tg.stop()
     print("Stopped Telegram")
@@ -353,8 +395,12 @@ def stop_threads(signum, frame):
 
 def main():
     pgsql.connect()
+    uidcache.preload()
+    mirror.load()
+    history.load()
 
     start_loki_update_thread()
+    api.start()
 
     print("Starting Telegram bot")
 
@@ -1,9 +1,6 @@
 
 config = None
-network_info = {}
-sn_states = {}
-testnet_sn_states = {}
-testnet_network_info = {}
+# The network states (get_info, SN states, lokinet addresses) are in lokisnbot.snapshot
 
 # Enable logging
 import logging
@@ -0,0 +1,274 @@
+# Subscription alerts: the alert messages, and the updater's per-subscription evaluation of which
+# of them need to go out.
+
+import lokisnbot
+from . import util
+from . import history
+from .constants import *
+from .servicenode import ServiceNode, reward
+
+
+V305_BUGGY = ([3,0,0], [3,0,1], [3,0,2], [3,0,3], [3,0,4], [3,0,5])
+
+
+def prefix(sn):
+    return '🚧' if sn.testnet else ''
+
+
+def dereg_msg(sn, expected):
+    return prefix(sn) + ('📅 Service node _{}_ reached the end of its registration period and is no longer registered on the network.' if expected else
+            '🛑 *UNEXPECTED DEREGISTRATION!* Service node _{}_ is no longer registered on the network! 😦').format(sn.alias())
+
+
+def decomm_msg(sn):
+    msg = '☣️ *WARNING*: Service node _{}_ has been *DECOMMISSIONED* for missing uptime proofs.'.format(sn.alias())
+    if sn.decomm_credit_blocks():
+        msg += '  It has {} to start sending uptime proofs again or else it will be deregistered!'.format(sn.format_decomm_credit())
+    else:
+        msg += '  It has *no* uptime credit left; *deregistration* is imminent!'
+    return prefix(sn) + msg
+
+
+def recomm_msg(sn):
+    return prefix(sn) + '😌 Service node _{}_ has been recommissioned and is now active on the network again! 💚'.format(sn.alias())
+
+
+def proof_age_msg(sn):
+    return prefix(sn) + '⚠ *WARNING:* Service node _{}_ last uptime proof is *{}*'.format(sn.alias(), sn.format_proof_age())
+
+
+def unstable_msg(sn, stats):
+    return prefix(sn) + ('⚠ Service node _{}_ looks *unstable*: in the last {} it has had *{}* late uptime proofs and *{}* decommissions '
+            '(average time between proofs: _{}_; longest: _{}_).  Its last uptime proof is *{}*.  I won\'t warn about every late proof while '
+            'this continues, unless the proof gets more than {} old.').format(
+            sn.alias(), util.friendly_time(FLAP_WINDOW), stats['late'] + 1, stats['decomms'],
+            util.friendly_time(int(stats['mean'])) if stats['mean'] else 'unknown', util.friendly_time(stats['max']) if stats['max'] else 'unknown',
+            sn.format_proof_age(), util.friendly_time(UNSTABLE_PROOF_AGE))
+
+
+def proof_received_msg(sn):
+    return prefix(sn) + '😌 Service node _{}_ last uptime proof received (now *{}*)'.format(sn.alias(), sn.format_proof_age())
+
+
+def contribution_msg(sn, first):
+    pct = sn.state('total_contributed') / sn.state('staking_requirement') * 100
+    return prefix(sn) + ('{} Service node _{}_ is awaiting contributions.' if first else
+            '{} Service node _{}_ received a contribution.').format(sn.moon_symbol(pct), sn.alias()) + (
+            '  Total contributions: _{:.9f}_ (_{:.1f}%_ of required _{:.9f}_).  Additional contribution required: _{:.9f}_.'.format(
+                sn.state('total_contributed')*1e-9, pct, sn.state('staking_requirement')*1e-9, (sn.state('staking_requirement') - sn.state('total_contributed'))*1e-9))
+
+
+def staked_msg(sn):
+    return prefix(sn) + '💚 Service node _{}_ is now fully staked and active!'.format(sn.alias())
+
+
+def unlock_msg(sn, req_height, netheight):
+    return prefix(sn) + '📆 💔 Service node _{}_ has started a stake unlock.  Stakes will unlock in {} (at block _{}_)'.format(
+            sn.alias(), util.friendly_time((req_height - netheight) * AVERAGE_BLOCK_SECONDS), req_height)
+
+
+def obsolete_msg(sn):
+    return prefix(sn) + '⚠ *WARNING:* Service node _{}_ is running *v{}*\n{}\nIf not upgraded before the fork this service node will deregister!'.format(
+            sn.alias(), sn.version_str(), lokisnbot.config.WARN_VERSION_MSG)
+
+
+def upgraded_msg(sn):
+    return prefix(sn) + '💖 Service node _{}_ is now running *v{}*.  Thanks for upgrading!'.format(sn.alias(), sn.version_str())
+
+
+def version_change_msg(sn, last_version):
+    """Returns the message about a SN version change from `last_version`, or None if it isn't an
+    upgrade or downgrade"""
+    snver = sn.version()
+    msg = None
+    if snver > last_version:
+        msg = prefix(sn) + '💖 Service node _{}_ upgraded to *v{}* (from *v{}*)'
+        if snver >= [8,1,5] and last_version < [8,1,5]:
+            msg += '\n\n🐂 Welcome to OXEN! 🐂'
+    elif [0, 0, 0] < snver < last_version:
+        msg = prefix(sn) + '💔 Service node _{}_ *downgraded* to *v{}* (from *v{}*)!'
+    return msg and msg.format(sn.alias(), sn.version_str(), ServiceNode.to_version_string(last_version))
+
+
+def v305_msg(sn):
+    return ('🛑 *WARNING* Service node _{}_ is running a version before *v3.0.6*; a bug has been found (and fixed in *v3.0.6*) that can cause service '
+            'node deregistration; upgrading to v3.0.6 (now available on github) as soon as possible is strongly recommended.'.format(sn.alias()))
+
+
+def expiry_msg(sn, expires_in, expires_at):
+    hformat = '{:.0f}' if expires_in >= 7200 else '{:.1f}'
+    return prefix(sn) + ('⏱ Service node _{}_ registration expires in about '+hformat+' hour{} (block _{}_)').format(
+            sn.alias(), expires_in/3600, '' if expires_in == 3600 else 's', expires_at)
+
+
+def expiry_threshold(sn, expires_in):
+    """Returns the expiry notification threshold (in seconds) that `expires_in` has reached, or None"""
+    return next((int(t*3600) for t in (lokisnbot.config.TESTNET_EXPIRY_THRESHOLDS if sn.testnet else lokisnbot.config.EXPIRY_THRESHOLDS)
+        if expires_in <= t*3600), None)
+
+
+def reward_shares(sn, snreward, wallets=None):
+    """Returns a list of (address, amount) pairs of the shares of a `snreward` reward that go to
+    contributors matching one of the `wallets` prefixes.  Returns an empty list for a solo node, or
+    if the user has no wallets."""
+    if not wallets or len(sn.state('contributors')) <= 1:
+        return []
+    return [(addr, mine / COIN) for addr, mine in sn.reward_split(int(snreward * COIN)).items() if addr.startswith(wallets)]
+
+
+def format_shares(shares):
+    return ', '.join('*{:.3f} OXEN* (_{}...{}_)'.format(mine, addr[0:7], addr[-3:]) for addr, mine in shares)
+
+
+def reward_msg(sn, lrbh, wallets=None):
+    """Reward message for a reward at height `lrbh`; `wallets` is the user's tuple of wallet
+    prefixes, if any, used to include the user's share of the reward"""
+    snreward = reward(lrbh)
+    my_rewards = reward_shares(sn, snreward, wallets)
+    return prefix(sn) + '💰 Service node _{}_ earned a reward of *{:.3f} OXEN* at height *{}*.'.format(sn.alias(), snreward, lrbh) + (
+            '  Your share: ' + format_shares(my_rewards) if my_rewards else '')
+
+
+def reward_summary_msg(won, wallets=None):
+    """Aggregated reward message for all the rewards earned by one user's SNs since the last
+    update.  `won` is a list of (sn, [height, ...]) pairs.  A single reward gets the regular
+    reward_msg()."""
+    if len(won) == 1 and len(won[0][1]) == 1:
+        return reward_msg(won[0][0], won[0][1][0], wallets)
+
+    lines = ['💰 Rewards earned since the last update:']
+    for sn, heights in won:
+        total = sum(reward(h) for h in heights)
+        shares = {}
+        for h in heights:
+            for addr, mine in reward_shares(sn, reward(h), wallets):
+                shares[addr] = shares.get(addr, 0) + mine
+        lines.append('{}Service node _{}_: *{}* reward{} totalling *{:.3f} OXEN* (at height{} {})'.format(
+            prefix(sn), sn.alias(), len(heights), '' if len(heights) == 1 else 's', total, '' if len(heights) == 1 else 's',
+            ', '.join('*{}*'.format(h) for h in heights)) + (
+            '.  Your share: ' + format_shares(shares.items()) if shares else ''))
+    return '\n'.join(lines)
+
+
+def check(sn, notify, now, netheight, wallets, expected_dereg_height):
+    """Evaluates a single subscription: sends whatever alerts are needed (through `notify(sn, msg,
+    is_update=True)`, which returns true if the message went out) and records them in the
+    subscription.  `wallets` is the {uid: (wallet, ...)} prefix dict; `expected_dereg_height` is a
+    {pubkey: height} dict of when nodes are expected to leave the network."""
+    pubkey = sn.binary_pubkey()
+
+    if not sn.active():
+        if not sn['notified_dereg']:
+            if notify(sn, dereg_msg(sn, pubkey in expected_dereg_height and 0 < expected_dereg_height[pubkey] <= netheight)):
+                sn.update(active=False, notified_dereg=True, complete=False, last_contributions=0, expiry_notified=None, deregistered_at=int(now))
+        elif sn['active']:
+            sn.update(active=False)
+        return
+    elif sn['notified_dereg'] or not sn['active']:
+        sn.update(active=True, notified_dereg=False)
+
+
+    if sn.decommissioned():
+        if not sn['notified_decomm'] or sn['notified_decomm'] + 60*60 <= now:
+            if notify(sn, decomm_msg(sn)):
+                sn.update(notified_decomm=now)
+    elif sn['notified_decomm'] and sn.active_on_network():
+        if notify(sn, recomm_msg(sn)):
+            sn.update(notified_decomm=None)
+
+
+    proof_age = sn.proof_age()
+    if proof_age is not None:
+        if proof_age >= PROOF_AGE_WARNING:
+            # A node that keeps going just over the threshold gets a single "unstable" alert (per
+            # FLAP_WINDOW) rather than a warning/recovered pair each time, unless the proof gets
+            # really old:
+            unstable = not sn['notified_age'] and proof_age < UNSTABLE_PROOF_AGE and history.flapping(pubkey, now)
+            if unstable:
+                if not sn['notified_unstable'] or sn['notified_unstable'] + FLAP_WINDOW <= now:
+                    if notify(sn, unstable_msg(sn, unstable)):
+                        sn.update(notified_unstable=int(now))
+            elif not sn['notified_age'] or proof_age - sn['notified_age'] > PROOF_AGE_REPEAT:
+                if notify(sn, proof_age_msg(sn)):
+                    sn.update(notified_age=proof_age)
+        elif sn['notified_age']:
+            if notify(sn, proof_received_msg(sn)):
+                sn.update(notified_age=None)
+
+
+    just_completed = False
+    if not sn['complete']:
+        if not sn['last_contributions'] or sn['last_contributions'] < sn.state('total_contributed'):
+            if notify(sn, contribution_msg(sn, not sn['last_contributions'])):
+                sn.update(last_contributions=sn.state('total_contributed'))
+
+        if sn.state('total_contributed') >= sn.state('staking_requirement'):
+            if notify(sn, staked_msg(sn)):
+                sn.update(complete=True)
+            just_completed = True
+
+
+    if sn.infinite_stake():
+        req_height = sn.expiry_block()
+        if req_height is None:
+            if sn['requested_unlock_height'] is not None or sn['unlock_notified']:
+                sn.update(requested_unlock_height=None, unlock_notified=False)
+        elif not sn['unlock_notified']:
+            if notify(sn, unlock_msg(sn, req_height, netheight)):
+                sn.update(unlock_notified=True, requested_unlock_height=req_height)
+
+
+    snver = sn.version()
+    if snver and any(snver):
+        config = lokisnbot.config
+        if config.WARN_VERSION_MSG and config.WARN_VERSION_LESS_THAN and snver < config.WARN_VERSION_LESS_THAN:
+            if not sn['notified_obsolete'] or sn['notified_obsolete'] + 24*60*60 <= now:
+                if notify(sn, obsolete_msg(sn)):
+                    sn.update(notified_obsolete=now)
+        elif sn['notified_obsolete']:
+            if notify(sn, upgraded_msg(sn)):
+                sn.update(notified_obsolete=None)
+
+        update_lv = False
+        if sn['last_version'] and sn['last_version'] > [0, 0, 0]:
+            msg = version_change_msg(sn, sn['last_version'])
+            if msg and notify(sn, msg):
+                update_lv = True
+        else:
+            update_lv = True
+
+        if update_lv:
+            sn.update(last_version=snver)
+
+
+    if snver and snver in V305_BUGGY:
+        if not sn['notified_v305'] or sn['notified_v305'] + 24*60*60 <= now:
+            if notify(sn, v305_msg(sn)):
+                sn.update(notified_v305=now)
+
+
+    if sn['expires_soon']:
+        expires_at, expires_in = sn.expiry_block(), sn.expires_in()
+        if sn.infinite_stake() and expires_at is None:
+            if sn['expiry_notified']:
+                sn.update(expiry_notified=None)
+        else:
+            notify_time = expiry_threshold(sn, expires_in)
+            if notify_time and (not sn['expiry_notified'] or sn['expiry_notified'] > notify_time):
+                if notify(sn, expiry_msg(sn, expires_in, expires_at)):
+                    sn.update(expiry_notified=notify_time)
+            elif notify_time is None and sn['expiry_notified']:
+                sn.update(expiry_notified=None)
+
+    lrbh = sn.state('last_reward_block_height')
+    if not sn['last_reward_block_height']:
+        sn.update(last_reward_block_height=lrbh)
+    elif sn['last_reward_block_height'] and lrbh > sn['last_reward_block_height']:
+        if (sn['rewards']
+                and lrbh > sn.state('state_height') # will be == if the update was a recommission rather than a reward
+                and not just_completed
+                and sn.state('total_contributed') >= sn.state('staking_requirement')):
+            if notify(sn, reward_msg(sn, lrbh, wallets.get(sn['uid'])), is_update=False):
+                sn.update(last_reward_block_height=lrbh)
+        else:
+            sn.update(last_reward_block_height=lrbh)
@@ -0,0 +1,182 @@
+# Optional read-only HTTP/JSON API (enabled by setting API_PORT in the config) for dashboards and
+# scripts.  Everything is served from memory: network status and per-node state come straight from
+# the published snapshots, and the monitored nodes of API token holders from a token table that the
+# updater republishes from the subscription mirror each poll, so requests never touch oxend or the
+# database.  Response bodies are serialized once per snapshot (and kept with it), and every
+# response carries an ETag derived from the snapshot generations it was built from, so a client
+# polling with If-None-Match gets a bodiless 304 until the next poll changes something.
+#
+# Endpoints:
+#   GET /status[?testnet]  - network height, node counts, unlock buckets, versions
+#   GET /sn/<pubkey>       - the oxend state of the given service node (mainnet or testnet)
+#   GET /mine              - the caller's monitored nodes with their states; needs the caller's
+#                            token (see NetworkContext.api_token_msg) as `Authorization: Bearer ...`
+
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import lokisnbot
+from . import snapshot, columns, expiry, opennodes
+
+# token: (version, ((binary pubkey, testnet, alias), ...)); replaced (never modified) by publish_tokens()
+tokens = {}
+_token_versions = {}  # token: (version, nodes) as of the last publish_tokens() (updater thread only)
+
+server = None
+server_thread = None
+
+
+def publish_tokens(token_nodes):
+    """Replaces the token table with the given {token: ((binary pubkey, testnet, alias), ...)}
+    (see mirror.api_tokens()).  A token's version only changes when its list of monitored nodes
+    does, so unchanged users keep their ETags.  Called from the updater thread."""
+    global tokens
+    new = {}
+    for token, nodes in token_nodes.items():
+        old = _token_versions.get(token)
+        new[token] = old if old and old[1] == nodes else ((old[0] + 1 if old else 1), nodes)
+    _token_versions.clear()
+    _token_versions.update(new)
+    tokens = new
+
+
+def _body(obj):
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def _status_body(snap):
+    counts = columns.status_counts(snap, now=int(snap.fetched_at))
+    return _body({
+        'testnet': snap.testnet,
+        'generation': snap.generation,
+        'fetched_at': int(snap.fetched_at),
+        'height': snap.height,
+        'service_nodes': { k: counts[k] for k in ('active', 'decomm', 'waiting', 'infinite', 'old_proof') },
+        'open': len(opennodes.index(snap).by['room']),
+        'unlocking': dict(zip(('1d', '3d', '7d', 'later'), expiry.unlock_buckets(snap))),
+        'versions': [{ 'version': list(v) if v else None, 'count': n } for v, n in counts['versions'].items()],
+        })
+
+
+def _ready(snap):
+    """True if the snapshot holds polled network state (rather than being the generation 0
+    placeholder of a network that hasn't been, or isn't, polled)"""
+    return snap.generation != 0 and snap.height is not None
+
+
+def _node(snap, pubkey):
+    return {
+        'pubkey': pubkey.hex(),
+        'testnet': snap.testnet,
+        'height': snap.height,
+        'lokinet': snap.lokinet_addrs.get(pubkey),
+        'state': snap.states[pubkey],
+        }
+
+
+def _node_body(snap, pubkey):
+    return snap.index(('api_node', pubkey), lambda s: _body(_node(s, pubkey)))
+
+
+def _mine_body(nets, token, version, nodes):
+    mainnet, testnet = nets
+    def build(s):
+        result = []
+        for pubkey, is_testnet, alias in nodes:
+            snap = testnet if is_testnet else mainnet
+            node = _node(snap, pubkey) if pubkey in snap.states else { 'pubkey': pubkey.hex(), 'testnet': is_testnet, 'state': None }
+            node['alias'] = alias
+            result.append(node)
+        return _body(result)
+    # Kept with the mainnet snapshot, keyed by everything else the body depends on:
+    return mainnet.index(('api_mine', token, version, testnet.generation), build)
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = 'lokisnbot'
+    protocol_version = 'HTTP/1.1'
+
+    sn_re = re.compile(r'/sn/([0-9a-fA-F]{64})')
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        nets = snapshot.current
+        if url.path == '/status':
+            if url.query not in ('', 'testnet'):
+                return self.error(400, 'Invalid query string')
+            snap = nets.network(url.query == 'testnet')
+            if snap.testnet and not lokisnbot.config.TESTNET_NODE_URL:
+                return self.error(404, 'Testnet is not enabled')
+            if not _ready(snap):
+                return self.error(503, 'Network state not available yet')
+            return self.respond('"s{}"'.format(snap.generation), lambda: snap.index('api_status', _status_body))
+
+        m = self.sn_re.fullmatch(url.path)
+        if m:
+            if url.query:
+                return self.error(400, 'Invalid query string')
+            pubkey = bytes.fromhex(m[1])
+            for snap in nets:
+                if _ready(snap) and pubkey in snap.states:
+                    return self.respond('"n{}"'.format(snap.generation), lambda: _node_body(snap, pubkey))
+            return self.error(404, 'Unknown service node')
+
+        if url.path == '/mine':
+            auth = self.headers.get('Authorization', '')
+            entry = tokens.get(auth[7:]) if auth.startswith('Bearer ') else None
+            if not entry:
+                return self.error(401, 'Missing or invalid API token')
+            version, nodes = entry
+            return self.respond('"m{}-{}-{}"'.format(nets.mainnet.generation, nets.testnet.generation, version),
+                    lambda: _mine_body(nets, auth[7:], version, nodes), private=True)
+
+        return self.error(404, 'Not found')
+
+    def respond(self, etag, body, private=False):
+        """Sends a 304 if the client already has `etag`, otherwise the body (built by calling `body`)"""
+        if etag in (t.strip() for t in self.headers.get('If-None-Match', '').split(',')):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'private, no-cache' if private else 'no-cache')
+            self.end_headers()
+            return
+        body = body()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'private, no-cache' if private else 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, code, message):
+        body = _body({ 'error': message })
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start():
+    """Starts the API server thread, if API_PORT is configured"""
+    global server, server_thread
+    if not lokisnbot.config.API_PORT:
+        return
+    server = ThreadingHTTPServer((lokisnbot.config.API_LISTEN, lokisnbot.config.API_PORT), Handler)
+    server.daemon_threads = True
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    print("API listening on {}:{}".format(lokisnbot.config.API_LISTEN, lokisnbot.config.API_PORT))
+
+
+def stop():
+    if server:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,113 @@
+# Network-wide queries over a snapshot's service node states (status counts, reward queue position,
+# etc.).  If NumPy is installed each snapshot gets a columnar copy of the fields these need (built
+# once, the first time it is needed, and kept with the snapshot), so that the queries are vectorized
+# expressions instead of Python loops over every node; without NumPy the same queries run as plain
+# loops over the states.
+
+import time
+
+from .constants import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_NO_VERSION = -1
+
+
+def _pack_version(v):
+    """Packs a [major, minor, patch] version into a single integer, or _NO_VERSION if missing"""
+    if not v or len(v) != 3:
+        return _NO_VERSION
+    return v[0] << 40 | v[1] << 20 | v[2]
+
+
+def _unpack_version(p):
+    return None if p == _NO_VERSION else [p >> 40, p >> 20 & 0xfffff, p & 0xfffff]
+
+
+class Columns:
+    """Columnar (NumPy array) form of a network snapshot's service node states.  Row i of each array
+    is the node with pubkey `pubkeys[i]`; `row` maps binary pubkeys back to rows."""
+
+    def __init__(self, snap):
+        states = snap.states
+        self.pubkeys = list(states.keys())
+        self.row = { pk: i for i, pk in enumerate(self.pubkeys) }
+        vals = states.values()
+        col = lambda f, dtype=np.int64: np.fromiter(f, dtype=dtype, count=len(states))
+        self.registration_height = col(x['registration_height'] for x in vals)
+        self.unlock_height = col(x['requested_unlock_height'] or 0 for x in vals)
+        self.last_proof = col(x['last_uptime_proof'] or 0 for x in vals)
+        self.last_reward = col(x['last_reward_block_height'] for x in vals)
+        self.contributed = col(x['total_contributed'] for x in vals)
+        self.required = col(x['staking_requirement'] for x in vals)
+        self.active = col((x.get('active', True) for x in vals), dtype=bool)
+        self.version = col(_pack_version(x.get('service_node_version')) for x in vals)
+        self.staked = self.contributed >= self.required
+        self.infinite = self.registration_height >= (TESTNET_INFINITE_FROM if snap.testnet else INFINITE_FROM)
+
+
+def columns(snap):
+    """Returns the Columns of the given snapshot, or None if NumPy isn't available"""
+    if np is None:
+        return None
+    return snap.index('columns', Columns)
+
+
+def status_counts(snap, now=None):
+    """Returns a dict of network-wide node counts for the status display: 'active', 'decomm' and
+    'waiting' (for stakes) node counts; 'infinite' for infinite-staked nodes without an unlock;
+    'old_proof' for nodes with an uptime proof older than PROOF_AGE_WARNING; and 'versions', a
+    dict of version list (as a tuple, or None if unknown): node count."""
+    if now is None:
+        now = int(time.time())
+    c = columns(snap)
+    if c is not None:
+        versions, vcounts = np.unique(c.version, return_counts=True)
+        return {
+            'active': int(np.count_nonzero(c.staked & c.active)),
+            'decomm': int(np.count_nonzero(c.staked & ~c.active)),
+            'waiting': int(np.count_nonzero(~c.staked)),
+            'infinite': int(np.count_nonzero(c.infinite & (c.unlock_height == 0))),
+            'old_proof': int(np.count_nonzero((c.last_proof > 0) & (now - c.last_proof > PROOF_AGE_WARNING))),
+            'versions': { (tuple(v) if v else None): int(n) for v, n in zip(map(_unpack_version, versions.tolist()), vcounts) },
+            }
+
+    counts = { 'active': 0, 'decomm': 0, 'waiting': 0, 'infinite': 0, 'old_proof': 0, 'versions': {} }
+    for sn in snap.states.values():
+        if sn['total_contributed'] < sn['staking_requirement']:
+            counts['waiting'] += 1
+        elif 'active' not in sn or sn['active']:
+            counts['active'] += 1
+        else:
+            counts['decomm'] += 1
+        if sn['registration_height'] >= (TESTNET_INFINITE_FROM if snap.testnet else INFINITE_FROM) and not sn['requested_unlock_height']:
+            counts['infinite'] += 1
+        if sn['last_uptime_proof'] and now - sn['last_uptime_proof'] > PROOF_AGE_WARNING:
+            counts['old_proof'] += 1
+        v = sn.get('service_node_version')
+        v = tuple(v) if v else None
+        counts['versions'][v] = counts['versions'].get(v, 0) + 1
+    return counts
+
+
+def reward_queue_ahead(snap, last_reward_height):
+    """Returns the number of active, fully staked nodes that last earned a reward before
+    `last_reward_height`, i.e. that are ahead of a node with that last reward height in the reward
+    queue"""
+    cols = columns(snap)
+    if cols is not None:
+        return int(np.count_nonzero(cols.staked & cols.active & (cols.last_reward < last_reward_height)))
+    return sum(1 for sn in snap.states.values() if
+            ('active' not in sn or sn['active']) and sn['total_contributed'] >= sn['staking_requirement']
+            and sn['last_reward_block_height'] < last_reward_height)
+
+
+def fully_staked(snap):
+    """Returns the set of binary pubkeys of the snapshot's fully staked nodes"""
+    cols = columns(snap)
+    if cols is not None:
+        return set(cols.pubkeys[i] for i in np.flatnonzero(cols.staked))
+    return set(pubkey for pubkey, sn in snap.states.items() if sn['total_contributed'] >= sn['staking_requirement'])
@@ -6,7 +6,34 @@ TESTNET_STAKE_BLOCKS = 720*2 + 20  # Length of a stake (pre-3.0.0)
 INFINITE_FROM = 234767  # Block where infinite stakes began
 TESTNET_INFINITE_FROM = 1  # Testnet is always infinite
 AVERAGE_BLOCK_SECONDS = 120  # Target block time
+ARCHIVE_AFTER = 7*24*3600  # How long after a deregistration notification a SN subscription gets archived
+ARCHIVE_INTERVAL = 3600  # How often to look for subscriptions to archive
+MAX_CHECK_INTERVAL = 3600  # Longest time a subscription goes without being re-evaluated by the updater
+MIRROR_RECONCILE_INTERVAL = 600  # How often to verify the updater's in-memory subscription mirror against the database
 COIN = 1000000000  # Number of atomic units in 1 coin
+UID_CACHE_SIZE = 100000  # Max number of Telegram/Discord user -> uid mappings to keep in memory
+FAUCET_BATCH_WINDOW = 5  # How long the faucet waits for more requests to send in the same transaction
+FAUCET_MAX_DESTINATIONS = 15  # Max faucet payments per transaction, and per TESTNET_FAUCET_WAIT_GLOBAL period
+PROOF_HISTORY_SIZE = 48  # Number of uptime proof timestamps remembered per node
+TRANSITION_HISTORY_SIZE = 16  # Number of decommission/recommission transitions remembered per node
+HISTORY_PERSIST_INTERVAL = 600  # How often changed proof histories get written to the database
+FLAP_WINDOW = 24*3600  # Period over which late proofs/decommissions are counted to detect flapping
+FLAP_EPISODES = 3  # Late proofs/decommissions within FLAP_WINDOW that make a node "unstable"
+UNSTABLE_PROOF_AGE = 2*3600  # Proof age at which an unstable node gets regular proof age warnings again
+OPEN_NODES_PAGE_SIZE = 10  # Nodes per page of the open (awaiting contributions) nodes list
+OPEN_NODES_LOW_FEE = 0.05  # Operator fee limit of the open nodes list's "low fee" filter
+INLINE_RESULTS = 10  # Max number of service nodes returned for a Telegram inline query
+INLINE_MIN_PUBKEY_PREFIX = 4  # Min length of an inline query to search network-wide pubkeys with
+INLINE_CACHE_TIME = 10  # How long Telegram may cache inline query results, in seconds
+ALIAS_INDEX_TTL = 60  # How long a user's cached alias index (for inline queries) is used
+ALIAS_INDEX_SIZE = 10000  # Max number of users' alias indexes to keep in memory
+DISCORD_SEND_CONCURRENCY = 8  # Max number of Discord DMs being sent at once
+DISCORD_SEND_ATTEMPTS = 3  # Attempts to deliver a Discord DM before giving up (on transient errors)
+DISCORD_DM_CHANNEL_CACHE_SIZE = 10000  # Max number of Discord DM channels to keep in memory
+REFRESH_TTL = 30  # How long an on-demand refreshed SN state overrides the updater's snapshot
+REFRESH_MIN_INTERVAL = 2  # Refreshes of the same SN within this many seconds reuse the last result
+REWARD_HEADERS_PER_RPC = 1000  # Max number of block headers to request at once when scanning for rewards
+REWARD_BACKFILL_MAX_BLOCKS = 720*7  # How far back to go when catching up on missed rewards (e.g. after downtime)
 
 # (height,requirement) pairs for an integer math linear approximation of the staking amount which
 # started applying in the Loki 5.x hard fork.  This begins at the first height; anything beyond the
@@ -0,0 +1,95 @@
+# Contributor index: a per-snapshot list of every (contributor address, pubkey, amount) stake on the
+# network, sorted by address, so that the nodes a user's wallet prefixes have stakes in can be
+# found with a bisection per prefix rather than a `startswith` check of every contributor of every
+# node.  Used for the portfolio view, finding unmonitored nodes and auto-monitoring.
+
+import time
+from bisect import bisect_left
+
+from .constants import *
+from . import columns, expiry
+from .servicenode import reward, split_reward
+
+
+class ContributorIndex:
+    """The stakes of a snapshot's nodes sorted by contributor address: `addresses[i]` staked
+    `amounts[i]` in the node with binary pubkey `pubkeys[i]`."""
+
+    def __init__(self, snap):
+        stakes = sorted((c['address'], pubkey, c['amount'])
+                for pubkey, x in snap.states.items() for c in x['contributors'])
+        self.addresses = [s[0] for s in stakes]
+        self.pubkeys = [s[1] for s in stakes]
+        self.amounts = [s[2] for s in stakes]
+
+    def stakes(self, prefix):
+        """Returns a list of (address, pubkey, amount) of the stakes of addresses starting with `prefix`"""
+        i = j = bisect_left(self.addresses, prefix)
+        while j < len(self.addresses) and self.addresses[j].startswith(prefix):
+            j += 1
+        return list(zip(self.addresses[i:j], self.pubkeys[i:j], self.amounts[i:j]))
+
+
+def index(snap):
+    """Returns the ContributorIndex of the given snapshot"""
+    return snap.index('contributors', ContributorIndex)
+
+
+def matching(snap, prefixes):
+    """Returns the set of binary pubkeys of the snapshot's nodes with a contributor matching any of
+    the given wallet prefixes"""
+    idx = index(snap)
+    return set(pubkey for p in prefixes for a, pubkey, amount in idx.stakes(p))
+
+
+def portfolio(snap, prefixes, now=None):
+    """Summarizes the stakes of the given wallet prefixes in the snapshot's nodes.  Returns a list
+    with a dict for each prefix that has stakes, with keys:
+    - wallet: the wallet prefix
+    - stake: total atomic OXEN staked
+    - nodes: number of nodes staked in
+    - share: the wallet's share of those nodes, in nodes (e.g. 1.5 for one solo node and half of another)
+    - daily: expected atomic OXEN of rewards per day, at the current rate of one reward per active
+      node per queue cycle
+    - next_reward: blocks until the soonest next reward of any of the wallet's active nodes, or None
+    - at_risk: list of (pubkey, reason) of nodes that are decommissioned, have an overdue uptime
+      proof, or are unlocking/expiring within a day
+    """
+    if now is None:
+        now = int(time.time())
+    idx, expiries = index(snap), expiry.index(snap)
+    # Each active node earns one reward per pass through the reward queue:
+    rewards_per_day = 24 * 3600 / AVERAGE_BLOCK_SECONDS / max(columns.status_counts(snap, now)['active'], 1)
+    snreward = int(reward(snap.height) * COIN)
+    result = []
+    for prefix in prefixes:
+        stakes = idx.stakes(prefix)
+        if not stakes:
+            continue
+        p = { 'wallet': prefix, 'stake': 0, 'nodes': 0, 'share': 0, 'daily': 0, 'next_reward': None, 'at_risk': [] }
+        by_node = {}
+        for address, pubkey, amount in stakes:
+            by_node.setdefault(pubkey, []).append((address, amount))
+        for pubkey, mine in by_node.items():
+            x = snap.states[pubkey]
+            amount = sum(a for addr, a in mine)
+            p['stake'] += amount
+            p['nodes'] += 1
+            p['share'] += amount / x['staking_requirement']
+            staked = x['total_contributed'] >= x['staking_requirement']
+            active = x.get('active', True)
+            if staked and active:
+                split = split_reward(x, snreward)
+                p['daily'] += sum(split.get(addr, 0) for addr in set(addr for addr, a in mine)) * rewards_per_day
+                to_go = 1 + columns.reward_queue_ahead(snap, x['last_reward_block_height'])
+                if p['next_reward'] is None or to_go < p['next_reward']:
+                    p['next_reward'] = to_go
+
+            if staked and not active:
+                p['at_risk'].append((pubkey, 'decommissioned'))
+            elif staked and x['last_uptime_proof'] and now - x['last_uptime_proof'] > PROOF_AGE_WARNING:
+                p['at_risk'].append((pubkey, 'uptime proof overdue'))
+            elif pubkey in expiries.height_of and expiries.height_of[pubkey] - snap.height < 720:
+                p['at_risk'].append((pubkey, 'unlocking'))
+        result.append(p)
+    return result
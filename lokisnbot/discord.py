@@ -4,18 +4,18 @@ import re
 import math
 import threading
 import asyncio
+from collections import OrderedDict
 
 import discord
 from discord.ext import commands
 
 import lokisnbot
-from . import pgsql
+from . import pgsql, uidcache, refresh, snapshot, opennodes, lookup
 from .constants import *
 from .util import friendly_time, ago, explorer, escape_markdown
-from .servicenode import ServiceNode
+from .servicenode import ServiceNode, pubkey_bin
 from .network import Network, NetworkContext
 
-uid_cache = {}
 last_pubkeys = {}
 
 message_futures = []
@@ -23,6 +23,7 @@ message_futures = []
 class DiscordContext(NetworkContext):
     def __init__(self, context: commands.Context):
         self.context = context
+        self._snap = snapshot.get()
 
 
     @staticmethod
@@ -50,19 +51,7 @@ class DiscordContext(NetworkContext):
 
     def get_uid(self):
         """Returns the user id in the pg database; creates one if not already found"""
-        global uid_cache
-        uid = self.context.author.id
-        if uid not in uid_cache:
-            cur = pgsql.cursor()
-            cur.execute("SELECT id FROM users WHERE discord_id = %s", (uid,))
-            row = cur.fetchone()
-            if row is None:
-                cur.execute("INSERT INTO users (discord_id) VALUES (%s) RETURNING id", (uid,))
-                row = cur.fetchone()
-            if row is None:
-                return None
-            uid_cache[uid] = row[0]
-        return uid_cache[uid]
+        return uidcache.get('discord', self.context.author.id)
 
 
     def is_dm(self):
@@ -100,7 +89,7 @@ class DiscordContext(NetworkContext):
         sns = ServiceNode.all(uid, sortkey=lambda sn: (sn['testnet'], sn.expiry_block() or float("inf"), sn['alias'] or sn['pubkey']))
 
         last_pubkeys[uid] = []
-        height = lokisnbot.network_info['height']
+        height = self.snap.mainnet.height
         if sns:
             msg = self.b('Service node expirations:')+'\n'
             testnet = False
@@ -109,7 +98,7 @@ class DiscordContext(NetworkContext):
                 last_pubkeys[uid].append(sn['pubkey'])
                 if not testnet and sn['testnet']:
                     msg += '\n'+self.b('Testnet service node expirations:')+'\n'
-                    height = lokisnbot.testnet_network_info['height']
+                    height = self.snap.testnet.height
                     testnet = True
 
                 msg += '{} — {} {}: {}\n'.format(self.b(i+1), sn.status_icon(), sn.alias(),
@@ -122,49 +111,47 @@ class DiscordContext(NetworkContext):
         self.send_reply(msg)
 
 
-    def pubkey_from_arg(self, arg, send_errmsg=False):
-        global last_pubkeys
-        if re.search('^[0-9a-f]{64}$', arg):  # Full pubkey
-            return arg
-        if self.is_dm():
-            uid = self.get_uid()
-            last_pks = last_pubkeys[uid] if uid in last_pubkeys else []
-            # Plain number: an index from the last time we gave a pubkey list:
-            if last_pks and re.search(r'^[1-9]\d*$', arg):
-                argi = int(arg) - 1
-                if argi < len(last_pks):
-                    return last_pks[argi]
+    def pubkeys_from_args(self, args, send_errmsg=False):
+        """Resolves service node arguments (see lookup.resolve()) to hex pubkeys.  List indices and
+        aliases are only accepted in DMs; elsewhere only full or unambiguous partial pubkeys are.
+        Returns a list of the hex pubkeys (or None for unresolvable arguments)."""
+        personal = self.is_dm()
+        # Don't create users rows for people merely using commands in public channels:
+        uid = self.get_uid() if personal else None
+        pubkeys = lookup.resolve(self.snap, uid, args, listed=last_pubkeys.get(uid, ()) if personal else (), personal=personal)
+        if send_errmsg:
+            for arg, pubkey in zip(args, pubkeys):
+                if pubkey is None:
+                    self.send_reply("Error: `{}` is not a valid service node pubkey{}".format(arg,
+                        ', pubkey prefix, list index, or alias' if personal else ' or pubkey prefix'))
+        return pubkeys
 
-            # if the user has a SN with an exact alias match then use it
-            pk = ServiceNode.pubkey_from_alias(uid, arg)
-            if pk:
-                return pk
 
-            if send_errmsg:
-                self.send_reply("Error: `{}` is not a valid service node pubkey, list index, or alias".format(arg))
-        elif send_errmsg:
-            self.send_reply("Error: `{}` is not a valid service node pubkey".format(arg))
-        return None
+    def pubkey_from_arg(self, arg, send_errmsg=False):
+        return self.pubkeys_from_args([arg], send_errmsg)[0]
 
 
     def start_monitoring(self, *pubkeys : str):
-        pubkeys = [self.pubkey_from_arg(x) for x in pubkeys]
+        pubkeys = self.pubkeys_from_args(pubkeys)
         if None in pubkeys:
             return self.send_reply("Invalid usage: $start PUBKEY PUBKEY ... — starts monitoring one or more service nodes")
         self.plain_input(text=' '.join(pubkeys), add_sn=True)
+        lookup.forget_aliases(self.get_uid())
 
 
     def stop_monitoring(self, *pubkeys : str):
-        pubkeys = [self.pubkey_from_arg(x) for x in pubkeys]
+        pubkeys = self.pubkeys_from_args(pubkeys)
         if None in pubkeys:
             return self.send_reply("Invalid usage: $stop PUBKEY PUBKEY ... — stop monitoring one or more service nodes")
 
         uid = self.get_uid()
+        lookup.forget_aliases(uid)
         for pubkey in pubkeys:
             try:
                 sn = ServiceNode(pubkey=pubkey, uid=uid)
             except ValueError:
                 self.send_reply("I couldn't find service node {}, or I wasn't monitoring it.  Please check the public service node id and try again".format(pubkey))
+                continue
             sn.delete()
             self.send_reply("Okay, I'm no longer monitoring service node " + (
                 "{} ({})".format(self.i(sn['alias']), self.i(sn['pubkey'])) if sn['alias'] else self.i(sn['pubkey'])) + " for you.")
@@ -201,34 +188,31 @@ class DiscordContext(NetworkContext):
         await self.send_reply_async(msg)
         response = await self.get_response_from_user()
         sn.update(**{field: response.content})
+        lookup.forget_aliases(self.get_uid())
         self.service_node(sn=sn, reply_text=success_fmt.format(sn.alias()))
 
 
     def set_sn_field(self, field, pubkey, value, success):
         if pubkey == 'all':
-            sns = ServiceNode.all(self.get_uid())
-            if not sns:
+            uid = self.get_uid()
+            sns = ServiceNode.update_all(uid, **{field: value})
+            if not sns and not ServiceNode.monitoring(uid):
                 return self.send_reply("Unable to do that: you aren't currently monitoring any service nodes!")
-        else:
-            pubkey = self.pubkey_from_arg(pubkey, send_errmsg=True)
-            if pubkey is None:
-                return
-
-            try:
-                sns = [ServiceNode(pubkey=pubkey, uid=self.get_uid())]
-            except ValueError:
-                return self.service_node(snid=snid, reply_text="I couldn't find that service node!")
+            lookup.forget_aliases(uid)
+            return self.service_nodes('\n'.join(success.format(sn.alias()) for sn in sns) or 'No service nodes needed to be changed.')
 
-        success_msgs = []
-        for sn in sns:
-            sn.update(**{field: value})
+        pubkey = self.pubkey_from_arg(pubkey, send_errmsg=True)
+        if pubkey is None:
+            return
 
-            success_msgs.append(success.format(sn.alias()))
+        try:
+            sn = ServiceNode(pubkey=pubkey, uid=self.get_uid())
+        except ValueError:
+            return self.send_reply("I couldn't find that service node!")
 
-        if len(sns) == 1:
-            self.service_node(sn=sns[0], reply_text=success.format(sn.alias()))
-        else:
-            self.service_nodes('\n'.join(success_msgs))
+        sn.update(**{field: value})
+        lookup.forget_aliases(self.get_uid())
+        self.service_node(sn=sn, reply_text=success.format(sn.alias()))
 
 
     def wallets_menu(self, reply_text=''):
@@ -311,10 +295,16 @@ class DiscordContext(NetworkContext):
             self.send_reply("🤣 Nice try, but I don't have any mainnet OXEN.  Try again with a "+self.i('testnet')+" wallet address instead")
 
         elif self.is_wallet(wallet, mainnet=False, testnet=True):
-            tx = self.send_faucet_tx(wallet)
-            if tx:
-                self.send_reply(dead_end=True, message='💸 Sent you {:.9f} testnet OXEN: {}'.format(
-                    lokisnbot.config.TESTNET_FAUCET_AMOUNT/COIN, 'https://'+lokisnbot.config.TESTNET_EXPLORER+'/tx/'+tx['tx_hash']))
+            # The result comes back on the faucet thread, so hand it back over to the event loop:
+            loop = asyncio.get_event_loop()
+            result = loop.create_future()
+            if self.send_faucet_tx(wallet, lambda *res: loop.call_soon_threadsafe(result.set_result, res)):
+                tx_hash, error = await result
+                if error:
+                    self.faucet_error(error)
+                else:
+                    self.send_reply(dead_end=True, message='💸 Sent you {:.9f} testnet OXEN: {}'.format(
+                        lokisnbot.config.TESTNET_FAUCET_AMOUNT/COIN, 'https://'+lokisnbot.config.TESTNET_EXPLORER+'/tx/'+tx_hash))
 
         else:
             self.send_reply(
@@ -326,6 +316,73 @@ class DiscordContext(NetworkContext):
         self.send_reply(msg, file=discord.File(open(lokisnbot.config.DONATION_IMAGE, 'rb')) if lokisnbot.config.DONATION_IMAGE else None)
 
 
+def user_gone(error):
+    """True if a DM failed because the user doesn't exist anymore (Unknown User).  (Users that
+    merely don't accept DMs from us right now -- 50007 -- aren't gone: that can be temporary.)"""
+    return isinstance(error, discord.NotFound) and error.code == 10013
+
+
+class Delivery:
+    """Delivers DMs from the Discord event loop.  Users are looked up in the client's cache and,
+    failing that, fetched from Discord, and their DM channels are kept in a bounded LRU cache.
+    Sends run concurrently, at most DISCORD_SEND_CONCURRENCY at a time (discord.py itself waits
+    out any per-route or global rate limits it runs into), with transient failures retried."""
+
+    def __init__(self, bot, loop):
+        self.bot = bot
+        self.loop = loop
+        self.channels = OrderedDict()  # user id: DMChannel, least to most recently used
+        self.semaphore = None  # Created on the loop by the first send
+
+    async def channel(self, userid):
+        """Returns the DM channel of the given user id"""
+        channel = self.channels.get(userid)
+        if channel:
+            self.channels.move_to_end(userid)
+            return channel
+        user = self.bot.get_user(userid) or await self.bot.fetch_user(userid)
+        channel = user.dm_channel or await user.create_dm()
+        self.channels[userid] = channel
+        while len(self.channels) > DISCORD_DM_CHANNEL_CACHE_SIZE:
+            self.channels.popitem(last=False)
+        return channel
+
+    async def send(self, userid, message, done=None):
+        """Sends a DM.  Calls `done`, if given, with None on success or with the exception on
+        failure.  Returns True on success, False on failure."""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(DISCORD_SEND_CONCURRENCY)
+        error = None
+        for attempt in range(DISCORD_SEND_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(2 ** attempt)
+            try:
+                async with self.semaphore:
+                    await (await self.channel(userid)).send(message)
+                error = None
+                break
+            except (discord.NotFound, discord.Forbidden) as e:
+                self.channels.pop(userid, None)
+                error = e
+                if isinstance(e, discord.Forbidden) or user_gone(e):
+                    # Unknown user, or one that we may not DM: retrying won't help
+                    break
+                # Anything else not found (e.g. a stale cached DM channel) gets retried with a
+                # freshly looked up channel
+            except Exception as e:
+                error = e
+        if done:
+            try:
+                done(error)
+            except Exception as e:
+                print("Discord delivery callback failed: {}".format(e))
+        return error is None
+
+    def submit(self, userid, message, done=None):
+        """Queues a DM for delivery; may be called from any thread"""
+        asyncio.run_coroutine_threadsafe(self.send(userid, message, done), self.loop)
+
+
 class DiscordNetwork(Network):
     def __init__(self, **kwargs):
         helpcmd = commands.DefaultHelpCommand(dm_help=True, verify_checks=False)
@@ -335,6 +392,12 @@ class DiscordNetwork(Network):
                 help_command=helpcmd
         )
         self.loop = asyncio.get_event_loop()
+        self.delivery = Delivery(self.bot, self.loop)
+
+        # Each command runs in its own task, so pin the network snapshot for the whole command:
+        @self.bot.before_invoke
+        async def pin_snapshot(ctx):
+            snapshot.hold()
 
         dm_only = commands.check(lambda ctx: isinstance(ctx.channel, discord.DMChannel))
 
@@ -356,6 +419,33 @@ class DiscordNetwork(Network):
                     """Shows current testnet status"""
                     DiscordContext(ctx).status(testnet=True)
 
+            @commands.command(name='open')
+            async def open_nodes(self, ctx, *args : str):
+                """Lists service nodes awaiting contributions.  Optional arguments: a sort order (`room` (the default), `fee` or `newest`), a page number, `maxfee=N` to only show nodes with an operator fee of at most N%, `need=N` to only show nodes needing at least N OXEN, and `testnet`."""
+                c = DiscordContext(ctx)
+                sort, page, max_fee, min_room, testnet = 'room', 1, None, None, False
+                try:
+                    for a in args:
+                        if a in opennodes.SORTS:
+                            sort = a
+                        elif a.isdigit():
+                            page = int(a)
+                        elif a.startswith('maxfee='):
+                            max_fee = float(a[7:].rstrip('%')) / 100
+                        elif a.startswith('need='):
+                            min_room = int(float(a[5:]) * COIN)
+                        elif a == 'testnet' and lokisnbot.config.TESTNET_NODE_URL:
+                            testnet = True
+                        else:
+                            raise ValueError("Invalid argument {}".format(a))
+                except (ValueError, OverflowError):
+                    c.send_reply("Invalid command; use e.g. `$open`, `$open fee 2`, or `$open newest maxfee=5 need=1000`")
+                    return
+                msg, page, pages = c.open_nodes_msg(page - 1, sort, max_fee, min_room, testnet)
+                if page < pages - 1:
+                    msg += '; use `$open {}` for the next page'.format(' '.join([a for a in args if not a.isdigit()] + [str(page + 2)]))
+                c.send_reply(msg)
+
             if lokisnbot.config.TESTNET_WALLET_URL and lokisnbot.config.TESTNET_FAUCET_AMOUNT:
                 @commands.command()
                 @dm_only
@@ -376,6 +466,21 @@ class DiscordNetwork(Network):
                 """Show service nodes sorted by expiry"""
                 DiscordContext(ctx).service_nodes_expiries()
 
+            @commands.command()
+            @dm_only
+            async def unlocks(self, ctx):
+                """Show service nodes with a scheduled unlock, soonest first"""
+                c = DiscordContext(ctx)
+                c.send_reply(c.upcoming_unlocks_msg())
+
+            if lokisnbot.config.API_PORT:
+                @commands.command()
+                @dm_only
+                async def apitoken(self, ctx, new : str=''):
+                    """Shows your token for the JSON API; use `$apitoken new` to replace it with a new one"""
+                    c = DiscordContext(ctx)
+                    c.send_reply(c.api_token_msg(reset=new == 'new'))
+
             @commands.command()
             @dm_only
             async def start(self, ctx, *pubkeys : str):
@@ -458,11 +563,13 @@ class DiscordNetwork(Network):
 
             @commands.command()
             async def sn(self, ctx, pubkey : str):
-                """Shows details of a service node; specify the index of the last service node list, or a full SN pubkey (if used in a channel, only a pubkey is allowed)"""
+                """Shows details of a service node; specify the index of the last service node list, an alias, or a full or unambiguous partial SN pubkey (if used in a channel, only a full or partial pubkey is allowed)"""
                 c = DiscordContext(ctx)
                 pubkey = c.pubkey_from_arg(pubkey, send_errmsg=True)
                 if pubkey:
-                    DiscordContext(ctx).service_node(pubkey=pubkey)
+                    # Refresh off the event loop; service_node() then picks up the refreshed state:
+                    await ctx.bot.loop.run_in_executor(None, refresh.refresh, pubkey_bin(pubkey))
+                    c.service_node(pubkey=pubkey)
 
             @commands.command(name='$')
             @dm_only
@@ -495,6 +602,20 @@ class DiscordNetwork(Network):
                 """Forgets a wallet associated with your account; pass the wallet (or wallet prefix) to forget"""
                 DiscordContext(ctx).forget_wallet(wallet)
 
+            @commands.command()
+            @dm_only
+            async def portfolio(self, ctx):
+                """Summarizes the stakes, expected rewards and at-risk nodes of your wallet(s)"""
+                c = DiscordContext(ctx)
+                c.send_reply(c.portfolio_msg())
+
+            @commands.command()
+            @dm_only
+            async def earnings(self, ctx):
+                """Shows the rewards your wallet(s) have earned, by day, week, month and in total"""
+                c = DiscordContext(ctx)
+                c.send_reply(c.earnings_msg())
+
             @commands.command(aliases=['unmon'])
             @dm_only
             async def unmonitored(self, ctx):
@@ -565,23 +686,29 @@ class DiscordNetwork(Network):
     def stop(self):
         asyncio.ensure_future(self.bot.logout())
 
-    async def message_user(self, userid, message):
-        user = self.bot.get_user(userid)
-        if user:
-            await user.send(message)
-        return True
-
-    def try_message(self, chatid, message, append=None):
-        """Send a message to the bot.  If the message gives a 'bot was blocked by the user' error then
-        we delete the user's service_nodes (to stop generating more messages)."""
+    def try_message(self, chatid, message, append=None, done=None):
+        """Queues a DM to the given Discord user id and returns True without waiting for it to be
+        sent.  The outcome is reported asynchronously: `done`, if given, gets called (on the Discord
+        loop, or on an executor thread once a gone user's subscriptions are removed) with None once
+        the message is delivered, or with the exception if delivery failed."""
         if append:
             message += '\n' + append
-        future = asyncio.run_coroutine_threadsafe(self.message_user(chatid, message), self.loop)
-        try:
-            future.result()
-        except Exception as e:
-            print("Sending to user {} failed: {}".format(chatid, e))
-            return False
+        def purge(error):
+            pgsql.cursor().execute("DELETE FROM service_nodes WHERE uid = (SELECT id FROM users WHERE discord_id = %s)", (chatid,))
+            uidcache.invalidate('discord', chatid)
+            if done:
+                done(error)
+        def report(error):
+            if user_gone(error):
+                # Deleted account (the database work happens off the event loop):
+                print("Discord user {} is gone; removing them from SN monitoring ({})".format(chatid, error), flush=True)
+                self.loop.run_in_executor(None, purge, error)
+                return
+            if error:
+                print("Error sending Discord message to {}: {}".format(chatid, error), flush=True)
+            if done:
+                done(error)
+        self.delivery.submit(chatid, message, report)
         return True
 
     def sn_update_extra(self, sn):
@@ -0,0 +1,86 @@
+# Expiry/unlock calendar: a per-snapshot index of the network's service nodes ordered by the block
+# height at which their registration expires (for infinite stakes: the height of the requested
+# unlock; nodes without one aren't in the index).  Range queries ("what expires in the next 24h",
+# bucket counts, which nodes crossed an expiry notification threshold since the last poll) are then
+# a couple of bisections plus the matching entries rather than a pass over every node.
+
+from bisect import bisect_left, bisect_right
+
+from .constants import *
+
+
+class ExpiryIndex:
+    """Nodes of a snapshot sorted by expiry height: `heights[i]` is the expiry height of the node
+    with binary pubkey `pubkeys[i]`; `height_of` maps pubkeys to expiry heights."""
+
+    def __init__(self, snap):
+        infinite_from = TESTNET_INFINITE_FROM if snap.testnet else INFINITE_FROM
+        stake_blocks = TESTNET_STAKE_BLOCKS if snap.testnet else STAKE_BLOCKS
+        entries = []
+        for pubkey, x in snap.states.items():
+            if x['registration_height'] >= infinite_from:
+                if x['requested_unlock_height']:
+                    entries.append((x['requested_unlock_height'], pubkey))
+            else:
+                entries.append((x['registration_height'] + stake_blocks, pubkey))
+        entries.sort()
+        self.heights = [e[0] for e in entries]
+        self.pubkeys = [e[1] for e in entries]
+        self.height_of = { pk: h for h, pk in entries }
+
+    def between(self, after, until):
+        """Returns a list of (height, pubkey) of the nodes expiring after height `after` up to and
+        including height `until`, in expiry order"""
+        i, j = bisect_right(self.heights, after), bisect_right(self.heights, until)
+        return list(zip(self.heights[i:j], self.pubkeys[i:j]))
+
+
+def index(snap):
+    """Returns the ExpiryIndex of the given snapshot"""
+    return snap.index('expiry', ExpiryIndex)
+
+
+def expires_within_height(snap, seconds):
+    """Returns the highest expiry height for which ServiceNode.expires_in() is at most `seconds`"""
+    return snap.height - 1 + int(seconds // AVERAGE_BLOCK_SECONDS)
+
+
+def expiring_within(snap, seconds):
+    """Returns a list of (height, pubkey) of nodes that expire within the given number of seconds"""
+    return index(snap).between(-1, expires_within_height(snap, seconds))
+
+
+def buckets(heights, height, days=(1, 3, 7)):
+    """Takes a sorted list of expiry heights and returns a list of how many of them are less than
+    days[0] days after `height`, between days[0] and days[1] days, ..., and days[-1] days or more."""
+    before = [bisect_left(heights, height + d*720) for d in days]
+    return [b - a for a, b in zip([0] + before, before + [len(heights)])]
+
+
+def unlock_buckets(snap, days=(1, 3, 7)):
+    """Returns the network-wide buckets() of the snapshot's expiring/unlocking nodes"""
+    return buckets(index(snap).heights, snap.height, days)
+
+
+def crossed_thresholds(old, new, thresholds):
+    """Returns the set of pubkeys of nodes in snapshot `new` that have crossed one of the given
+    expiry notification thresholds (in hours) since snapshot `old`, i.e. whose expires_in() is now
+    at or under the threshold but wasn't at the old height."""
+    if old.height is None or new.height is None or new.height <= old.height:
+        return set()
+    idx = index(new)
+    crossed = set()
+    for t in thresholds:
+        crossed.update(pk for h, pk in idx.between(expires_within_height(old, t*3600), expires_within_height(new, t*3600)))
+    return crossed
+
+
+def upcoming(snap, pubkeys):
+    """Returns a list of (height, pubkey) of the nodes with the given binary pubkeys that have an
+    expiry or unlock scheduled, in expiry order"""
+    pubkeys = set(pubkeys)
+    idx = index(snap)
+    if len(pubkeys) * 16 < len(idx.pubkeys):
+        # Relatively few nodes: sorting just those is cheaper than walking the whole index
+        return sorted((idx.height_of[pk], pk) for pk in pubkeys if pk in idx.height_of)
+    return [(h, pk) for h, pk in zip(idx.heights, idx.pubkeys) if pk in pubkeys]
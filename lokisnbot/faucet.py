@@ -0,0 +1,103 @@
+# Testnet faucet dispatcher.  Faucet requests get rate limited and queued, and a dispatcher thread
+# sends everything queued during a FAUCET_BATCH_WINDOW as a single multi-destination `transfer`, so
+# that users aren't blocked behind each other's wallet RPC requests.  The per-user and global rate
+# limits live in the database (see faucet_reserve() in database.pgsql) so that they are enforced
+# atomically and shared by every bot process using the same database.
+
+import threading
+import queue
+import time
+import requests
+
+import lokisnbot
+from . import pgsql
+from .constants import FAUCET_BATCH_WINDOW, FAUCET_MAX_DESTINATIONS
+
+pending = queue.Queue()  # (uid, wallet, done) tuples waiting to be sent
+dispatcher = None
+dispatcher_lock = threading.Lock()
+
+
+def waits(uid):
+    """Returns a (user_wait, global_wait) tuple of how many seconds the given user would currently
+    have to wait before being allowed to use the faucet (both 0 if the user can use it now).  This
+    doesn't reserve anything; see request()."""
+    cur = pgsql.cursor()
+    cur.execute("SELECT * FROM faucet_waits(%s, %s, %s, %s, %s)", (uid, int(time.time()),
+        lokisnbot.config.TESTNET_FAUCET_WAIT_USER, lokisnbot.config.TESTNET_FAUCET_WAIT_GLOBAL, FAUCET_MAX_DESTINATIONS))
+    return cur.fetchone()
+
+
+def request(uid, wallet, done):
+    """Requests a faucet payment to `wallet` for the given user.  If the user is allowed to use the
+    faucet the request is queued (and counted against the rate limits) and (0, 0) is returned;
+    otherwise nothing is queued and (user_wait, global_wait) is returned, as for waits().
+
+    Once queued, `done(tx_hash, error)` gets called from the dispatcher thread with the hash of the
+    (shared) transaction, or with an error message if the transfer failed (in which case the user's
+    rate limit is released again)."""
+    cur = pgsql.cursor()
+    cur.execute("SELECT * FROM faucet_reserve(%s, %s, %s, %s, %s)", (uid, int(time.time()),
+        lokisnbot.config.TESTNET_FAUCET_WAIT_USER, lokisnbot.config.TESTNET_FAUCET_WAIT_GLOBAL, FAUCET_MAX_DESTINATIONS))
+    user_wait, global_wait = cur.fetchone()
+    if user_wait or global_wait:
+        return user_wait, global_wait
+
+    _start_dispatcher()
+    pending.put((uid, wallet, done))
+    return 0, 0
+
+
+def _start_dispatcher():
+    global dispatcher
+    with dispatcher_lock:
+        if dispatcher is None:
+            dispatcher = threading.Thread(target=_dispatch, daemon=True)
+            dispatcher.start()
+
+
+def _dispatch():
+    while True:
+        batch = [pending.get()]
+        # Give anyone else FAUCET_BATCH_WINDOW seconds to join this transaction:
+        deadline = time.time() + FAUCET_BATCH_WINDOW
+        while len(batch) < FAUCET_MAX_DESTINATIONS:
+            try:
+                batch.append(pending.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        send(batch)
+
+
+def send(batch):
+    """Sends a batch of (uid, wallet, done) requests as a single transfer and reports the result to
+    each request's `done` callback"""
+    tx_hash, error = None, None
+    try:
+        transfer = requests.post(lokisnbot.config.TESTNET_WALLET_URL + "/json_rpc", timeout=30, json={
+            "jsonrpc": "2.0",
+            "id": "0",
+            "method": "transfer",
+            "params": {
+                "destinations": [{"amount": lokisnbot.config.TESTNET_FAUCET_AMOUNT, "address": wallet} for uid, wallet, done in batch],
+                "priority": 5,
+                }
+            }).json()
+        if 'error' in transfer and transfer['error']:
+            print("Faucet transfer error: {}".format(transfer['error']))
+            error = transfer['error']['message']
+        else:
+            tx_hash = transfer['result']['tx_hash']
+            print("Faucet success: {} ({} destinations)".format(tx_hash, len(batch)))
+    except Exception as e:
+        print("testnet wallet error: {}".format(e))
+        error = 'An error occured while communicating with the testnet wallet; please try again later'
+
+    if error:
+        pgsql.cursor().execute("UPDATE users SET faucet_last_used = NULL WHERE id = ANY(%s)", ([uid for uid, wallet, done in batch],))
+
+    for uid, wallet, done in batch:
+        try:
+            done(tx_hash, error)
+        except Exception as e:
+            print("Faucet reply failed: {}".format(e))
@@ -0,0 +1,174 @@
+# Uptime proof history.  For every node on the network the updater keeps the timestamps of its
+# last PROOF_HISTORY_SIZE uptime proofs and its last TRANSITION_HISTORY_SIZE decommission/recommission
+# transitions in fixed-size, array-backed ring buffers, so memory per node is bounded no matter how
+# long the bot runs.  The history is used to detect nodes that keep flapping across the proof age
+# warning threshold (see alerts.check()) and for the proof interval statistics in the SN details,
+# and is periodically written to the proof_history table (in a compact binary form) so that it
+# survives restarts.
+
+import struct
+import time
+from array import array
+import psycopg2.extras
+
+from . import pgsql
+from .constants import *
+
+
+class Ring:
+    """Fixed-size ring buffer of integers backed by an array; iterates from oldest to newest"""
+
+    __slots__ = ('values', 'next', 'count')
+
+    def __init__(self, typecode, size):
+        self.values = array(typecode, [0]) * size
+        self.next = 0
+        self.count = 0
+
+    def append(self, value):
+        self.values[self.next] = value
+        self.next = (self.next + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+
+    def last(self):
+        return self.values[self.next - 1] if self.count else None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        size = len(self.values)
+        start = (self.next - self.count) % size
+        for i in range(self.count):
+            yield self.values[(start + i) % size]
+
+
+class NodeHistory:
+    """Proof timestamps and decommission transitions of one node.  Transitions are stored as
+    timestamps, negated for decommissions."""
+
+    __slots__ = ('proofs', 'transitions', 'active', 'dirty')
+
+    def __init__(self):
+        self.proofs = Ring('I', PROOF_HISTORY_SIZE)
+        self.transitions = Ring('q', TRANSITION_HISTORY_SIZE)
+        self.active = None
+        self.dirty = False
+
+    def to_bytes(self):
+        p, t = list(self.proofs), list(self.transitions)
+        return struct.pack('<BBB{}L{}q'.format(len(p), len(t)), 1 if self.active else 0, len(p), len(t), *p, *t)
+
+    @staticmethod
+    def from_bytes(data):
+        h = NodeHistory()
+        active, np, nt = struct.unpack_from('<BBB', data)
+        values = struct.unpack_from('<{}L{}q'.format(np, nt), data, 3)
+        for v in values[0:np]:
+            h.proofs.append(v)
+        for v in values[np:]:
+            h.transitions.append(v)
+        h.active = bool(active)
+        return h
+
+
+histories = {}  # binary pubkey: NodeHistory
+gone = set()  # pubkeys of forgotten nodes whose persisted history still needs deleting
+last_persist = 0
+
+
+def observe(states, now):
+    """Records any new uptime proofs and decommission transitions in the given {pubkey: state} dict"""
+    for pubkey, x in states.items():
+        h = histories.get(pubkey)
+        if h is None:
+            h = histories[pubkey] = NodeHistory()
+        proof = x.get('last_uptime_proof')
+        if proof and proof != h.proofs.last():
+            h.proofs.append(proof)
+            h.dirty = True
+        active = x.get('active', True)
+        if h.active is not None and active != h.active:
+            h.transitions.append(int(now) if active else -int(now))
+            h.dirty = True
+        h.active = active
+
+
+def forget(pubkeys):
+    """Drops the in-memory history of nodes that have left the network"""
+    for pubkey in pubkeys:
+        if histories.pop(pubkey, None):
+            gone.add(pubkey)
+
+
+def forget_missing(*networks):
+    """Drops the history of nodes in none of the given {pubkey: state} dicts; used on the first
+    poll to get rid of the loaded history of nodes that left the network while we weren't running"""
+    forget([pubkey for pubkey in histories if not any(pubkey in states for states in networks)])
+
+
+def stats(pubkey, now=None, since=None):
+    """Returns a dict of proof statistics of the given node over its history (or just since the
+    `since` timestamp): 'proofs' (number of proofs), 'mean' and 'max' (seconds between proofs),
+    'late' (number of intervals longer than PROOF_AGE_WARNING), 'decomms' (number of
+    decommissions), and 'span' (seconds since the first proof, or None if there are no proofs).
+    Returns None if there is not enough history."""
+    h = histories.get(pubkey)
+    if not h:
+        return None
+    if now is None:
+        now = time.time()
+    proofs = [p for p in h.proofs if since is None or p >= since]
+    intervals = [b - a for a, b in zip(proofs, proofs[1:])]
+    decomms = sum(1 for t in h.transitions if t < 0 and (since is None or -t >= since))
+    if not intervals and not decomms:
+        return None
+    return {
+        'proofs': len(proofs),
+        'mean': sum(intervals) / len(intervals) if intervals else None,
+        'max': max(intervals) if intervals else None,
+        'late': sum(1 for i in intervals if i > PROOF_AGE_WARNING),
+        'decomms': decomms,
+        'span': now - proofs[0] if proofs else None,
+        }
+
+
+def flapping(pubkey, now):
+    """Called when a node's proof is late: returns the stats() for the last FLAP_WINDOW if the node
+    has had FLAP_EPISODES or more late proofs or decommissions (counting the current one) in that
+    window, otherwise None."""
+    s = stats(pubkey, now, since=now - FLAP_WINDOW)
+    if s and s['late'] + s['decomms'] + 1 >= FLAP_EPISODES:
+        return s
+    return None
+
+
+def load():
+    """Loads the persisted history of all nodes"""
+    cur = pgsql.cursor()
+    cur.execute("SELECT pubkey, history FROM proof_history")
+    for pubkey, data in cur:
+        histories[bytes(pubkey)] = NodeHistory.from_bytes(bytes(data))
+
+
+def persist(now, force=False):
+    """Writes the history of every node whose history changed since the last write (and deletes
+    that of forgotten nodes), at most once every HISTORY_PERSIST_INTERVAL seconds (unless
+    `force`d)"""
+    global last_persist
+    if not force and now - last_persist < HISTORY_PERSIST_INTERVAL:
+        return
+    last_persist = now
+    if gone:
+        pubkeys = list(gone)
+        gone.difference_update(pubkeys)
+        pgsql.cursor().execute("DELETE FROM proof_history WHERE pubkey = ANY(%s)", (pubkeys,))
+    dirty = [(pubkey, h) for pubkey, h in list(histories.items()) if h.dirty]
+    if not dirty:
+        return
+    psycopg2.extras.execute_values(pgsql.cursor(),
+            "INSERT INTO proof_history (pubkey, history, updated) VALUES %s "
+            "ON CONFLICT (pubkey) DO UPDATE SET history = EXCLUDED.history, updated = EXCLUDED.updated",
+            [(pubkey, h.to_bytes(), int(now)) for pubkey, h in dirty], page_size=len(dirty))
+    for pubkey, h in dirty:
+        h.dirty = False
@@ -0,0 +1,81 @@
+# Reward ledger.  Every reward found by the updater's block scan (see rewards.py) gets split into the
+# shares of the winning node's contributors (see servicenode.split_reward()), and the shares are
+# recorded in the reward_ledger table along with running daily and monthly per-address totals in
+# reward_rollups.  The rollups are updated by the same statement that inserts the ledger rows (from
+# just the rows actually inserted, so recording the same blocks twice changes nothing), and
+# earnings queries only ever read the rollups: looking up a year of earnings reads at most a few
+# hundred rows however many rewards were earned.
+
+import time
+import datetime
+import psycopg2.extras
+
+from . import pgsql
+from .constants import *
+from .servicenode import reward, split_reward
+
+
+def record(testnet, winners, times, states):
+    """Records the shares of the rewards of the given winners (binary pubkey: [height, ...]) using
+    the current `states` of the nodes (rewards of nodes no longer on the network are skipped).
+    `times` maps heights to block timestamps.  Everything goes into the ledger, and the rollups,
+    with a single statement."""
+    rows = []
+    for pubkey, heights in winners.items():
+        state = states.get(pubkey)
+        if not state:
+            continue
+        for h in heights:
+            for address, amount in split_reward(state, int(reward(h) * COIN)).items():
+                rows.append((testnet, h, times[h], pubkey, address, amount))
+    if not rows:
+        return
+
+    psycopg2.extras.execute_values(pgsql.cursor(), """
+        WITH ins AS (
+            INSERT INTO reward_ledger (testnet, height, block_time, pubkey, address, amount) VALUES %s
+            ON CONFLICT DO NOTHING
+            RETURNING testnet, (to_timestamp(block_time) AT TIME ZONE 'UTC')::date AS day, address, amount
+        )
+        INSERT INTO reward_rollups (testnet, monthly, period_start, address, amount, rewards)
+        SELECT testnet, FALSE, day, address, SUM(amount), COUNT(*) FROM ins GROUP BY testnet, day, address
+        UNION ALL
+        SELECT testnet, TRUE, date_trunc('month', day)::date, address, SUM(amount), COUNT(*) FROM ins
+            GROUP BY testnet, date_trunc('month', day)::date, address
+        ON CONFLICT (address, testnet, monthly, period_start) DO UPDATE
+            SET amount = reward_rollups.amount + EXCLUDED.amount, rewards = reward_rollups.rewards + EXCLUDED.rewards
+        """, rows, template="(%s, %s, %s, %s, %s, %s)", page_size=len(rows))
+
+
+def earnings(prefixes, testnet=False, months=12, today=None):
+    """Returns the earnings of the addresses matching any of the given wallet prefixes, as a dict
+    with keys 'today', 'week' (the last 7 days), 'month' (the last 30 days), and 'total', each a
+    (atomic OXEN, rewards) tuple, plus 'monthly', a list of (date, atomic OXEN, rewards) for up to
+    the last `months` calendar months, newest first."""
+    if today is None:
+        today = datetime.datetime.utcfromtimestamp(time.time()).date()
+    result = { 'today': (0, 0), 'week': (0, 0), 'month': (0, 0), 'total': (0, 0), 'monthly': [] }
+    if not prefixes:
+        return result
+
+    # One LIKE per prefix (rather than a join against wallet_prefixes) so that each can use the
+    # (C-collated, and so prefix-searchable) primary key index:
+    match = '(' + ' OR '.join('address LIKE %s' for p in prefixes) + ')'
+    patterns = [p + '%' for p in prefixes]
+    cur = pgsql.cursor()
+    cur.execute("SELECT period_start, SUM(amount)::bigint, SUM(rewards)::integer FROM reward_rollups WHERE " + match +
+            " AND testnet = %s AND NOT monthly AND period_start > %s GROUP BY period_start",
+            patterns + [testnet, today - datetime.timedelta(days=30)])
+    for day, amount, rewards in cur:
+        age = (today - day).days
+        for key, days in (('today', 1), ('week', 7), ('month', 30)):
+            if age < days:
+                result[key] = (result[key][0] + amount, result[key][1] + rewards)
+
+    cur.execute("SELECT period_start, SUM(amount)::bigint, SUM(rewards)::integer FROM reward_rollups WHERE " + match +
+            " AND testnet = %s AND monthly GROUP BY period_start ORDER BY period_start DESC", patterns + [testnet])
+    for month, amount, rewards in cur:
+        if len(result['monthly']) < months:
+            result['monthly'].append((month, amount, rewards))
+        result['total'] = (result['total'][0] + amount, result['total'][1] + rewards)
+    return result
@@ -0,0 +1,162 @@
+# Prefix lookups of service nodes by pubkey or alias, for answering Telegram inline queries as the
+# user types and for resolving the pubkey arguments of Discord commands.  Pubkeys are matched
+# network-wide through a per-snapshot sorted list of hex pubkeys (a bisection per query); aliases
+# through a small per-user index of the user's own subscriptions, kept in an LRU cache for
+# ALIAS_INDEX_TTL seconds (or until the user changes a subscription) so that keystrokes and command
+# arguments don't each cost a query.
+
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from . import pgsql
+from .constants import *
+
+hex_re = re.compile(r'[0-9a-f]+', re.ASCII)
+pubkey_re = re.compile(r'[0-9a-f]{64}', re.ASCII)
+list_index_re = re.compile(r'[1-9]\d*', re.ASCII)
+
+
+class PubkeyIndex:
+    """The hex pubkeys of a snapshot's nodes, sorted"""
+
+    def __init__(self, snap):
+        self.pubkeys = sorted(pk.hex() for pk in snap.states)
+
+    def matching(self, prefix, limit):
+        """Returns up to `limit` hex pubkeys starting with `prefix`, in order"""
+        i = bisect_left(self.pubkeys, prefix)
+        result = []
+        while i < len(self.pubkeys) and len(result) < limit and self.pubkeys[i].startswith(prefix):
+            result.append(self.pubkeys[i])
+            i += 1
+        return result
+
+
+def pubkey_index(snap):
+    """Returns the PubkeyIndex of the given snapshot"""
+    return snap.index('pubkeys', PubkeyIndex)
+
+
+class AliasIndex:
+    """A user's subscriptions sorted by case-folded alias: `keys[i]` is the folded alias of
+    `entries[i]`, a (hex pubkey, testnet, alias) tuple.  `alias_of` maps the hex pubkeys of all of
+    the user's subscriptions (aliased or not) to their alias (or None); `by_alias` maps exact
+    aliases to hex pubkeys; `pubkeys` is the sorted list of the subscriptions' hex pubkeys."""
+
+    def __init__(self, rows):
+        rows = [(bytes(pubkey).hex(), testnet, alias) for pubkey, testnet, alias in rows]
+        entries = sorted((alias.casefold(), (pubkey, testnet, alias)) for pubkey, testnet, alias in rows if alias)
+        self.keys = [e[0] for e in entries]
+        self.entries = [e[1] for e in entries]
+        self.alias_of = { pubkey: alias for pubkey, testnet, alias in rows }
+        self.by_alias = { alias: pubkey for pubkey, testnet, alias in rows if alias }
+        self.pubkeys = sorted(self.alias_of)
+        self.built = time.time()
+
+    def resolve(self, arg):
+        """Returns the hex pubkey of the user's node with alias `arg`, or failing that the one whose
+        alias case-insensitively equals (or, failing that, starts with) `arg` if there is exactly
+        one such node; otherwise None"""
+        if arg in self.by_alias:
+            return self.by_alias[arg]
+        matches = self.matching(arg, len(self.keys))
+        exact = set(pubkey for pubkey, testnet, alias in matches if alias.casefold() == arg.casefold())
+        for found in (exact, set(pubkey for pubkey, testnet, alias in matches)):
+            if len(found) == 1:
+                return next(iter(found))
+        return None
+
+    def matching(self, prefix, limit):
+        """Returns up to `limit` (hex pubkey, testnet, alias) entries with an alias starting with
+        `prefix` (case-insensitively), in alias order"""
+        prefix = prefix.casefold()
+        i = bisect_left(self.keys, prefix)
+        result = []
+        while i < len(self.keys) and len(result) < limit and self.keys[i].startswith(prefix):
+            result.append(self.entries[i])
+            i += 1
+        return result
+
+
+# uid: AliasIndex, in least-to-most recently used order
+alias_indexes = OrderedDict()
+lock = threading.Lock()
+
+
+def alias_index(uid):
+    """Returns the AliasIndex of the given user, loading it if not cached (or expired)"""
+    with lock:
+        idx = alias_indexes.get(uid)
+        if idx and idx.built + ALIAS_INDEX_TTL > time.time():
+            alias_indexes.move_to_end(uid)
+            return idx
+
+    cur = pgsql.cursor()
+    cur.execute("SELECT pubkey, testnet, alias FROM service_nodes WHERE uid = %s AND NOT archived", (uid,))
+    idx = AliasIndex(cur.fetchall())
+    with lock:
+        alias_indexes[uid] = idx
+        alias_indexes.move_to_end(uid)
+        while len(alias_indexes) > ALIAS_INDEX_SIZE:
+            alias_indexes.popitem(last=False)
+    return idx
+
+
+def forget_aliases(uid):
+    """Drops the cached AliasIndex of the given user; called when the user's subscriptions change"""
+    with lock:
+        alias_indexes.pop(uid, None)
+
+
+def resolve(snap, uid, args, listed=(), personal=True):
+    """Resolves command arguments to hex pubkeys in one pass.  Each argument can be a full pubkey;
+    if `personal`, an index (starting at 1) into `listed`, the hex pubkeys of the last list shown
+    to the user, or one of the user's aliases (see AliasIndex.resolve()); or a pubkey prefix of at
+    least INLINE_MIN_PUBKEY_PREFIX hex digits matching just one of the user's nodes or, failing
+    that, just one node on the network.  Returns a list with the hex pubkey (or None if it couldn't
+    be resolved) of each argument."""
+    aliases = alias_index(uid) if personal and any(not pubkey_re.fullmatch(a) for a in args) else None
+    result = []
+    for arg in args:
+        pubkey = None
+        if pubkey_re.fullmatch(arg):
+            pubkey = arg
+        elif personal and listed and list_index_re.fullmatch(arg) and int(arg) <= len(listed):
+            pubkey = listed[int(arg) - 1]
+        elif aliases:
+            pubkey = aliases.resolve(arg)
+        if pubkey is None and len(arg) >= INLINE_MIN_PUBKEY_PREFIX and hex_re.fullmatch(arg):
+            if aliases:
+                i = bisect_left(aliases.pubkeys, arg)
+                mine = [pk for pk in aliases.pubkeys[i:i+2] if pk.startswith(arg)]
+                if len(mine) == 1:
+                    pubkey = mine[0]
+            if pubkey is None:
+                found = [pk for net in snap for pk in pubkey_index(net).matching(arg, 2)]
+                if len(found) == 1:
+                    pubkey = found[0]
+        result.append(pubkey)
+    return result
+
+
+def search(snap, uid, query, limit=INLINE_RESULTS):
+    """Returns up to `limit` (hex pubkey, alias or None) of the nodes matching `query`: the user's
+    nodes with an alias starting with it first, then nodes on the network (mainnet, then testnet)
+    with a pubkey starting with it (if it's at least INLINE_MIN_PUBKEY_PREFIX hex digits).  An
+    empty query gives the user's own aliased nodes.  `uid` may be None for a user we don't know, in
+    which case only pubkeys are matched."""
+    aliases = alias_index(uid) if uid is not None else None
+    query = query.strip()
+    results = [(pubkey, alias) for pubkey, testnet, alias in aliases.matching(query, limit)] if aliases else []
+    prefix = query.lower()
+    if len(results) < limit and len(prefix) >= INLINE_MIN_PUBKEY_PREFIX and hex_re.fullmatch(prefix):
+        seen = set(pubkey for pubkey, alias in results)
+        for net in snap:
+            for pubkey in pubkey_index(net).matching(prefix, limit):
+                if pubkey not in seen and len(results) < limit:
+                    seen.add(pubkey)
+                    results.append((pubkey, aliases.alias_of.get(pubkey) if aliases else None))
+    return results
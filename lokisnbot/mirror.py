@@ -0,0 +1,235 @@
+# In-memory mirror of the subscription tables (service_nodes, users, wallet_prefixes) used by the
+# updater.  The mirror is loaded once at startup and then kept up to date by applying the row-level
+# changes that the database triggers (see database.pgsql) publish on the lokisnbot_changes NOTIFY
+# channel, so that the updater doesn't have to re-read the tables every poll.
+#
+# Rows are stored as dicts in the same form as ServiceNode data (except that service_nodes rows
+# don't include the note), and are updated in place: a ServiceNode constructed with copy=False from
+# a mirrored row updates the mirror directly when the updater writes to it.
+#
+# Everything here is only used from the updater thread.
+
+import heapq
+import hashlib
+import json
+
+from . import pgsql
+from .servicenode import ServiceNode, pubkey_bin
+
+CHANNEL = 'lokisnbot_changes'
+
+# table: the SQL expression (in terms of table alias `t`) the table's rows are ordered by for checksums
+checksum_order = { 'service_nodes': 't.id', 'users': 't.id', 'wallet_prefixes': 't.uid, t.wallet COLLATE "C"' }
+
+listen_conn = None
+
+subs = {}  # service_nodes.id: row
+users = {}  # users.id: row
+wallets = {}  # uid: set(wallet, ...)
+hashes = { t: {} for t in checksum_order }  # table: {key: md5 of the row's text}
+
+by_pubkey = {}  # binary pubkey: set(service_nodes.id, ...)
+by_uid = {}  # uid: set(service_nodes.id, ...)
+deadlines = []  # heap of (next_check_at, service_nodes.id); may contain stale entries
+
+
+def _key(table, row):
+    return (row['uid'], row['wallet']) if table == 'wallet_prefixes' else row['id']
+
+
+def _unindex(row):
+    pubkey = pubkey_bin(row['pubkey'])
+    by_pubkey[pubkey].discard(row['id'])
+    if not by_pubkey[pubkey]:
+        del by_pubkey[pubkey]
+    by_uid[row['uid']].discard(row['id'])
+    if not by_uid[row['uid']]:
+        del by_uid[row['uid']]
+
+
+def _from_json(row):
+    """Converts a row as produced by to_jsonb into mirror form (bytea pubkeys come through json
+    as '\\x...' strings, which we want as plain hex)."""
+    if 'pubkey' in row:
+        row['pubkey'] = row['pubkey'][2:]
+    return row
+
+
+def _apply(table, op, row, rowhash=None):
+    """Applies one inserted/updated/deleted row to the mirror.  `rowhash` is the md5 of the row's
+    text (used by reconcile()), if known."""
+    key = _key(table, row)
+    if op == 'DELETE':
+        hashes[table].pop(key, None)
+        if table == 'service_nodes':
+            old = subs.pop(key, None)
+            if old:
+                _unindex(old)
+        elif table == 'users':
+            users.pop(key, None)
+        else:
+            w = wallets.get(row['uid'])
+            if w:
+                w.discard(row['wallet'])
+                if not w:
+                    del wallets[row['uid']]
+        return
+
+    if rowhash is not None:
+        hashes[table][key] = rowhash
+    if table == 'service_nodes':
+        old = subs.get(key)
+        if old:
+            _unindex(old)
+            old.update(row)
+            row = old
+        else:
+            subs[key] = row
+        by_pubkey.setdefault(pubkey_bin(row['pubkey']), set()).add(key)
+        by_uid.setdefault(row['uid'], set()).add(key)
+        heapq.heappush(deadlines, (row['next_check_at'], key))
+    elif table == 'users':
+        users[key] = row
+    else:
+        wallets.setdefault(row['uid'], set()).add(row['wallet'])
+
+
+def _load_table(table):
+    """(Re-)loads all of a table's rows into the mirror"""
+    if table == 'service_nodes':
+        subs.clear()
+        by_pubkey.clear()
+        by_uid.clear()
+        deadlines.clear()
+    elif table == 'users':
+        users.clear()
+    else:
+        wallets.clear()
+    hashes[table].clear()
+
+    with pgsql.stream_cursor('mirror_load') as cur:
+        cur.execute("SELECT md5(t::text), to_jsonb(t) - 'note' FROM " + table + " t")
+        for rowhash, row in cur:
+            _apply(table, 'INSERT', _from_json(row), rowhash)
+
+
+def load():
+    """Starts listening for changes and loads the initial contents of the mirror.  We start
+    listening first so that no change made during the load can be missed."""
+    global listen_conn
+    listen_conn = pgsql.listen(CHANNEL)
+    for table in checksum_order:
+        _load_table(table)
+
+
+def sync():
+    """Applies all the change notifications received since the last call.  Notifications for rows
+    too large to fit in a notification payload don't include the row, so it gets fetched here."""
+    listen_conn.poll()
+    while listen_conn.notifies:
+        change = json.loads(listen_conn.notifies.pop(0).payload)
+        row = change.get('row')
+        if row is None and change['op'] == 'DELETE':
+            row = { 'id': change['id'] }
+        elif row is None:
+            cur = pgsql.cursor()
+            cur.execute("SELECT md5(t::text), to_jsonb(t) - 'note' FROM service_nodes t WHERE id = %s", (change['id'],))
+            fetched = cur.fetchone()
+            if fetched is None:
+                continue  # Deleted since; the delete notification is still to come
+            change['hash'], row = fetched
+        _apply(change['table'], change['op'], _from_json(row), change.get('hash'))
+
+
+def reconcile():
+    """Guards against missed notifications: compares a checksum of each mirrored table with the
+    database and reloads any table that doesn't match.  Returns the list of reloaded tables.
+
+    Changes that are still in flight can cause a spurious mismatch (and so an unneeded reload), so
+    this should be called right after sync()."""
+    reloaded = []
+    cur = pgsql.cursor()
+    for table, order in checksum_order.items():
+        cur.execute("SELECT md5(string_agg(md5(t::text), '' ORDER BY " + order + ")) FROM " + table + " t")
+        expected = cur.fetchone()[0]
+        mine = hashes[table]
+        actual = hashlib.md5(''.join(mine[k] for k in sorted(mine)).encode()).hexdigest() if mine else None
+        if actual != expected:
+            _load_table(table)
+            reloaded.append(table)
+    return reloaded
+
+
+def _subscription(row):
+    """Returns a ServiceNode for the given mirrored row, with the user's chat ids added"""
+    user = users.get(row['uid'])
+    row['telegram_id'] = user['telegram_id'] if user else None
+    row['discord_id'] = user['discord_id'] if user else None
+    return ServiceNode(row, copy=False)
+
+
+def subscriptions(now, changed=None):
+    """Generator yielding a ServiceNode for each non-archived subscription that is due (i.e. with
+    next_check_at <= now) or is for one of the `changed` binary pubkeys.  If `changed` is None then
+    all non-archived subscriptions are yielded."""
+    if changed is None:
+        ids = list(subs.keys())
+    else:
+        changed = set(changed)
+        ids = set()
+        while deadlines and deadlines[0][0] <= now:
+            ids.add(heapq.heappop(deadlines)[1])
+        for pubkey in changed:
+            ids.update(by_pubkey.get(pubkey, ()))
+    for i in ids:
+        row = subs.get(i)
+        if row is None or row['archived']:
+            continue
+        # Skip stale heap entries (unless the row changed, they'll have another entry for the current deadline):
+        if changed is not None and row['next_check_at'] > now and pubkey_bin(row['pubkey']) not in changed:
+            continue
+        yield _subscription(row)
+        heapq.heappush(deadlines, (row['next_check_at'], i))
+
+
+def for_pubkey(pubkey):
+    """Generator yielding a ServiceNode for each non-archived subscription of the given binary pubkey"""
+    for i in list(by_pubkey.get(pubkey, ())):
+        row = subs[i]
+        if not row['archived']:
+            yield _subscription(row)
+
+
+def wallet_prefixes():
+    """Returns a dict of uid: tuple(wallet, ...) of all users' wallet prefixes"""
+    return { uid: tuple(w) for uid, w in wallets.items() }
+
+
+def auto_monitor_users():
+    """Returns a list of (uid, telegram_id, discord_id, set(binary pubkey, ...)) tuples for the users
+    that have auto-monitoring enabled, with the pubkeys they already monitor."""
+    return [(uid, u['telegram_id'], u['discord_id'], set(pubkey_bin(subs[i]['pubkey']) for i in by_uid.get(uid, ())))
+            for uid, u in users.items() if u['auto_monitor']]
+
+
+def api_tokens():
+    """Returns a dict of API token: tuple((binary pubkey, testnet, alias), ...) of the non-archived
+    subscriptions of each user that has an API token (see api.py)"""
+    return { u['api_token']: tuple(sorted((pubkey_bin(subs[i]['pubkey']), subs[i]['testnet'], subs[i]['alias'])
+                for i in by_uid.get(uid, ()) if not subs[i]['archived']))
+            for uid, u in users.items() if u.get('api_token') }
+
+
+def revive(pubkeys):
+    """Revives archived subscriptions of the given binary pubkeys, both in the database and in the
+    mirror (so that they are evaluated without waiting for the change notifications)."""
+    if ServiceNode.revive(pubkeys):
+        for pubkey in pubkeys:
+            for i in by_pubkey.get(pubkey, ()):
+                subs[i]['archived'] = False
+
+
+def store(sn):
+    """Adds a just-inserted ServiceNode's row to the mirror without waiting for its change
+    notification"""
+    _apply('service_nodes', 'INSERT', { k: v for k, v in sn._data.items() if k not in ('telegram_id', 'discord_id', 'note') })
@@ -3,14 +3,13 @@ from abc import ABCMeta, abstractmethod
 import time
 import requests
 import re
+import secrets
 
 import lokisnbot
-from . import pgsql
+from . import pgsql, refresh, faucet, snapshot, columns, expiry, contributors, ledger, history, opennodes
 from .constants import *
 from .util import friendly_time, ago, explorer, escape_markdown
-from .servicenode import ServiceNode, lsr, reward
-
-last_faucet_use = 0
+from .servicenode import ServiceNode, lsr, reward, pubkey_bin
 
 class Network(metaclass=ABCMeta):
 
@@ -37,6 +36,18 @@ class Network(metaclass=ABCMeta):
 
 class NetworkContext(metaclass=ABCMeta):
 
+    _snap = None
+
+    @property
+    def snap(self):
+        """The network snapshots (a snapshot.Networks) that this request works with.  Subclasses
+        set this when the request starts, otherwise it is whatever is pinned when first used, so
+        that a request sees a single poll of both networks throughout."""
+        if self._snap is None:
+            self._snap = snapshot.get()
+        return self._snap
+
+
     @staticmethod
     def b(text):
         """Returns text with bold markup.  Default returns text as-is"""
@@ -157,32 +168,15 @@ class NetworkContext(metaclass=ABCMeta):
 
 
     def status(self, testnet=False, **kwargs):
-        sns = lokisnbot.testnet_sn_states if testnet else lokisnbot.sn_states
-        active, decomm, waiting, infinite, old_proof = 0, 0, 0, 0, 0
-        unlocking = [0, 0, 0, 0]  # <1 d, <3 days, <1 week, >1 week
+        net = self.snap.network(testnet)
+        h = net.height
+        counts = columns.status_counts(net)
+        active, decomm, waiting, infinite, old_proof = (counts[x] for x in ('active', 'decomm', 'waiting', 'infinite', 'old_proof'))
+        unlocking = expiry.unlock_buckets(net)  # <1 d, <3 days, <1 week, >1 week
         version_counts = {}
-        now = int(time.time())
-        h = (lokisnbot.testnet_network_info if testnet else lokisnbot.network_info)['height']
-        for sn in sns.values():
-            if sn['total_contributed'] < sn['staking_requirement']:
-                waiting += 1
-            elif 'active' not in sn or sn['active']:
-                active += 1
-            else:
-                decomm += 1
-            if sn['registration_height'] >= (TESTNET_INFINITE_FROM if testnet else INFINITE_FROM):
-                if sn['requested_unlock_height']:
-                    unlock_days = (sn['requested_unlock_height'] - h) // 720
-                    unlocking[0 if unlock_days < 1 else 1 if unlock_days < 3 else 2 if unlock_days < 7 else 3] += 1
-                else:
-                    infinite += 1
-            if sn['last_uptime_proof'] and now - sn['last_uptime_proof'] > PROOF_AGE_WARNING:
-                old_proof += 1
-            ver = ServiceNode.to_version_string(sn['service_node_version']) if 'service_node_version' in sn else None
-            if ver not in version_counts:
-                version_counts[ver] = 1
-            else:
-                version_counts[ver] += 1
+        for v, n in counts['versions'].items():
+            ver = ServiceNode.to_version_string(list(v)) if v else None
+            version_counts[ver] = version_counts.get(ver, 0) + n
 
         b = lambda x: self.b(x)
         i = lambda x: self.i(x)
@@ -222,19 +216,9 @@ class NetworkContext(metaclass=ABCMeta):
             self.send_reply(reply_text, **kwargs)
 
 
-    def faucet_was_recently_used(self):
-        """Checks if the faucet was recently used and, if so, sends a reply to the user and returns
-        True.  Otherwise sends nothing and returns True."""
-        cur = pgsql.cursor()
-        cur.execute("SELECT faucet_last_used FROM users WHERE id = %s", (self.get_uid(),))
-        last_used = cur.fetchone()[0]
-        if last_used is None:
-            last_used = 0
-
-        global last_faucet_use
-        now = int(time.time())
-        global_wait = (last_faucet_use - now) + lokisnbot.config.TESTNET_FAUCET_WAIT_GLOBAL
-        user_wait = (last_used - now) + lokisnbot.config.TESTNET_FAUCET_WAIT_USER
+    def faucet_wait_reply(self, user_wait, global_wait):
+        """If either wait time is non-zero, replies to the user with how long they have to wait
+        before they can use the faucet and returns True.  Otherwise sends nothing and returns False."""
         if user_wait > 0:
             self.send_reply(dead_end=True,
                     message="🤔 It appears that you have already used the faucet recently.  You need to wait another {} before you can use it again.".format(
@@ -242,42 +226,31 @@ class NetworkContext(metaclass=ABCMeta):
             return True
         elif global_wait > 0:
             self.send_reply(dead_end=True,
-                    message="🤔 The faucet has been used by someone else recently.  You need to wait another {} before you can use it.".format(
+                    message="🤔 The faucet has been used by a lot of other people recently.  You need to wait another {} before you can use it.".format(
                         friendly_time(global_wait)))
             return True
         return False
 
-    def send_faucet_tx(self, wallet):
-        """Tries to send a faucet transaction.  Upon error, sends an error message and returns None.
-        Upon success, returns the `result` element of the transaction response."""
-        try:
-            transfer = requests.post(lokisnbot.config.TESTNET_WALLET_URL + "/json_rpc", timeout=5, json={
-                "jsonrpc": "2.0",
-                "id": "0",
-                "method": "transfer",
-                "params": {
-                    "destinations": [{"amount": lokisnbot.config.TESTNET_FAUCET_AMOUNT, "address": wallet}],
-                    "priority": 5,
-                    }
-                }).json()
-        except Exception as e:
-            print("testnet wallet error: {}".format(e))
-            return self.send_reply(dead_end=True, message='💩 An error occured while communicating with the testnet wallet; please try again later')
-
-        if 'error' in transfer and transfer['error']:
-            print("Faucet transfer error: {}".format(transfer['error']))
-            return self.send_reply(dead_end=True, message='☣ '+self.b('Transfer failed')+': {}'.format(transfer['error']['message']))
-
-        print("Faucet success: {}".format(transfer['result']['tx_hash']))
-        global last_faucet_use
-        last_faucet_use = int(time.time())
-        pgsql.cursor().execute("UPDATE users SET faucet_last_used = %s WHERE id = %s", (int(time.time()), self.get_uid()))
-
-        return transfer['result']
-
-
-    def service_node(self, *, snid=None, reply_text='', pubkey=None, sn=None, send=True):
-        """Shows service node details.  If `send` is false, returns (msg, sn) instead of sending it"""
+    def faucet_was_recently_used(self):
+        """Checks if the faucet was recently used and, if so, sends a reply to the user and returns
+        True.  Otherwise sends nothing and returns False."""
+        return self.faucet_wait_reply(*faucet.waits(self.get_uid()))
+
+    def send_faucet_tx(self, wallet, done):
+        """Queues a faucet transaction to `wallet`, to go out with the next faucet batch.  Returns
+        True if queued; otherwise (if the user isn't allowed to use the faucet right now) replies
+        with the wait time and returns False.  Once the batch is sent, `done(tx_hash, error)` gets
+        called (from the faucet thread) with either the transaction hash or an error message; see
+        faucet_error() for replying with the latter."""
+        return not self.faucet_wait_reply(*faucet.request(self.get_uid(), wallet, done))
+
+    def faucet_error(self, error):
+        self.send_reply(dead_end=True, message='☣ '+self.b('Transfer failed')+': {}'.format(error))
+
+
+    def service_node(self, *, snid=None, reply_text='', pubkey=None, sn=None, send=True, fresh=False):
+        """Shows service node details.  If `send` is false, returns (msg, sn) instead of sending it.
+        If `fresh` is true the SN's state is first refreshed from oxend (see refresh.refresh())."""
 
         uid = self.get_uid()
         if snid or pubkey:
@@ -285,6 +258,9 @@ class NetworkContext(metaclass=ABCMeta):
         elif not sn:
             raise RuntimeError("service_node requires either snid or sn")
 
+        if fresh and refresh.refresh(sn.binary_pubkey()):
+            sn = ServiceNode(sn._data)
+
         if 'id' in sn:
             snid = sn['id']
 
@@ -296,21 +272,25 @@ class NetworkContext(metaclass=ABCMeta):
 
         pubkey = sn['pubkey']
 
-        sns = lokisnbot.sn_states
+        net = self.snap.network(sn.testnet)
         if sn.testnet:
-            sns = lokisnbot.testnet_sn_states
             reply_text += '🚧 This is a '+self.b('testnet')+' service node! 🚧\n'
 
         if 'note' in sn and sn['note']:
             reply_text += 'Note: ' + self.escape_msg(sn['note']) + '\n'
 
         if sn.active():
-            height = (lokisnbot.testnet_network_info if sn.testnet else lokisnbot.network_info)['height']
+            height = net.height
 
             reply_text += 'Public key: {}\n'.format(self.i(pubkey))
             reply_text += 'Lokinet address: {}\n'.format(self.i(sn.lokinet_snode_addr()))
 
             reply_text += 'Last uptime proof: ' + sn.format_proof_age() + '\n'
+            proofs = history.stats(sn.binary_pubkey())
+            if proofs and proofs['mean']:
+                reply_text += 'Uptime proofs: every {} on average, longest gap {}; {} late and {} decommission{} in the last {}\n'.format(
+                        self.b(friendly_time(int(proofs['mean']))), self.b(friendly_time(proofs['max'])), proofs['late'],
+                        proofs['decomms'], '' if proofs['decomms'] == 1 else 's', friendly_time(int(proofs['span'])))
 
             ver, verstr = sn.version(), sn.version_str()
             reply_text += 'Service node version: ' + (self.b(verstr) if verstr else 'unknown')
@@ -367,8 +347,7 @@ class NetworkContext(metaclass=ABCMeta):
                 lrbh = sn.state('last_reward_block_height')
                 # FIXME: this is slightly wrong because it doesn't account for other SNs that may expire
                 # before they earn a reward:
-                blocks_to_go = 1 + sum(1 for sni in sns.values() if
-                        ('active' not in sni or sni['active']) and sni['total_contributed'] >= sni['staking_requirement'] and sni['last_reward_block_height'] < lrbh)
+                blocks_to_go = 1 + columns.reward_queue_ahead(net, lrbh)
 
                 if sn.decommissioned():
                     reply_text += 'Next reward: *never* (currently decommissioned)\n'
@@ -399,6 +378,118 @@ class NetworkContext(metaclass=ABCMeta):
             return (reply_text, sn)
 
 
+    def upcoming_unlocks_msg(self):
+        """Returns a message listing the user's service nodes that have an unlock (or expiry)
+        scheduled, soonest first, with a summary of how many unlock when"""
+        sns = { sn.binary_pubkey(): sn for sn in ServiceNode.all(self.get_uid(), sortkey=None) }
+        msg = ''
+        for testnet in (False, True):
+            upcoming = expiry.upcoming(self.snap.network(testnet), (pk for pk, sn in sns.items() if sn.testnet == testnet))
+            if not upcoming:
+                continue
+            if msg:
+                msg += '\n'
+            msg += self.b('Upcoming testnet unlocks:' if testnet else 'Upcoming unlocks:') + '\n'
+            counts = expiry.buckets([h for h, pk in upcoming], self.snap.network(testnet).height)
+            msg += '{} service node{} unlocking: {} <1d, {} 1-3d, {} 3-7d, {} ≥7d\n\n'.format(
+                    self.b(len(upcoming)), '' if len(upcoming) == 1 else 's', *(self.b(c) for c in counts))
+            for height, pk in upcoming:
+                sn = sns[pk]
+                msg += '{} {}: block {} ({})\n'.format(sn.status_icon(), sn.alias(), self.i(height), self.i(friendly_time(sn.expires_in())))
+
+        return msg or 'None of your service nodes currently have an unlock scheduled.'
+
+
+    def portfolio_msg(self):
+        """Returns a message summarizing, for each of the user's wallets, its stakes across all
+        nodes on the network: total stake, share, expected rewards, and any nodes at risk"""
+        uid = self.get_uid()
+        cur = pgsql.cursor()
+        cur.execute("SELECT wallet FROM wallet_prefixes WHERE uid = %s ORDER BY wallet", (uid,))
+        prefixes = [row[0] for row in cur]
+        if not prefixes:
+            return "I don't know any of your wallets yet; add one to see your portfolio."
+
+        aliases = { sn.binary_pubkey(): sn.alias() for sn in ServiceNode.all(uid, sortkey=None) }
+        msg = ''
+        for testnet in (False, True):
+            for p in contributors.portfolio(self.snap.network(testnet), prefixes):
+                if msg:
+                    msg += '\n'
+                w = p['wallet']
+                msg += '{}{}:\n'.format('🚧' if testnet else '', self.b(w[0:7]+'...'+w[-2:] if len(w) > 12 else w))
+                msg += ('Staked: '+self.b('{:.3f}')+' OXEN in '+self.b('{}')+' service node{} ('+self.i('{:.2f}')+' node{} worth)\n').format(
+                        p['stake']/COIN, p['nodes'], '' if p['nodes'] == 1 else 's', p['share'], '' if p['share'] == 1 else 's')
+                msg += 'Expected rewards: '+self.b('{:.3f}'.format(p['daily']/COIN))+' OXEN/day\n'
+                if p['next_reward'] is not None:
+                    msg += 'Next reward in {} blocks (approx. {})\n'.format(self.b(p['next_reward']), friendly_time(p['next_reward'] * AVERAGE_BLOCK_SECONDS))
+                for pubkey, reason in p['at_risk']:
+                    name = aliases.get(pubkey) or pubkey.hex()[0:6] + '…' + pubkey.hex()[-3:]
+                    msg += '⚠ {}: {}\n'.format(self.i(name), reason)
+
+        return msg or 'None of your wallets currently have stakes in any service nodes.'
+
+
+    def earnings_msg(self):
+        """Returns a message with the rewards earned by the user's wallets: today, over the last week
+        and 30 days, by month, and in total"""
+        cur = pgsql.cursor()
+        cur.execute("SELECT wallet FROM wallet_prefixes WHERE uid = %s", (self.get_uid(),))
+        prefixes = [row[0] for row in cur]
+        if not prefixes:
+            return "I don't know any of your wallets yet; add one to see your earnings."
+
+        e = ledger.earnings(prefixes)
+        if not e['total'][1]:
+            return "I haven't recorded any rewards earned by your wallets yet."
+        amount = lambda x: (self.b('{:.3f}')+' OXEN ({} reward{})').format(x[0]/COIN, x[1], '' if x[1] == 1 else 's')
+        msg = self.b('Your service node earnings:') + '\n'
+        msg += 'Today (UTC): ' + amount(e['today']) + '\n'
+        msg += 'Last 7 days: ' + amount(e['week']) + '\n'
+        msg += 'Last 30 days: ' + amount(e['month']) + '\n\n'
+        for month, oxen, rewards in e['monthly']:
+            msg += self.i(month.strftime('%B %Y')) + ': ' + amount((oxen, rewards)) + '\n'
+        msg += '\nTotal: ' + amount(e['total'])
+        return msg
+
+
+    def open_nodes_msg(self, page=0, sort='room', max_fee=None, min_room=None, testnet=False):
+        """Returns a (message, page, pages) tuple with the given page of the service nodes that are
+        still awaiting contributions, in the given opennodes.SORTS order, optionally limited to
+        nodes with an operator fee of at most `max_fee` and needing at least `min_room` atomic OXEN"""
+        net = self.snap.network(testnet)
+        nodes, page, pages, total = opennodes.page(net, page, sort, max_fee, min_room)
+        filters = []
+        if max_fee is not None:
+            filters.append('fee ≤ {:g}%'.format(max_fee * 100))
+        if min_room is not None:
+            filters.append('needing ≥ {:g} OXEN'.format(min_room / COIN))
+        msg = self.b('{}Service nodes awaiting contributions'.format('Testnet ' if testnet else '')) + ' ({}{}):\n\n'.format(
+                { 'room': 'most stake needed first', 'fee': 'lowest fee first', 'newest': 'newest first' }[sort],
+                ''.join('; ' + f for f in filters))
+        if not nodes:
+            return (msg + 'There are currently no such service nodes.', page, pages)
+        for n in nodes:
+            msg += '{}\nNeeds {} OXEN; fee {}; {} contributor{}; registered {}\n\n'.format(
+                    self.i(n.pubkey.hex()), self.b('{:.3f}'.format(n.room / COIN)), self.b('{:.1f}%'.format(n.fee * 100)),
+                    n.contributors, '' if n.contributors == 1 else 's',
+                    ago((net.height - n.registration_height) * AVERAGE_BLOCK_SECONDS) if net.height else 'at height {}'.format(n.registration_height))
+        msg += 'Page {} of {} ({} service node{})'.format(page + 1, pages, total, '' if total == 1 else 's')
+        return (msg, page, pages)
+
+
+    def api_token_msg(self, reset=False):
+        """Returns a message with the user's API token (see api.py), creating one if the user doesn't
+        have one yet or if `reset` is given"""
+        token = self.get_user_field('api_token')
+        if not token or reset:
+            token = self.set_user_field('api_token', secrets.token_hex(24))
+        return ('Your API token is: {}\n\nSend it as an `Authorization: Bearer` header with requests to the '
+                '`/mine` API endpoint to get the service nodes you monitor.  Anyone with this token can see your '
+                'service nodes, so keep it private; you can replace it with a new one at any time.'
+                ' (It can take a few seconds for a new token to start working.)').format(self.b(token))
+
+
     @abstractmethod
     def wallets_menu(self, reply_text=''):
         """Lists the known wallets"""
@@ -411,7 +502,7 @@ class NetworkContext(metaclass=ABCMeta):
         uid = self.get_uid()
         have = set()
         for sn in ServiceNode.all(uid):
-            have.add(sn['pubkey'])
+            have.add(sn.binary_pubkey())
 
         cur = pgsql.cursor()
         cur.execute("SELECT wallet from wallet_prefixes WHERE uid = %s", (uid,))
@@ -422,21 +513,21 @@ class NetworkContext(metaclass=ABCMeta):
 
         added = []
 
-        sns = lokisnbot.sn_states
-        for pubkey, sn in sns.items():
+        sns = self.snap.mainnet.states
+        for pubkey in contributors.matching(self.snap.mainnet, wallets):
             if pubkey in have:
                 continue
-            if any(c['address'].startswith(wallets) for c in sn['contributors']):
-                have.add(pubkey)
-                sn = ServiceNode({
-                    'pubkey': pubkey,
-                    'uid': uid,
-                    'active': True,
-                    'complete': sn['total_contributed'] >= sn['staking_requirement'],
-                    'last_reward_block_height': sn['last_reward_block_height']
-                })
-                sn.insert()
-                added.append(sn)
+            sn = sns[pubkey]
+            have.add(pubkey)
+            sn = ServiceNode({
+                'pubkey': pubkey,
+                'uid': uid,
+                'active': True,
+                'complete': sn['total_contributed'] >= sn['staking_requirement'],
+                'last_reward_block_height': sn['last_reward_block_height']
+            })
+            sn.insert()
+            added.append(sn)
 
         return added
 
@@ -459,13 +550,29 @@ class NetworkContext(metaclass=ABCMeta):
 
         many = len(pubkeys) > 5
 
+        # Look up all the pubkeys (and, if adding, insert all the new ones) up front with a single
+        # query each rather than one query per pubkey:
+        existing = ServiceNode.all_by_pubkeys(uid, pubkeys)
+        added = {}
+        if not just_looking:
+            sns, tsns = self.snap.mainnet.states, self.snap.testnet.states
+            for pubkey in pubkeys:
+                if pubkey in existing or pubkey in added:
+                    continue
+                sn_data = { 'pubkey': pubkey, 'uid': uid, 'active': False, 'testnet': False, 'complete': False, 'last_reward_block_height': None }
+                pk = pubkey_bin(pubkey)
+                state = sns.get(pk) or tsns.get(pk)
+                if state:
+                    sn_data['active'] = True
+                    sn_data['testnet'] = pk not in sns
+                    sn_data['complete'] = state['total_contributed'] >= state['staking_requirement']
+                    sn_data['last_reward_block_height'] = state['last_reward_block_height']
+                added[pubkey] = ServiceNode(sn_data)
+            ServiceNode.insert_many(list(added.values()))
+
         summary = []
         for pubkey in pubkeys:
-            sn = None
-            try:
-                sn = ServiceNode(uid=uid, pubkey=pubkey)
-            except ValueError:
-                pass
+            sn = existing.get(pubkey)
 
             append_status = True
             if not just_looking:
@@ -473,25 +580,16 @@ class NetworkContext(metaclass=ABCMeta):
                     summary.append('I am '+self.i('already')+' monitoring service node '+self.i(sn.shortpub())+' for you.  Current status:')
 
                 else:
-                    sn_data = { 'pubkey': pubkey, 'uid': uid }
-                    sns, tsns = lokisnbot.sn_states, lokisnbot.testnet_sn_states
-                    if pubkey in sns:
-                        sn_data['active'] = True
-                        sn_data['complete'] = sns[pubkey]['total_contributed'] >= sns[pubkey]['staking_requirement']
-                        sn_data['last_reward_block_height'] = sns[pubkey]['last_reward_block_height']
-                        summary.append("Okay, I'm now monitoring service node "+self.i('{}')+" for you.  Current status:")
-                    elif pubkey in tsns:
-                        sn_data['active'] = True
-                        sn_data['testnet'] = True
-                        sn_data['complete'] = tsns[pubkey]['total_contributed'] >= tsns[pubkey]['staking_requirement']
-                        sn_data['last_reward_block_height'] = tsns[pubkey]['last_reward_block_height']
-                        summary.append("Okay, I'm now monitoring "+self.b('testnet')+" service node "+self.i('{}')+" for you.  Current status:")
-                    else:
+                    sn = added.pop(pubkey)
+                    # If the same pubkey is given more than once, later mentions are "already" monitored:
+                    existing[pubkey] = sn
+                    if not sn.active():
                         summary.append("Service node "+self.i('{}')+" isn't currently registered on the network, but I'll start monitoring it for you once it appears.")
                         append_status = False
-
-                    sn = ServiceNode(sn_data)
-                    sn.insert()
+                    elif sn.testnet:
+                        summary.append("Okay, I'm now monitoring "+self.b('testnet')+" service node "+self.i('{}')+" for you.  Current status:")
+                    else:
+                        summary.append("Okay, I'm now monitoring service node "+self.i('{}')+" for you.  Current status:")
                     summary[-1] = summary[-1].format(sn.shortpub())
             elif sn:
                 summary.append('Service node '+self.i(sn.shortpub())+' status:' if many else '')
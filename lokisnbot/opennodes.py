@@ -0,0 +1,63 @@
+# Contribution opportunities: a per-snapshot index of the nodes that are registered but still
+# awaiting stake, pre-sorted by each of the orders the "open nodes" view offers.  Filtered views are
+# built (from just the open nodes) the first time a given sort/filter combination is asked for and
+# kept with the snapshot, so paging through them is a slice.
+
+from .constants import *
+
+SORTS = ('room', 'fee', 'newest')
+
+
+class OpenNode:
+    """A node awaiting contributions"""
+
+    __slots__ = ('pubkey', 'room', 'fee', 'registration_height', 'contributors')
+
+    def __init__(self, pubkey, x):
+        self.pubkey = pubkey
+        self.room = x['staking_requirement'] - x['total_contributed']
+        self.fee = x['portions_for_operator'] / 18446744073709551612.
+        self.registration_height = x['registration_height']
+        self.contributors = len(x['contributors'])
+
+
+class OpenNodes:
+    """The open nodes of a snapshot, with `by[sort]` the list of them in each of the SORTS orders:
+    'room' (most stake still needed first), 'fee' (lowest operator fee first) and 'newest' (most
+    recently registered first)"""
+
+    def __init__(self, snap):
+        nodes = [OpenNode(pubkey, x) for pubkey, x in snap.states.items()
+                if x['total_contributed'] < x['staking_requirement']]
+        self.by = {
+            'room': sorted(nodes, key=lambda n: (-n.room, n.fee, n.pubkey)),
+            'fee': sorted(nodes, key=lambda n: (n.fee, -n.room, n.pubkey)),
+            'newest': sorted(nodes, key=lambda n: (-n.registration_height, n.pubkey)),
+            }
+
+
+def index(snap):
+    """Returns the OpenNodes of the given snapshot"""
+    return snap.index('open_nodes', OpenNodes)
+
+
+def view(snap, sort='room', max_fee=None, min_room=None):
+    """Returns the list of the snapshot's open nodes in the given sort order, limited to those with
+    an operator fee of at most `max_fee` (a portion, e.g. 0.05 for 5%) and needing at least
+    `min_room` atomic OXEN, if given"""
+    if sort not in SORTS:
+        raise ValueError("Invalid sort order {}".format(sort))
+    nodes = index(snap).by[sort]
+    if max_fee is None and min_room is None:
+        return nodes
+    return snap.index(('open_nodes', sort, max_fee, min_room), lambda s: [n for n in nodes
+        if (max_fee is None or n.fee <= max_fee) and (min_room is None or n.room >= min_room)])
+
+
+def page(snap, page=0, sort='room', max_fee=None, min_room=None):
+    """Returns a (nodes, page, pages, total) tuple of the open nodes on the given page (of
+    OPEN_NODES_PAGE_SIZE nodes) of the view(); out-of-range pages give the last page"""
+    nodes = view(snap, sort, max_fee, min_room)
+    pages = max((len(nodes) + OPEN_NODES_PAGE_SIZE - 1) // OPEN_NODES_PAGE_SIZE, 1)
+    page = min(max(page, 0), pages - 1)
+    return (nodes[page * OPEN_NODES_PAGE_SIZE:(page + 1) * OPEN_NODES_PAGE_SIZE], page, pages, len(nodes))
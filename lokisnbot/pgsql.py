@@ -1,12 +1,24 @@
 import psycopg2, psycopg2.extras
+from contextlib import contextmanager
 from . import config
 
 conn = None
+stream_conn = None
 
 def connect():
-    global conn
+    global conn, stream_conn
     conn = psycopg2.connect(**config.PGSQL_CONNECT)
     conn.autocommit = True
+    # Server-side cursors need to live inside a transaction, so they get their own connection:
+    stream_conn = psycopg2.connect(**config.PGSQL_CONNECT)
+
+def listen(channel):
+    """Returns a new connection that is LISTENing on the given NOTIFY channel.  Notifications are
+    collected by calling poll() on the connection, and can then be popped from its `notifies`."""
+    listener = psycopg2.connect(**config.PGSQL_CONNECT)
+    listener.autocommit = True
+    listener.cursor().execute("LISTEN " + channel)
+    return listener
 
 def cursor():
     return conn.cursor()
@@ -14,3 +26,12 @@ def cursor():
 def dict_cursor():
     return conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
+@contextmanager
+def stream_cursor(name, itersize=1000):
+    """Context manager giving a named, server-side cursor that fetches plain tuple rows from the
+    server `itersize` rows at a time as it is iterated, so that large results never have to be held
+    in memory all at once.  The cursor's (read) transaction ends when the context exits."""
+    with stream_conn:
+        with stream_conn.cursor(name) as cur:
+            cur.itersize = itersize
+            yield cur
@@ -0,0 +1,78 @@
+# On-demand refresh of a single service node's state, for when a user explicitly asks for current
+# details (Telegram's Refresh button, Discord's $sn) rather than whatever the last poll (up to 10s
+# old) saw.  Fetched states go into a short-lived overlay on top of the updater's snapshot that
+# ServiceNode consults first, and concurrent refreshes of the same node share a single request.
+
+import threading
+import time
+import requests
+
+import lokisnbot
+from . import snapshot
+from .constants import REFRESH_TTL, REFRESH_MIN_INTERVAL
+
+# binary pubkey: (fetched_at, testnet, state)
+overlay = {}
+
+lock = threading.Lock()
+# binary pubkey: threading.Event set when the in-flight request for the pubkey finishes
+inflight = {}
+
+
+def cached(pubkey):
+    """Returns the (testnet, state) overlay for the given binary pubkey, if there is an unexpired one"""
+    entry = overlay.get(pubkey)
+    if entry and entry[0] + REFRESH_TTL > time.time():
+        return entry[1:]
+    return None
+
+
+def clear():
+    """Drops the overlay; called by the updater when it installs a new snapshot (which is newer than
+    anything in the overlay)."""
+    overlay.clear()
+
+
+def _fetch(pubkey, testnet):
+    url = lokisnbot.config.TESTNET_NODE_URL if testnet else lokisnbot.config.NODE_URL
+    states = requests.post(url + '/json_rpc', json={"jsonrpc":"2.0","id":"0","method":"get_service_nodes",
+        "params": { "service_node_pubkeys": [pubkey.hex()] }}, timeout=2).json()['result']['service_node_states']
+    return states[0] if states else None
+
+
+def refresh(pubkey):
+    """Fetches the current state of the SN with the given binary pubkey from oxend and puts it in
+    the overlay.  If a refresh of the same SN is already in progress this waits for and shares its
+    result instead of making another request, and a state fetched in the last REFRESH_MIN_INTERVAL
+    seconds gets reused as is.  Returns true if the overlay has a fresh state for the SN.  Only SNs
+    the updater already knows about can be refreshed."""
+    snap = snapshot.current
+    testnet = pubkey not in snap.mainnet.states and pubkey in snap.testnet.states
+    if not testnet and pubkey not in snap.mainnet.states:
+        return False
+
+    with lock:
+        entry = overlay.get(pubkey)
+        if entry and entry[0] + REFRESH_MIN_INTERVAL > time.time():
+            return True
+        done = inflight.get(pubkey)
+        leader = done is None
+        if leader:
+            done = inflight[pubkey] = threading.Event()
+
+    if not leader:
+        done.wait(5)
+        return cached(pubkey) is not None
+
+    try:
+        state = _fetch(pubkey, testnet)
+        if state:
+            overlay[pubkey] = (time.time(), testnet, state)
+        return state is not None
+    except Exception as e:
+        print("Unable to refresh service node {}: {}".format(pubkey.hex(), e))
+        return False
+    finally:
+        with lock:
+            del inflight[pubkey]
+        done.set()
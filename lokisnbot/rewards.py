@@ -0,0 +1,98 @@
+# Reward notifications from the blocks themselves.  Each poll the updater scans the block headers
+# since the last scanned height for the service_node_winner of each block, so that every reward gets
+# reported (with its own height) even if a node won more than once between polls or the bot was
+# down for a while.  Block headers are fetched in ranges of up to REWARD_HEADERS_PER_RPC blocks, so
+# catching up on a day's worth of blocks takes a single RPC request.
+
+import requests
+
+from . import pgsql
+from . import mirror
+from . import alerts
+from . import ledger
+from . import snapshot
+from .constants import *
+from .servicenode import ServiceNode
+
+
+def scan_height(testnet):
+    """Returns the last scanned block height of mainnet or testnet, or None if we haven't scanned
+    anything yet"""
+    cur = pgsql.cursor()
+    cur.execute("SELECT height FROM reward_scan WHERE testnet = %s", (testnet,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def set_scan_height(testnet, height):
+    pgsql.cursor().execute("INSERT INTO reward_scan (testnet, height) VALUES (%s, %s) "
+            "ON CONFLICT (testnet) DO UPDATE SET height = EXCLUDED.height", (testnet, height))
+
+
+def fetch_winners(node_url, start, end):
+    """Fetches the block headers of blocks `start` through `end` (inclusive) and returns a dict of
+    binary pubkey: [height, ...] of the service node winners of those blocks, and a dict of
+    height: timestamp of the blocks"""
+    winners, times = {}, {}
+    for first in range(start, end + 1, REWARD_HEADERS_PER_RPC):
+        last = min(first + REWARD_HEADERS_PER_RPC - 1, end)
+        headers = requests.post(node_url + '/json_rpc', json={"jsonrpc":"2.0","id":"0","method":"get_block_headers_range",
+            "params": { "start_height": first, "end_height": last }}, timeout=10).json()['result']['headers']
+        for h in headers:
+            times[h['height']] = h['timestamp']
+            winner = h.get('service_node_winner')
+            if winner and winner.strip('0'):
+                winners.setdefault(bytes.fromhex(winner), []).append(h['height'])
+    return winners, times
+
+
+def unreported(testnet, top):
+    """Returns a dict of binary pubkey: [height, ...] (ascending) of the rewards recorded in the
+    ledger in the REWARD_BACKFILL_MAX_BLOCKS blocks up to `top`"""
+    cur = pgsql.cursor()
+    cur.execute("SELECT pubkey, array_agg(DISTINCT height ORDER BY height) FROM reward_ledger"
+            " WHERE testnet = %s AND height > %s AND height <= %s GROUP BY pubkey",
+            (testnet, top - REWARD_BACKFILL_MAX_BLOCKS, top))
+    return { bytes(pubkey): heights for pubkey, heights in cur }
+
+
+def backfill(node_url, testnet, height, notify, wallets):
+    """Scans the blocks added since the last scan (up to the current `height`) and records the
+    rewards in the ledger (see ledger.py), then sends each user one message summarizing the rewards
+    in the ledger earned by their subscribed SNs after each subscription's
+    last_reward_block_height, advancing it.  Because the summaries come from the ledger rather than
+    from just the scanned blocks, rewards whose message couldn't be delivered get reported the next
+    time around.  Goes back at most REWARD_BACKFILL_MAX_BLOCKS blocks.  On the very first run this
+    just records the current height."""
+    top = height - 1
+    last = scan_height(testnet)
+    if last is None:
+        set_scan_height(testnet, top)
+        return
+    if top <= last:
+        return
+
+    start = max(last + 1, top - REWARD_BACKFILL_MAX_BLOCKS + 1)
+    try:
+        winners, times = fetch_winners(node_url, start, top)
+    except Exception as e:
+        print("Unable to fetch block headers {}-{} for reward notifications: {}".format(start, top, e))
+        return
+
+    ledger.record(testnet, winners, times, snapshot.get().network(testnet).states)
+    set_scan_height(testnet, top)
+
+    won = {}  # uid: [(sn, [height, ...]), ...]
+    for pubkey, heights in unreported(testnet, top).items():
+        for sn in mirror.for_pubkey(pubkey):
+            if sn.testnet != testnet or not sn['last_reward_block_height'] or not sn['rewards'] or not sn.staked():
+                continue
+            mine = [h for h in heights if h > sn['last_reward_block_height']]
+            if mine:
+                won.setdefault(sn['uid'], []).append((sn, mine))
+
+    for uid, sns in won.items():
+        sns.sort(key=lambda x: ServiceNode.default_sortkey(x[0]))
+        if notify(sns[0][0], alerts.reward_summary_msg(sns, wallets.get(uid)), is_update=False, also=[sn for sn, heights in sns[1:]]):
+            for sn, heights in sns:
+                sn.update(last_reward_block_height=max(heights))
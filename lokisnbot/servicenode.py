@@ -1,8 +1,12 @@
 
 import time
+import base64
+import psycopg2.extras
 
 import lokisnbot
 from . import pgsql
+from . import refresh
+from . import snapshot
 from .constants import *
 
 def lsr(h, testnet=False):
@@ -15,26 +19,105 @@ def reward(h):
     return 16.5
     #return 14 + 50 * 2**(-h/64800)
 
+def split_reward(state, snreward):
+    """Splits a reward of `snreward` atomic OXEN earned by the SN with the given state into the
+    contributor shares: the operator (the first contributor) gets the operator fee portion, and the
+    rest is split in proportion to the stakes.  Returns a dict of address: atomic OXEN."""
+    contributors = state['contributors']
+    operator_reward = snreward * state['portions_for_operator'] // 18446744073709551612
+    result = {}
+    for c in contributors:
+        mine = (snreward - operator_reward) * c['amount'] // state['staking_requirement']
+        result[c['address']] = result.get(c['address'], 0) + mine
+    if contributors:
+        result[contributors[0]['address']] = result.get(contributors[0]['address'], 0) + operator_reward
+    return result
+
 base32z_dict = 'ybndrfg8ejkmcpqxot1uwisza345h769'
+# z-base-32 uses the same bit ordering as RFC 4648 base32, just with a different alphabet, so we can
+# let base64.b32encode do the heavy lifting and translate the result:
+base32z_trans = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ234567', base32z_dict)
+
+def lokinet_snode_addrs(pk_hexes):
+    """Bulk lokinet address encoder: takes an iterable of hex ed25519 pubkeys and returns a list of
+    the corresponding .snode addresses (with None for any missing or invalid keys)."""
+    addrs = []
+    for pk_hex in pk_hexes:
+        try:
+            pk = bytes.fromhex(pk_hex) if pk_hex and len(pk_hex) == 64 else None
+        except ValueError:
+            pk = None
+        addrs.append(base64.b32encode(pk).decode().rstrip('=').translate(base32z_trans) + '.snode' if pk else None)
+    return addrs
+
+
+def lokinet_addresses(states, previous=None):
+    """Builds the pubkey-indexed lokinet address table for a set of SN states: returns a dict of
+    pubkey: (pubkey_ed25519, address).  Entries of `previous` (the table for the prior snapshot) are
+    reused for any node whose ed25519 key hasn't changed, so only new nodes (or nodes with a changed
+    ed25519 key) actually get encoded."""
+    table, encode = {}, []
+    for pubkey, x in states.items():
+        ed = x.get('pubkey_ed25519')
+        old = previous.get(pubkey) if previous else None
+        if old and old[0] == ed:
+            table[pubkey] = old
+        else:
+            encode.append((pubkey, ed))
+    if encode:
+        for (pubkey, ed), addr in zip(encode, lokinet_snode_addrs(ed for pubkey, ed in encode)):
+            table[pubkey] = (ed, addr)
+    return table
+
+
+def pubkey_bin(pubkey):
+    """Converts a hex pubkey to the 32-byte binary form used in the database and as the key of the
+    network state dicts.  Binary pubkeys (bytes or a memoryview from a bytea column) are returned as
+    bytes."""
+    return bytes(pubkey) if isinstance(pubkey, (bytes, memoryview)) else bytes.fromhex(pubkey)
+
+
+def db_row(row):
+    """Converts a row (or partial row) of the service_nodes table into a dict, converting the
+    database's binary pubkey into the hex pubkey used by ServiceNode data."""
+    row = dict(row)
+    if 'pubkey' in row and row['pubkey'] is not None:
+        row['pubkey'] = bytes(row['pubkey']).hex()
+    return row
+
+
+def db_values(data, cols):
+    """Returns a tuple of the values in dict `data` of the given columns, converted to database
+    values (i.e. with the pubkey converted to binary)."""
+    return tuple(pubkey_bin(data[c]) if c == 'pubkey' else data[c] for c in cols)
+
 
 class ServiceNode:
     _data = None
     _state = None
+    _net = None
     testnet = False
-    def __init__(self, data=None, snid=None, pubkey=None, uid=None):
+    def __init__(self, data=None, snid=None, pubkey=None, uid=None, copy=True):
         """
         Constructs a ServiceNode object.  Can take a data dict (which typically contains all the
         fields fetched from a row of the service_nodes table, but must contain at least pubkey), or
-        a (pubkey or snid) + uid pair to do the query during construction.
+        a (pubkey or snid) + uid pair to do the query during construction.  If `copy` is False then
+        a given data dict is used directly (and updated by update() and insert()) instead of copied.
+
+        The pubkey may be given in either hex or binary (e.g. straight from the database) form;
+        sn['pubkey'] is always the hex pubkey, while binary_pubkey() gives the binary pubkey.
+
+        The SN's network state comes from the pinned (or else the current) network snapshot as of
+        construction; see snapshot.get().
         """
         if data:
             if 'pubkey' not in data:
                 raise RuntimeError("Given service node data is invalid")
-            self._data = dict(data)
+            self._data = dict(data) if copy else data
         elif uid and (snid or pubkey):
             cur = pgsql.dict_cursor()
             key = 'id' if snid else 'pubkey'
-            cur.execute('SELECT * FROM service_nodes WHERE ' + key + ' = %s AND uid = %s', (snid or pubkey, uid))
+            cur.execute('SELECT * FROM service_nodes WHERE ' + key + ' = %s AND uid = %s', (snid or pubkey_bin(pubkey), uid))
             data = cur.fetchone()
             if data:
                 self._data = dict(data)
@@ -43,21 +126,37 @@ class ServiceNode:
         else:
             raise RuntimeError("Invalid arguments: either 'data' or 'pubkey'/'uid' arguments must be supplied")
 
-        try:
-            self._state = lokisnbot.sn_states[self._data['pubkey']]
-        except KeyError:
+        self._pubkey = pubkey_bin(self._data['pubkey'])
+        if not isinstance(self._data['pubkey'], str):
+            self._data['pubkey'] = self._pubkey.hex()
+
+        snap = snapshot.get()
+        refreshed = refresh.cached(self._pubkey)
+        if refreshed:
+            self.testnet, self._state = refreshed
+        else:
             try:
-                self._state = lokisnbot.testnet_sn_states[self._data['pubkey']]
-                self.testnet = True
+                self._state = snap.mainnet.states[self._pubkey]
             except KeyError:
-                self._state = None
+                try:
+                    self._state = snap.testnet.states[self._pubkey]
+                    self.testnet = True
+                except KeyError:
+                    self._state = None
+        self._net = snap.network(self.testnet)
 
         if all(x in self._data for x in ('testnet', 'id', 'uid')) and self._state and self.testnet != self._data['testnet']:
             pgsql.cursor().execute("UPDATE service_nodes SET testnet = %s WHERE id = %s AND uid = %s",
                     (self.testnet, self._data['id'], self._data['uid']))
 
     @staticmethod
-    def all(uid, sortkey=lambda sn: (sn['testnet'], sn['alias'] is None, sn['alias'] or sn['pubkey'])):
+    def default_sortkey(sn):
+        """Default SN list ordering: mainnet first, then aliased SNs by alias, then the rest by pubkey"""
+        return (sn['testnet'], sn['alias'] is None, sn['alias'] or sn['pubkey'])
+
+
+    @staticmethod
+    def all(uid, sortkey=default_sortkey.__func__):
         cur = pgsql.dict_cursor()
         cur.execute("SELECT * FROM service_nodes WHERE uid = %s", (uid,))
         sns = []
@@ -68,12 +167,99 @@ class ServiceNode:
         return sns
 
 
+    @staticmethod
+    def monitoring(uid):
+        """Returns whether the user has any (non-archived) service node subscriptions"""
+        cur = pgsql.cursor()
+        cur.execute("SELECT EXISTS(SELECT 1 FROM service_nodes WHERE uid = %s AND NOT archived)", (uid,))
+        return cur.fetchone()[0]
+
+
+    @staticmethod
+    def all_by_pubkeys(uid, pubkeys):
+        """Looks up all of the given pubkeys for a user with a single query.  Returns a dict of
+        pubkey: ServiceNode for the pubkeys that the user is monitoring (others are omitted)."""
+        cur = pgsql.dict_cursor()
+        cur.execute("SELECT * FROM service_nodes WHERE uid = %s AND pubkey = ANY(%s)", (uid, [pubkey_bin(pk) for pk in pubkeys]))
+        sns = (ServiceNode(row) for row in cur)
+        return { sn['pubkey']: sn for sn in sns }
+
+
+    @staticmethod
+    def insert_many(sns):
+        """Bulk version of insert(): stores all the given ServiceNodes using a single multi-row
+        INSERT.  Every SN must have been constructed with the same set of data keys, which must all
+        be database columns, and must have a distinct uid/pubkey pair.  As with insert(), the
+        objects get updated with the values as actually stored in the database."""
+        if not sns:
+            return
+        cols = list(sns[0]._data.keys())
+        if 'uid' not in cols or 'pubkey' not in cols:
+            raise RuntimeError("Cannot insert SN rows without a uid and pubkey")
+        vals = []
+        for sn in sns:
+            if 'id' in sn._data:
+                raise RuntimeError("SN is already stored")
+            if sn._data.keys() != sns[0]._data.keys():
+                raise RuntimeError("Cannot bulk insert SNs with different data keys")
+            vals.append(db_values(sn._data, cols))
+        cur = pgsql.dict_cursor()
+        rows = psycopg2.extras.execute_values(cur, "INSERT INTO service_nodes ("+', '.join(cols)+") VALUES %s RETURNING *",
+                vals, page_size=len(vals), fetch=True)
+        by_pubkey = { (sn._data['uid'], sn._data['pubkey']): sn for sn in sns }
+        for row in rows:
+            row = db_row(row)
+            by_pubkey[(row['uid'], row['pubkey'])]._data.update(row)
+
+
+    @staticmethod
+    def update_all(uid, sortkey=default_sortkey.__func__, **kwargs):
+        """Bulk version of update(): sets one or more columns on all of a user's service nodes with
+        a single UPDATE, skipping rows that already have the given values.  Returns a list of
+        ServiceNodes (containing just the id, alias, pubkey, and testnet values) of the rows that
+        were actually changed, sorted by `sortkey`."""
+        if not kwargs:
+            raise RuntimeError("update_all requires at least one column to update")
+        if 'id' in kwargs or 'uid' in kwargs:
+            raise RuntimeError("Can't bulk update internal id/uid!")
+        keys = list(kwargs.keys())
+        vals = db_values(kwargs, keys)
+        cur = pgsql.dict_cursor()
+        cur.execute("UPDATE service_nodes SET " + ", ".join(k + " = %s" for k in keys) + " WHERE uid = %s AND (" +
+                " OR ".join(k + " IS DISTINCT FROM %s" for k in keys) + ") RETURNING id, alias, pubkey, testnet",
+                vals + (uid,) + vals)
+        sns = [ServiceNode(row) for row in cur]
+        if sortkey:
+            sns.sort(key=sortkey)
+        return sns
+
+
+    @staticmethod
+    def archive_deregistered(before):
+        """Archives all subscriptions for SNs that were deregistered (and notified about) before the
+        given timestamp.  Archived rows are skipped by the updater's regular polling (but remain
+        monitored: see revive()).  Returns the number of archived rows."""
+        cur = pgsql.cursor()
+        cur.execute("UPDATE service_nodes SET archived = TRUE WHERE NOT archived AND NOT active AND notified_dereg"
+                " AND COALESCE(deregistered_at, 0) <= %s", (before,))
+        return cur.rowcount
+
+
+    @staticmethod
+    def revive(pubkeys):
+        """Un-archives any archived subscriptions of the given pubkeys; this is called for pubkeys
+        that (re-)appear on the network.  Returns the number of revived rows."""
+        cur = pgsql.cursor()
+        cur.execute("UPDATE service_nodes SET archived = FALSE WHERE archived AND pubkey = ANY(%s)", ([pubkey_bin(pk) for pk in pubkeys],))
+        return cur.rowcount
+
+
     @staticmethod
     def pubkey_from_alias(uid, alias):
         cur = pgsql.dict_cursor()
         cur.execute("SELECT pubkey FROM service_nodes WHERE uid = %s AND alias = %s", (uid,alias))
         data = cur.fetchone()
-        return data[0] if data else None
+        return bytes(data[0]).hex() if data else None
 
 
     def __getitem__(self, key):
@@ -84,6 +270,11 @@ class ServiceNode:
         return key in self._data
 
 
+    def binary_pubkey(self):
+        """Returns the pubkey as bytes (as used in the database and network state dicts)"""
+        return self._pubkey
+
+
     def active(self):
         """Returns true if this is a known SN on either mainnet or testnet"""
         return self._state is not None
@@ -121,16 +312,13 @@ class ServiceNode:
             raise RuntimeError('Unable to update an non-stored service node record')
         if 'id' in kwargs:
             raise RuntimeError("Can't update internal id!")
-        keys, vals = [], []
-        for k, v in kwargs.items():
-            keys.append(k)
-            vals.append(v)
-        vals += (self._data['id'], self._data['uid'])
+        keys = list(kwargs.keys())
+        vals = db_values(kwargs, keys) + (self._data['id'], self._data['uid'])
         cur = pgsql.dict_cursor()
         cur.execute("UPDATE service_nodes SET " + ", ".join(k + " = %s" for k in keys) + " WHERE id = %s AND uid = %s" +
                 " RETURNING " + ", ".join(keys), tuple(vals))
 
-        self._data.update(cur.fetchone())
+        self._data.update(db_row(cur.fetchone()))
 
 
     def delete(self):
@@ -151,17 +339,11 @@ class ServiceNode:
             raise RuntimeError("SN is already stored")
         if 'uid' not in self._data or 'pubkey' not in self._data:
             raise RuntimeError("Cannot insert a SN row without a uid and pubkey")
-        cols, vals = [], []
-        for c, v in self._data.items():
-            if c in exclude:
-                continue
-            cols.append(c)
-            vals.append(v)
-        cols = ', '.join(cols)
-        vals = tuple(vals)
+        cols = [c for c in self._data.keys() if c not in exclude]
+        vals = db_values(self._data, cols)
         cur = pgsql.dict_cursor()
-        cur.execute("INSERT INTO service_nodes ("+cols+") VALUES %s RETURNING *", (vals,))
-        self._data.update(cur.fetchone())
+        cur.execute("INSERT INTO service_nodes ("+', '.join(cols)+") VALUES %s RETURNING *", (vals,))
+        self._data.update(db_row(cur.fetchone()))
 
 
     def shortpub(self):
@@ -179,26 +361,20 @@ class ServiceNode:
         return self._state['portions_for_operator'] / 18446744073709551612. if self.active() else None
 
 
+    def reward_split(self, snreward):
+        """Returns the contributor shares of a reward of `snreward` atomic OXEN earned by this SN
+        (see split_reward())"""
+        return split_reward(self._state, snreward)
+
+
     def lokinet_snode_addr(self):
         """Returns the lokinet snode address"""
         if 'pubkey_ed25519' not in self._state:
             return None
-        pk_hex = self._state['pubkey_ed25519']
-        if not pk_hex or len(pk_hex) != 64:
-            return None
-        bits = 0
-        val = 0
-        result = ''
-        for x in pk_hex:
-            bits += 4
-            val = (val << 4) + int(x, 16)
-            if bits >= 5:
-                bits -= 5
-                v = val >> bits
-                val &= (1 << bits) - 1
-                result += base32z_dict[v]
-        result += base32z_dict[val << (5 - bits)]
-        return result + ".snode"
+        cached = self._net.lokinet_addrs.get(self._pubkey)
+        if cached and cached[0] == self._state['pubkey_ed25519']:
+            return cached[1]
+        return lokinet_snode_addrs((self._state['pubkey_ed25519'],))[0]
 
 
     def proof_age(self):
@@ -302,11 +478,7 @@ class ServiceNode:
         block = self.expiry_block()
         if not block:
             return None
-        elif self.testnet:
-            height = lokisnbot.testnet_network_info['height']
-        else:
-            height = lokisnbot.network_info['height']
-        return (block - height + 1) * AVERAGE_BLOCK_SECONDS
+        return (block - self._net.height + 1) * AVERAGE_BLOCK_SECONDS
 
 
     def expires_soon(self):
@@ -0,0 +1,101 @@
+# Network snapshots.  Each poll the updater builds an immutable Snapshot of each network (its
+# get_info, service node states and lokinet addresses, all from that one poll) and publishes both
+# networks together by replacing `current`, a single reference that readers pick up without any
+# locking.  Request handlers pin the snapshot that was current when the request started (see pin())
+# so that everything a request looks at, including the ServiceNode objects it constructs, comes
+# from the same poll even if the updater publishes a new one partway through.
+
+import contextvars
+import itertools
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+
+class Snapshot:
+    """The state of one network as of one poll.  Snapshots are never modified once published, and
+    their dicts are shared by every reader, so must be treated as read-only.
+
+    `generation` is unique to each published snapshot, and so is usable as the cache key for
+    anything derived from it; derived data that should live exactly as long as the snapshot can
+    also be kept with it via index()."""
+
+    __slots__ = ('testnet', 'generation', 'fetched_at', 'info', 'height', 'states', 'lokinet_addrs', '_indexes', '_lock')
+
+    def __init__(self, testnet, generation, fetched_at, info, states, lokinet_addrs):
+        self.testnet = testnet
+        self.generation = generation
+        self.fetched_at = fetched_at
+        self.info = info
+        self.height = info['height'] if info else None
+        self.states = states
+        self.lokinet_addrs = lokinet_addrs
+        self._indexes = {}
+        self._lock = threading.RLock()  # Reentrant: an index may be built from other indexes
+
+    def index(self, name, build):
+        """Returns the derived index `name` of this snapshot, calling `build(snapshot)` to build it
+        the first time it is needed."""
+        try:
+            return self._indexes[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._indexes:
+                self._indexes[name] = build(self)
+            return self._indexes[name]
+
+
+class Networks(namedtuple('Networks', ('mainnet', 'testnet'))):
+    """The mainnet and testnet snapshots published together by one update"""
+
+    def network(self, testnet):
+        return self.testnet if testnet else self.mainnet
+
+
+_generations = itertools.count(1)
+
+# The latest published snapshots.  Generation 0 is the empty placeholder used until the first poll.
+current = Networks(Snapshot(False, 0, 0, {}, {}, {}), Snapshot(True, 0, 0, {}, {}, {}))
+
+_pinned = contextvars.ContextVar('lokisnbot_snapshot', default=None)
+
+
+def publish(mainnet, testnet=None, fetched_at=None):
+    """Builds and publishes new snapshots from (info, states, lokinet_addrs) tuples for mainnet and
+    (optionally) testnet; if testnet is None the previous testnet snapshot is kept.  Returns the
+    new Networks."""
+    global current
+    if fetched_at is None:
+        fetched_at = time.time()
+    prev = current
+    new = Networks(
+            Snapshot(False, next(_generations), fetched_at, *mainnet),
+            Snapshot(True, next(_generations), fetched_at, *testnet) if testnet else prev.testnet)
+    current = new
+    return new
+
+
+def get():
+    """Returns the Networks pinned by the current request (or updater pass), if any, otherwise the
+    latest published ones"""
+    return _pinned.get() or current
+
+
+@contextmanager
+def pin(networks=None):
+    """Context manager that makes get() return `networks` (default: the current ones) within the
+    block.  The pin is per thread (and per asyncio task)."""
+    token = _pinned.set(networks or current)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def hold(networks=None):
+    """Like pin(), but for the rest of the current asyncio task (or thread) rather than a block;
+    used for Discord commands, which each run in their own task, and by the updater thread for the
+    snapshots it just published."""
+    _pinned.set(networks or current)
@@ -0,0 +1,208 @@
+# Set-based subscription evaluation.  This is an alternative to evaluating every subscription one
+# at a time in Python (see alerts.check()): the current network state of every node gets bulk
+# loaded into the sn_snapshot staging table, and then a handful of UPDATE statements each find (and
+# mark as notified) all the subscriptions needing one kind of alert.  Only the rows that need a
+# message come back to Python.  Enabled with the SQL_EVALUATOR config option.
+#
+# Subscriptions are marked as notified before the messages go out; if a message can't be delivered
+# the row's previous values get put back so that it is retried next time, just as with alerts.check().
+
+import io
+
+import lokisnbot
+from . import pgsql
+from . import alerts
+from . import history
+from .constants import *
+from .servicenode import ServiceNode
+
+SNAPSHOT_COLUMNS = ('pubkey', 'testnet', 'height', 'active', 'staked', 'infinite', 'expiry_block', 'expires_in',
+        'expiry_threshold', 'last_uptime_proof', 'earned_downtime_blocks', 'version', 'last_reward_block_height',
+        'state_height', 'requested_unlock_height', 'registration_height', 'total_contributed', 'staking_requirement')
+
+# The proof age (in whole seconds, like ServiceNode.proof_age()) of a joined snapshot row
+AGE = "floor(%(now)s - s.last_uptime_proof)::bigint"
+# Whether a joined snapshot row has a (non-zero) version
+VERSION = "(s.version IS NOT NULL AND s.version > '{0,0,0}'::smallint[])"
+
+
+def _copy_value(v):
+    """Formats a value for COPY's text format"""
+    if v is None:
+        return '\\N'
+    elif isinstance(v, bool):
+        return 't' if v else 'f'
+    elif isinstance(v, bytes):
+        return '\\\\x' + v.hex()
+    elif isinstance(v, (list, tuple)):
+        return '{' + ','.join(str(int(x)) for x in v) + '}'
+    return str(int(v))
+
+
+def _snapshot_row(pubkey, x, testnet, height):
+    staked = x['total_contributed'] >= x['staking_requirement']
+    infinite = x['registration_height'] >= (TESTNET_INFINITE_FROM if testnet else INFINITE_FROM)
+    if infinite:
+        expiry_block = x['requested_unlock_height'] or None
+    else:
+        expiry_block = x['registration_height'] + (TESTNET_STAKE_BLOCKS if testnet else STAKE_BLOCKS)
+    expires_in, threshold = None, None
+    if expiry_block:
+        expires_in = (expiry_block - height + 1) * AVERAGE_BLOCK_SECONDS
+        threshold = next((int(t*3600) for t in (lokisnbot.config.TESTNET_EXPIRY_THRESHOLDS if testnet else lokisnbot.config.EXPIRY_THRESHOLDS)
+            if expires_in <= t*3600), None)
+    return (pubkey, testnet, height, x.get('active', True), staked, infinite, expiry_block, expires_in, threshold,
+            x.get('last_uptime_proof'), x.get('earned_downtime_blocks'), x.get('service_node_version'),
+            x['last_reward_block_height'], x.get('state_height'), x['requested_unlock_height'], x['registration_height'],
+            x['total_contributed'], x['staking_requirement'])
+
+
+def load_snapshot(networks):
+    """Replaces the contents of the sn_snapshot staging table with the given networks' node states.
+    `networks` is a sequence of (testnet, {pubkey: state}, height) tuples."""
+    buf = io.StringIO()
+    for testnet, states, height in networks:
+        for pubkey, x in states.items():
+            buf.write('\t'.join(_copy_value(v) for v in _snapshot_row(pubkey, x, testnet, height)))
+            buf.write('\n')
+    buf.seek(0)
+    cur = pgsql.cursor()
+    cur.execute("TRUNCATE sn_snapshot")
+    cur.copy_expert("COPY sn_snapshot (" + ", ".join(SNAPSHOT_COLUMNS) + ") FROM STDIN", buf)
+    cur.execute("ANALYZE sn_snapshot")
+
+
+def _update(where, sets, params, gone=False):
+    """Runs a single UPDATE that sets the `sets` columns (a dict of column: SQL expression) of all
+    subscriptions matching `where`, and returns a list of dicts of the updated rows (new values) plus
+    the user's chat ids and the previous values of the updated columns (as old_COLUMN).
+
+    The expressions can refer to the subscription as `sn` and, unless `gone` is given, to its node's
+    snapshot row as `s`.  With `gone`, only subscriptions of nodes that are not in the snapshot at
+    all are considered."""
+    cols = list(sets.keys())
+    if gone:
+        source = "service_nodes sn WHERE NOT EXISTS (SELECT 1 FROM sn_snapshot s WHERE s.pubkey = sn.pubkey) AND (NOT sn.testnet OR %(testnet)s) AND"
+    else:
+        source = "service_nodes sn JOIN sn_snapshot s ON s.pubkey = sn.pubkey WHERE"
+    cur = pgsql.dict_cursor()
+    cur.execute(
+            "WITH old AS (SELECT sn.id, " + ", ".join("sn." + c for c in cols) + " FROM " + source + " NOT sn.archived AND (" + where + ")"
+            " FOR UPDATE OF sn) "
+            "UPDATE service_nodes sn SET " + ", ".join(c + " = " + e for c, e in sets.items()) +
+            " FROM old, users u" + ("" if gone else ", sn_snapshot s") + " WHERE sn.id = old.id AND u.id = sn.uid" + ("" if gone else " AND s.pubkey = sn.pubkey") +
+            " RETURNING sn.*, u.telegram_id, u.discord_id, " + ", ".join("old." + c + " AS old_" + c for c in cols),
+            params)
+    return [dict(row) for row in cur]
+
+
+def _alert(notify, rows, cols, message, is_update=True):
+    """Sends `message(sn, row)` for each of the rows returned by _update(), putting back the
+    previous values of `cols` for any that can't be delivered.  Returns the ServiceNodes."""
+    sns = []
+    for row in rows:
+        sn = ServiceNode(row)
+        msg = message(sn, row)
+        if msg and not notify(sn, msg, is_update=is_update):
+            sn.update(**{ c: row['old_' + c] for c in cols })
+        sns.append(sn)
+    return sns
+
+
+def evaluate(networks, notify, now, wallets, expected_dereg_height):
+    """Evaluates all (non-archived) subscriptions against the given networks' node states, sending
+    alerts through `notify`.  Arguments are as for load_snapshot() and alerts.check()."""
+    load_snapshot(networks)
+    heights = { testnet: height for testnet, states, height in networks }
+    config = lokisnbot.config
+    params = { 'now': now, 'testnet': True in heights, 'warning': PROOF_AGE_WARNING, 'repeat': PROOF_AGE_REPEAT,
+            'warn_version': config.WARN_VERSION_LESS_THAN if config.WARN_VERSION_MSG else None }
+
+    def run(where, sets, message=None, is_update=True, gone=False):
+        rows = _update(where, sets, params, gone=gone)
+        if message:
+            return _alert(notify, rows, list(sets.keys()), message, is_update)
+        return rows
+
+    # Deregistrations (and SNs that are back on the network):
+    run("NOT sn.notified_dereg",
+            { 'active': 'FALSE', 'notified_dereg': 'TRUE', 'complete': 'FALSE', 'last_contributions': '0', 'expiry_notified': 'NULL',
+                'deregistered_at': 'floor(%(now)s)::bigint' },
+            lambda sn, row: alerts.dereg_msg(sn, 0 < expected_dereg_height.get(sn.binary_pubkey(), 0) <= heights.get(row['testnet'], 0)),
+            gone=True)
+    run("sn.notified_dereg AND sn.active", { 'active': 'FALSE' }, gone=True)
+    run("sn.notified_dereg OR NOT sn.active", { 'active': 'TRUE', 'notified_dereg': 'FALSE' })
+
+    # Decommissions and recommissions:
+    run("s.staked AND NOT s.active AND (COALESCE(sn.notified_decomm, 0) = 0 OR sn.notified_decomm + 3600 <= %(now)s)",
+            { 'notified_decomm': '%(now)s' }, lambda sn, row: alerts.decomm_msg(sn))
+    run("s.staked AND s.active AND sn.notified_decomm <> 0",
+            { 'notified_decomm': 'NULL' }, lambda sn, row: alerts.recomm_msg(sn))
+
+    # Uptime proof age.  As in alerts.check(), a node that keeps going just over the threshold gets
+    # a single "unstable" alert (per FLAP_WINDOW) instead of a warning, unless the proof gets really
+    # old; the flapping nodes (from the proof history) are found here and passed in:
+    unstable = {}
+    for testnet, states, height in networks:
+        for pubkey, x in states.items():
+            if x.get('last_uptime_proof') and PROOF_AGE_WARNING <= int(now - x['last_uptime_proof']) < UNSTABLE_PROOF_AGE:
+                stats = history.flapping(pubkey, now)
+                if stats:
+                    unstable[pubkey] = stats
+    params.update(unstable=list(unstable), unstable_age=UNSTABLE_PROOF_AGE, flap_window=FLAP_WINDOW)
+    flapping = "COALESCE(sn.notified_age, 0) = 0 AND " + AGE + " < %(unstable_age)s AND s.pubkey = ANY(%(unstable)s::bytea[])"
+    run("COALESCE(s.last_uptime_proof, 0) <> 0 AND " + AGE + " >= %(warning)s AND " + flapping + " AND "
+            "(COALESCE(sn.notified_unstable, 0) = 0 OR sn.notified_unstable + %(flap_window)s <= %(now)s)",
+            { 'notified_unstable': 'floor(%(now)s)::bigint' }, lambda sn, row: alerts.unstable_msg(sn, unstable[sn.binary_pubkey()]))
+    run("COALESCE(s.last_uptime_proof, 0) <> 0 AND " + AGE + " >= %(warning)s AND NOT (" + flapping + ") AND "
+            "(COALESCE(sn.notified_age, 0) = 0 OR " + AGE + " - sn.notified_age > %(repeat)s)",
+            { 'notified_age': AGE }, lambda sn, row: alerts.proof_age_msg(sn))
+    run("COALESCE(s.last_uptime_proof, 0) <> 0 AND " + AGE + " < %(warning)s AND sn.notified_age <> 0",
+            { 'notified_age': 'NULL' }, lambda sn, row: alerts.proof_received_msg(sn))
+
+    # Contributions:
+    run("NOT sn.complete AND (COALESCE(sn.last_contributions, 0) = 0 OR sn.last_contributions < s.total_contributed)",
+            { 'last_contributions': 's.total_contributed' }, lambda sn, row: alerts.contribution_msg(sn, not row['old_last_contributions']))
+    just_completed = [sn['id'] for sn in run("NOT sn.complete AND s.staked", { 'complete': 'TRUE' }, lambda sn, row: alerts.staked_msg(sn))]
+
+    # Stake unlocks:
+    run("s.infinite AND s.expiry_block IS NULL AND (sn.requested_unlock_height IS NOT NULL OR sn.unlock_notified)",
+            { 'requested_unlock_height': 'NULL', 'unlock_notified': 'FALSE' })
+    run("s.infinite AND s.expiry_block IS NOT NULL AND NOT sn.unlock_notified",
+            { 'unlock_notified': 'TRUE', 'requested_unlock_height': 's.expiry_block' },
+            lambda sn, row: alerts.unlock_msg(sn, row['requested_unlock_height'], heights[sn.testnet]))
+
+    # Versions:
+    obsolete = "s.version < %(warn_version)s::smallint[]" if params['warn_version'] else "FALSE"
+    run(VERSION + " AND " + obsolete + " AND (COALESCE(sn.notified_obsolete, 0) = 0 OR sn.notified_obsolete + 86400 <= %(now)s)",
+            { 'notified_obsolete': '%(now)s' }, lambda sn, row: alerts.obsolete_msg(sn))
+    run(VERSION + " AND NOT " + obsolete + " AND sn.notified_obsolete <> 0",
+            { 'notified_obsolete': 'NULL' }, lambda sn, row: alerts.upgraded_msg(sn))
+    run(VERSION + " AND sn.last_version > '{0,0,0}'::smallint[] AND s.version <> sn.last_version",
+            { 'last_version': 's.version' }, lambda sn, row: alerts.version_change_msg(sn, row['old_last_version']))
+    run(VERSION + " AND (sn.last_version IS NULL OR sn.last_version <= '{0,0,0}'::smallint[]) AND s.version IS DISTINCT FROM sn.last_version",
+            { 'last_version': 's.version' })
+    run("array_length(s.version, 1) = 3 AND s.version BETWEEN '{3,0,0}'::smallint[] AND '{3,0,5}'::smallint[] AND "
+            "(COALESCE(sn.notified_v305, 0) = 0 OR sn.notified_v305 + 86400 <= %(now)s)",
+            { 'notified_v305': '%(now)s' }, lambda sn, row: alerts.v305_msg(sn))
+
+    # Expiries:
+    run("sn.expires_soon AND s.infinite AND s.expiry_block IS NULL AND sn.expiry_notified <> 0",
+            { 'expiry_notified': 'NULL' })
+    run("sn.expires_soon AND s.expiry_threshold <> 0 AND (COALESCE(sn.expiry_notified, 0) = 0 OR sn.expiry_notified > s.expiry_threshold)",
+            { 'expiry_notified': 's.expiry_threshold' }, lambda sn, row: alerts.expiry_msg(sn, sn.expires_in(), sn.expiry_block()))
+    run("sn.expires_soon AND s.expiry_block IS NOT NULL AND s.expiry_threshold IS NULL AND sn.expiry_notified <> 0",
+            { 'expiry_notified': 'NULL' })
+
+    # Rewards:
+    params['just_completed'] = just_completed
+    run("COALESCE(sn.last_reward_block_height, 0) = 0 AND s.last_reward_block_height IS DISTINCT FROM sn.last_reward_block_height",
+            { 'last_reward_block_height': 's.last_reward_block_height' })
+    run("sn.last_reward_block_height <> 0 AND s.last_reward_block_height > sn.last_reward_block_height AND sn.rewards"
+            " AND s.last_reward_block_height > s.state_height AND s.staked AND NOT sn.id = ANY(%(just_completed)s)",
+            { 'last_reward_block_height': 's.last_reward_block_height' },
+            lambda sn, row: alerts.reward_msg(sn, row['last_reward_block_height'], wallets.get(sn['uid'])), is_update=False)
+    # Rewards that don't get an alert (but not ones whose alert couldn't be delivered just above):
+    run("sn.last_reward_block_height <> 0 AND s.last_reward_block_height > sn.last_reward_block_height AND (NOT sn.rewards"
+            " OR s.state_height IS NULL OR s.last_reward_block_height <= s.state_height OR NOT s.staked OR sn.id = ANY(%(just_completed)s))",
+            { 'last_reward_block_height': 's.last_reward_block_height' })
@@ -2,14 +2,16 @@
 
 import re
 import math
+import functools
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, Update, ChatAction, ForceReply
-from telegram.ext import Updater, Dispatcher, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, CallbackContext
-from telegram.ext.dispatcher import run_async
+from telegram import (InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, Update, ChatAction, ForceReply,
+        InlineQueryResultArticle, InputTextMessageContent)
+from telegram.ext import Updater, Dispatcher, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, CallbackContext, InlineQueryHandler
+from telegram.ext.dispatcher import run_async as ptb_run_async
 from telegram.error import TelegramError, BadRequest
 
 import lokisnbot
-from . import pgsql
+from . import pgsql, uidcache, snapshot, lookup
 from .constants import *
 from .util import friendly_time, ago, explorer, escape_markdown
 from .servicenode import ServiceNode
@@ -17,6 +19,17 @@ from .network import Network, NetworkContext
 
 
 
+def run_async(method):
+    """Like telegram's run_async, but keeps the context's network snapshot pinned in the worker
+    thread that the method gets run in"""
+    @ptb_run_async
+    @functools.wraps(method)
+    def pinned(self, *args, **kwargs):
+        with snapshot.pin(self.snap):
+            return method(self, *args, **kwargs)
+    return pinned
+
+
 def common_symbol(all_sns):
     more_sym = ''
     for sn in all_sns:
@@ -30,6 +43,7 @@ class TelegramContext(NetworkContext):
     def __init__(self, update: Update, context: CallbackContext):
         self.update = update
         self.context = context
+        self._snap = snapshot.current
 
 
     @staticmethod
@@ -77,17 +91,7 @@ class TelegramContext(NetworkContext):
 
     def get_uid(self):
         """Returns the user id in the pg database; creates one if not already found"""
-        if 'uid' not in self.context.user_data:
-            cur = pgsql.cursor()
-            cur.execute("SELECT id FROM users WHERE telegram_id = %s", (self.update.effective_user.id,))
-            row = cur.fetchone()
-            if row is None:
-                cur.execute("INSERT INTO users (telegram_id) VALUES (%s) RETURNING id", (self.update.effective_user.id,))
-                row = cur.fetchone()
-            if row is None:
-                return None
-            self.context.user_data['uid'] = row[0]
-        return self.context.user_data['uid']
+        return uidcache.get('telegram', self.update.effective_user.id)
 
 
     def want(self):
@@ -127,7 +131,7 @@ class TelegramContext(NetworkContext):
         if last_button:
             choices.append([last_button])
         else:
-            choices.append([InlineKeyboardButton('Status', callback_data='status')])
+            choices.append([InlineKeyboardButton('Status', callback_data='status'), InlineKeyboardButton('Open nodes', callback_data='open:room,0,0')])
             if lokisnbot.config.DONATION_ADDR:
                 choices[-1].append(InlineKeyboardButton('Donate', callback_data='donate'))
 
@@ -176,12 +180,14 @@ class TelegramContext(NetworkContext):
         elif self.is_wallet(wallet, mainnet=False, testnet=True):
             self.context.bot.send_chat_action(chat_id=self.update.message.chat_id, action=ChatAction.UPLOAD_DOCUMENT)
 
-            tx = self.send_faucet_tx(wallet)
-            if tx:
-                tx_hash = tx['tx_hash']
+            def sent(tx_hash, error):
+                if error:
+                    return self.faucet_error(error)
                 self.send_reply(dead_end=True, message='💸 Sent you {:.9f} testnet OXEN in {}'.format(
                     lokisnbot.config.TESTNET_FAUCET_AMOUNT/COIN, '['+tx_hash[0:8]+'...](https://'+lokisnbot.config.TESTNET_EXPLORER+'/tx/'+tx_hash+')'))
 
+            self.send_faucet_tx(wallet, sent)
+
         else:
             self.send_reply(
                     '{} does not look like a valid OXEN testnet wallet address!  Please check the address and send it again (use /start to cancel):'.format(wallet),
@@ -241,6 +247,9 @@ class TelegramContext(NetworkContext):
 
         buttons.append([InlineKeyboardButton('Add a service node', callback_data='add_sn'),
             InlineKeyboardButton('Show versions/expiries/proofs', callback_data='sns_expiries')]);
+        buttons.append([InlineKeyboardButton('Show upcoming unlocks', callback_data='sns_unlocks')])
+        if lokisnbot.config.API_PORT:
+            buttons[-1].append(InlineKeyboardButton('API token', callback_data='api_token'))
         buttons.append([
             InlineKeyboardButton('Find unmonitored SNs', callback_data='find_unmonitored_sn'),
             InlineKeyboardButton('Disable reward notifications', callback_data='disable_rewards_all')
@@ -262,13 +271,13 @@ class TelegramContext(NetworkContext):
         uid = self.get_uid()
         sns = ServiceNode.all(uid, sortkey=lambda sn: (sn['testnet'], sn.expiry_block() or float("inf"), sn['alias'] or sn['pubkey']))
 
-        height = lokisnbot.network_info['height']
+        height = self.snap.mainnet.height
         msg = self.b('Service node versions, expirations & proofs:')+'\n'
         testnet = False
         for sn in sns:
             if not testnet and sn['testnet']:
                 msg += '\n'+self.b('Testnet service node versions, expirations & proofs:')+'\n'
-                height = lokisnbot.testnet_network_info['height']
+                height = self.snap.testnet.height
                 testnet = True
 
             msg += '{} {}: '.format(sn.status_icon(), sn.alias())
@@ -287,6 +296,94 @@ class TelegramContext(NetworkContext):
         self.service_nodes_menu(reply_text=msg)
 
 
+    @run_async
+    def portfolio(self):
+        self.wallets_menu(reply_text=self.portfolio_msg())
+
+
+    @run_async
+    def earnings(self):
+        self.wallets_menu(reply_text=self.earnings_msg())
+
+
+    @run_async
+    def upcoming_unlocks(self):
+        self.service_nodes_menu(reply_text=self.upcoming_unlocks_msg())
+
+
+    @run_async
+    def inline_query(self):
+        """Answers an inline query (`@bot <alias or pubkey prefix>`) with a postable summary of each
+        matching service node.  (Anyone can use inline mode, so this doesn't create a user.)"""
+        query = self.update.inline_query
+        uid = uidcache.find('telegram', self.update.effective_user.id)
+        query.answer([self.inline_result(pubkey, alias) for pubkey, alias in lookup.search(self.snap, uid, query.query)],
+                cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+
+    def inline_result(self, pubkey, alias):
+        """Returns the inline query result for the given hex pubkey and alias.  Results are rendered
+        once per snapshot (and kept with the mainnet snapshot, keyed by the testnet generation)"""
+        return self.snap.mainnet.index(('inline', pubkey, alias, self.snap.testnet.generation),
+                lambda s: self.render_inline_result(pubkey, alias))
+
+
+    def render_inline_result(self, pubkey, alias):
+        sn = ServiceNode({ 'pubkey': pubkey, 'alias': alias })
+        if not sn.active():
+            status = 'not registered'
+        elif sn.decommissioned():
+            status = 'DECOMMISSIONED'
+        elif not sn.staked():
+            status = 'awaiting contributions ({:.1f}% staked)'.format(sn.state('total_contributed') / sn.state('staking_requirement') * 100)
+        else:
+            status = 'active'
+
+        text = '{} Service node {}{}\n`{}`\nStatus: {}\n'.format(sn.status_icon(), self.b(sn.alias()),
+                ' (' + self.b('testnet') + ')' if sn.testnet else '', pubkey, self.b(status))
+        description = status
+        if sn.active():
+            text += 'Last uptime proof: ' + sn.format_proof_age() + '\n'
+            verstr = sn.version_str()
+            text += 'Version: ' + (self.b(verstr) if verstr else 'unknown') + '\n'
+            if not (sn.infinite_stake() and sn.expiry_block() is None):
+                text += 'Expiry: block {} (approx. {})\n'.format(self.b(sn.expiry_block()), friendly_time(sn.expires_in()))
+            proof_age = sn.proof_age()
+            description += '; proof {}'.format(ago(proof_age) if proof_age is not None else 'never') + ('; v' + verstr if verstr else '')
+        return InlineQueryResultArticle(id=pubkey, title='{} {}'.format(sn.status_icon(), sn.alias()), description=description,
+                input_message_content=InputTextMessageContent(text, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True))
+
+
+    @run_async
+    def api_token(self, reset=False):
+        self.send_reply(self.api_token_msg(reset), reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton('Replace with a new token', callback_data='api_token_reset')],
+            [InlineKeyboardButton('< Service nodes', callback_data='sns'), InlineKeyboardButton('<< Main menu', callback_data='main')]]))
+
+
+    @run_async
+    def open_nodes(self, view=('room', False, 0)):
+        """Shows a page of the nodes awaiting contributions, with buttons to page, re-sort, and
+        toggle the low fee filter.  `view` is a (sort, low fee filter, page) tuple."""
+        sort, low_fee, page = view
+        msg, page, pages = self.open_nodes_msg(page, sort, max_fee=OPEN_NODES_LOW_FEE if low_fee else None)
+        query = lambda sort=sort, low_fee=low_fee, page=page: 'open:{},{},{}'.format(sort, int(low_fee), page)
+
+        buttons = []
+        if pages > 1:
+            buttons.append([])
+            if page > 0:
+                buttons[-1].append(InlineKeyboardButton('<< Previous', callback_data=query(page=page-1)))
+            if page < pages - 1:
+                buttons[-1].append(InlineKeyboardButton('Next >>', callback_data=query(page=page+1)))
+        buttons.append([InlineKeyboardButton(label, callback_data=query(sort=s, page=0))
+            for s, label in (('room', 'Most needed'), ('fee', 'Lowest fee'), ('newest', 'Newest')) if s != sort])
+        buttons.append([InlineKeyboardButton('Any fee' if low_fee else 'Fee ≤ {:g}%'.format(OPEN_NODES_LOW_FEE * 100),
+                callback_data=query(low_fee=not low_fee, page=0)),
+            InlineKeyboardButton('<< Main menu', callback_data='main')])
+        self.send_reply(msg, reply_markup=InlineKeyboardMarkup(buttons))
+
+
     @run_async
     def service_node_add(self):
         self.send_reply('Okay, send me the public key(s) of the service node(s) to add (use /start to cancel):', expect_reply=True)
@@ -294,19 +391,18 @@ class TelegramContext(NetworkContext):
 
 
     @run_async
-    def service_node_menu(self):
-        return self.service_node(snid=int(self.update.callback_query.data.split(':', 1)[1]))
+    def service_node_menu(self, snid):
+        return self.service_node(snid=snid)
 
 
     @run_async
-    def service_node_menu_inplace(self):
-        snid = self.update.callback_query.data.split(':', 1)[1]
+    def service_node_menu_inplace(self, snid):
         sn = None
         if snid == 'last':
             snid = None
             sn = ServiceNode({ 'pubkey': self.context.user_data['sn_last_viewed'] })
             del self.context.user_data['sn_last_viewed']
-        msg, sn = self.service_node(snid=snid, sn=sn, send=False)
+        msg, sn = self.service_node(snid=snid, sn=sn, send=False, fresh=True)
         try:
             self.context.bot.edit_message_text(
                     text=msg, parse_mode=ParseMode.MARKDOWN,
@@ -338,6 +434,7 @@ class TelegramContext(NetworkContext):
             snid = want_data
             alias = text.replace("*", "").replace("_", "").replace("[", "").replace("`", "")
             pgsql.cursor().execute("UPDATE service_nodes SET alias = %s WHERE id = %s AND uid = %s", (alias, snid, uid))
+            lookup.forget_aliases(uid)
             return self.service_node(snid=snid, reply_text="Okay, I'll now refer to service node "+self.i('{sn[pubkey]}')+' as '+self.i('{sn[alias]}')+'.  Current status:')
 
         elif want == 'wallet':
@@ -359,6 +456,8 @@ class TelegramContext(NetworkContext):
 
         if super().plain_input(text, add_sn=add_sn):
             self.expect(None)
+            if add_sn:
+                lookup.forget_aliases(uid)
         elif add_sn:
             self.send_reply(message="That doesn't look like a valid service node public key; please check the key(s) and try again: (use /start to cancel)", expect_reply=True)
         elif text == 'myid':
@@ -417,22 +516,21 @@ class TelegramContext(NetworkContext):
 
 
     @run_async
-    def stop_monitoring(self):
+    def stop_monitoring(self, snid):
         uid = self.get_uid()
-        snid = int(self.update.callback_query.data.split(':', 1)[1])
         try:
             sn = ServiceNode(snid=snid, uid=uid)
         except ValueError:
             return self.service_nodes_menu("I couldn't find that service node; please try again")
         sn.delete()
+        lookup.forget_aliases(uid)
         msg = "Okay, I'm no longer monitoring service node " + (
                 "_{}_ (_{}_)".format(sn['alias'], sn['pubkey']) if sn['alias'] else "_{}_".format(sn['pubkey'])) + " for you."
         return self.service_nodes_menu(msg)
 
 
-    def request_sn_field(self, field, send_fmt, current_fmt):
+    def request_sn_field(self, snid, field, send_fmt, current_fmt):
         uid = self.get_uid()
-        snid = int(self.update.callback_query.data.split(':', 1)[1])
         try:
             sn = ServiceNode(snid=snid, uid=uid)
         except ValueError:
@@ -445,9 +543,8 @@ class TelegramContext(NetworkContext):
         self.send_reply(msg, expect_reply=True)
 
 
-    def set_sn_field(self, field, value, success):
+    def set_sn_field(self, snid, field, value, success):
         uid = self.get_uid()
-        snid = int(self.update.callback_query.data.split(':', 1)[1])
         try:
             sn = ServiceNode(snid=snid, uid=uid)
         except ValueError:
@@ -459,76 +556,72 @@ class TelegramContext(NetworkContext):
 
 
     @run_async
-    def ask_note(self):
-        self.request_sn_field('note',
+    def ask_note(self, snid):
+        self.request_sn_field(snid, 'note',
                 "Send me a custom note to set for service node _{alias}_ (use /start to cancel).",
                 "The current note is: {escaped}")
 
 
     @run_async
-    def del_note(self):
-        self.set_sn_field('note', None, 'Removed note for service node _{}_.')
+    def del_note(self, snid):
+        self.set_sn_field(snid, 'note', None, 'Removed note for service node _{}_.')
 
 
     @run_async
-    def ask_alias(self):
-        self.request_sn_field('alias',
+    def ask_alias(self, snid):
+        self.request_sn_field(snid, 'alias',
                 "Send me an alias to use for this service node instead of the public key (_{sn[pubkey]}_).  Use /start to cancel.",
                 "The current alias is: {}")
 
 
     @run_async
-    def del_alias(self):
-        self.set_sn_field('alias', None, 'Removed alias for service node _{}_.')
+    def del_alias(self, snid):
+        self.set_sn_field(snid, 'alias', None, 'Removed alias for service node _{}_.')
+        lookup.forget_aliases(self.get_uid())
 
 
     @run_async
-    def enable_reward_notify(self):
-        self.set_sn_field('rewards', True,
+    def enable_reward_notify(self, snid):
+        self.set_sn_field(snid, 'rewards', True,
                 "Okay, I'll start sending you block reward notifications for _{}_.")
 
 
     @run_async
-    def disable_reward_notify(self):
-        self.set_sn_field('rewards', False,
+    def disable_reward_notify(self, snid):
+        self.set_sn_field(snid, 'rewards', False,
                 "Okay, I'll no longer send you block reward notifications for _{}_.")
 
 
     @run_async
     def enable_reward_notify_all(self):
-        uid = self.get_uid()
-        all_sns = ServiceNode.all(uid)
-        enabled_for = []
-        for sn in all_sns:
-            if not sn['rewards']:
-                sn.update(rewards=True)
-                enabled_for.append("_{}_".format(sn.alias()))
-
-        self.service_nodes_menu('Reward notification *enabled* for service nodes {}.'.format(", ".join(enabled_for)))
+        self.set_reward_notify_all(True)
 
 
     @run_async
     def disable_reward_notify_all(self):
-        uid = self.get_uid()
-        all_sns = ServiceNode.all(uid)
-        disabled_for = []
-        for sn in all_sns:
-            if sn['rewards']:
-                sn.update(rewards=False)
-                disabled_for.append("_{}_".format(sn.alias()))
+        self.set_reward_notify_all(False)
+
 
-        self.service_nodes_menu('Reward notification *disabled* for service nodes {}.'.format(", ".join(disabled_for)))
+    def set_reward_notify_all(self, enable):
+        uid = self.get_uid()
+        changed = ServiceNode.update_all(uid, rewards=enable)
+        if not changed and not ServiceNode.monitoring(uid):
+            return self.service_nodes_menu("Unable to do that: you aren't currently monitoring any service nodes!")
+        if not changed:
+            return self.service_nodes_menu('No service nodes needed to be changed.')
+        self.service_nodes_menu('Reward notification *{}* for service nodes {}.'.format('enabled' if enable else 'disabled',
+            ", ".join("_{}_".format(sn.alias()) for sn in changed)))
 
 
     @run_async
-    def enable_expires_soon(self):
-        self.set_sn_field('expires_soon', True,
+    def enable_expires_soon(self, snid):
+        self.set_sn_field(snid, 'expires_soon', True,
                 "Okay, I'll send you expiry notifications when _{}_ is close to expiry (48h, 24h, and 6h).")
 
 
     @run_async
-    def disable_expires_soon(self):
-        self.set_sn_field('expires_soon', False,
+    def disable_expires_soon(self, snid):
+        self.set_sn_field(snid, 'expires_soon', False,
                 "Okay, I'll stop sending you notifications when _{}_ is close to expiry.")
 
 
@@ -559,6 +652,8 @@ class TelegramContext(NetworkContext):
                 if self.get_user_field('auto_monitor') else
                 InlineKeyboardButton('Enable auto-monitoring', callback_data='enable_automon'),
                 ])
+            wallets.append([InlineKeyboardButton('Show portfolio', callback_data='portfolio'),
+                InlineKeyboardButton('Show earnings', callback_data='earnings')])
 
         wallets.append([InlineKeyboardButton('Add a wallet', callback_data='ask_wallet'),
             InlineKeyboardButton('<< Main menu', callback_data='main')])
@@ -574,9 +669,7 @@ class TelegramContext(NetworkContext):
 
 
     @run_async
-    def forget_wallet(self):
-        w = self.update.callback_query.data.split(':', 1)[1]
-
+    def forget_wallet(self, w):
         uid = self.get_uid()
         msgs = []
         remove = []
@@ -647,89 +740,131 @@ class TelegramContext(NetworkContext):
 
 
     @run_async
-    def dispatch_query(self):
-        q = self.update.callback_query.data
-        edit = True
-        call = None
-        if q == 'main':
-            call = self.start
-        elif q == 'sns':
-            call = self.service_nodes_menu
-        elif (match := re.match(r'sns_page(\d)', q)):
-            call = lambda: self.service_nodes_menu(page=int(match[1]))
-        elif q == 'sns_expiries':
-            call = self.service_nodes_expiries
-        elif q == 'status':
-            call = self.status
-        elif q == 'testnet_status':
-            call = self.testnet_status
-        elif q == 'testnet_faucet':
-            call = self.testnet_faucet
-        elif q == 'add_sn':
-            call = self.service_node_add
-        elif re.match(r'sn:\d+', q):
-            call = self.service_node_menu
-        elif re.match(r'refresh:(?:\d+|last)', q):
-            edit = False
-            call = self.service_node_menu_inplace
-        elif q == 'start:last':
-            call = self.start_monitoring
-        elif re.match(r'stop:\d+', q):
-            call = self.stop_monitoring
-        elif re.match(r'alias:\d+', q):
-            call = self.ask_alias
-        elif re.match(r'del_alias:\d+', q):
-            call = self.del_alias
-        elif re.match(r'note:\d+', q):
-            call = self.ask_note
-        elif re.match(r'del_note:\d+', q):
-            call = self.del_note
-        elif re.match(r'enable_reward:\d+', q):
-            call = self.enable_reward_notify
-        elif re.match(r'disable_reward:\d+', q):
-            call = self.disable_reward_notify
-        elif q == 'enable_rewards_all':
-            call = self.enable_reward_notify_all
-        elif q == 'disable_rewards_all':
-            call = self.disable_reward_notify_all
-        elif re.match(r'enable_expires_soon:\d+', q):
-            call = self.enable_expires_soon
-        elif re.match(r'disable_expires_soon:\d+', q):
-            call = self.disable_expires_soon
-        elif q == 'wallets':
-            call = self.wallets_menu
-        elif re.match(r'forget_wallet:\w+', q):
-            call = self.forget_wallet
-        elif q == 'ask_wallet':
-            call = self.ask_wallet
-        elif q == 'find_unmonitored':
-            call = self.find_unmonitored
-        elif q == 'find_unmonitored_sn':
-            call = lambda: self.find_unmonitored(self.service_nodes_menu)
-        elif q == 'enable_automon':
-            call = lambda: self.set_automon(True)
-        elif q == 'disable_automon':
-            call = lambda: self.set_automon(False)
-        elif q == 'donate':
-            call = self.donate
+    def remove_markup(self):
+        """Removes the inline buttons from the message containing the pressed button"""
+        try:
+            self.context.bot.edit_message_reply_markup(reply_markup=None,
+                    chat_id=self.update.callback_query.message.chat_id,
+                    message_id=self.update.callback_query.message.message_id)
+        except BadRequest as e:
+            if 'Message is not modified' in e.message:
+                pass
+            else:
+                raise
+
 
+    @run_async
+    def dispatch_query(self):
+        handler, args, edit = parse_query(self.update.callback_query.data) or (None, (), True)
         if edit:
-            try:
-                self.context.bot.edit_message_reply_markup(reply_markup=None,
-                        chat_id=self.update.callback_query.message.chat_id,
-                        message_id=self.update.callback_query.message.message_id)
-            except BadRequest as e:
-                if 'Message is not modified' in e.message:
-                    pass
-                else:
-                    raise
-        if call:
-            return call()
+            # Don't make the actual handler wait on this request:
+            self.remove_markup()
+        if handler:
+            return handler(self, *args)
+
+
+id_re = re.compile(r'\d+', re.ASCII)
+wallet_re = re.compile(r'\w+')
+
+def id_arg(arg):
+    """Callback query argument parser for a (numeric) SN row id"""
+    if not id_re.fullmatch(arg):
+        raise ValueError("Invalid id argument")
+    return int(arg)
+
+def last_arg(arg):
+    """Callback query argument parser for the `last` (i.e. last viewed) SN pseudo-id"""
+    if arg != 'last':
+        raise ValueError("Invalid last argument")
+    return arg
+
+def id_or_last_arg(arg):
+    return last_arg(arg) if arg == 'last' else id_arg(arg)
+
+open_re = re.compile(r'(room|fee|newest),([01]),(\d+)', re.ASCII)
+
+def open_arg(arg):
+    """Callback query argument parser for an open nodes `sort,lowfee,page` view"""
+    m = open_re.fullmatch(arg)
+    if not m:
+        raise ValueError("Invalid open nodes argument")
+    return (m[1], m[2] == '1', int(m[3]))
+
+def wallet_arg(arg):
+    if not wallet_re.fullmatch(arg):
+        raise ValueError("Invalid wallet argument")
+    return arg
+
+
+# Callback query data is a command name, optionally followed by either digits (e.g. `sns_page2`) or
+# by `:` and an argument (e.g. `sn:123`).  The command name maps to a (handler, argument parser,
+# remove_markup) route; the handler gets called with the context plus the parsed argument (if the
+# route takes one).  remove_markup controls whether the buttons get removed from the message with
+# the pressed button.
+query_re = re.compile(r'^([a-z_]+)(\d*)(?::(.*))?$', re.DOTALL)
+query_routes = {
+    'main': (TelegramContext.start, None, True),
+    'sns': (TelegramContext.service_nodes_menu, None, True),
+    'sns_page': (lambda c, page: c.service_nodes_menu(page=page), id_arg, True),
+    'sns_expiries': (TelegramContext.service_nodes_expiries, None, True),
+    'sns_unlocks': (TelegramContext.upcoming_unlocks, None, True),
+    'open': (TelegramContext.open_nodes, open_arg, True),
+    'api_token': (TelegramContext.api_token, None, True),
+    'api_token_reset': (lambda c: c.api_token(reset=True), None, True),
+    'status': (TelegramContext.status, None, True),
+    'testnet_status': (TelegramContext.testnet_status, None, True),
+    'testnet_faucet': (TelegramContext.testnet_faucet, None, True),
+    'add_sn': (TelegramContext.service_node_add, None, True),
+    'sn': (TelegramContext.service_node_menu, id_arg, True),
+    'refresh': (TelegramContext.service_node_menu_inplace, id_or_last_arg, False),
+    'start': (lambda c, last: c.start_monitoring(), last_arg, True),
+    'stop': (TelegramContext.stop_monitoring, id_arg, True),
+    'alias': (TelegramContext.ask_alias, id_arg, True),
+    'del_alias': (TelegramContext.del_alias, id_arg, True),
+    'note': (TelegramContext.ask_note, id_arg, True),
+    'del_note': (TelegramContext.del_note, id_arg, True),
+    'enable_reward': (TelegramContext.enable_reward_notify, id_arg, True),
+    'disable_reward': (TelegramContext.disable_reward_notify, id_arg, True),
+    'enable_rewards_all': (TelegramContext.enable_reward_notify_all, None, True),
+    'disable_rewards_all': (TelegramContext.disable_reward_notify_all, None, True),
+    'enable_expires_soon': (TelegramContext.enable_expires_soon, id_arg, True),
+    'disable_expires_soon': (TelegramContext.disable_expires_soon, id_arg, True),
+    'wallets': (TelegramContext.wallets_menu, None, True),
+    'forget_wallet': (TelegramContext.forget_wallet, wallet_arg, True),
+    'ask_wallet': (TelegramContext.ask_wallet, None, True),
+    'portfolio': (TelegramContext.portfolio, None, True),
+    'earnings': (TelegramContext.earnings, None, True),
+    'find_unmonitored': (TelegramContext.find_unmonitored, None, True),
+    'find_unmonitored_sn': (lambda c: c.find_unmonitored(c.service_nodes_menu), None, True),
+    'enable_automon': (lambda c: c.set_automon(True), None, True),
+    'disable_automon': (lambda c: c.set_automon(False), None, True),
+    'donate': (TelegramContext.donate, None, True),
+}
+
+def parse_query(data):
+    """Parses callback query data (once) using the routing table.  Returns a (handler, args,
+    remove_markup) tuple, or None if the data isn't a recognized query."""
+    m = query_re.match(data)
+    route = query_routes.get(m[1]) if m else None
+    if not route:
+        return None
+    handler, parse_arg, remove_markup = route
+    arg = m[3] if m[3] is not None else m[2] or None
+    if (arg is None) != (parse_arg is None):
+        return None
+    if parse_arg is None:
+        return (handler, (), remove_markup)
+    try:
+        return (handler, (parse_arg(arg),), remove_markup)
+    except ValueError:
+        return None
 
 
 def context_handler(ctx_method):
     def handler(update: Update, context: CallbackContext):
-        return ctx_method(TelegramContext(update, context))
+        ctx = TelegramContext(update, context)
+        with snapshot.pin(ctx.snap):
+            return ctx_method(ctx)
     return handler
 
 
@@ -742,6 +877,7 @@ class TelegramNetwork(Network):
 
         dp.add_handler(CommandHandler('start', context_handler(TelegramContext.start)))
         dp.add_handler(CallbackQueryHandler(context_handler(TelegramContext.dispatch_query)))
+        dp.add_handler(InlineQueryHandler(context_handler(TelegramContext.inline_query)))
         dp.add_handler(MessageHandler(Filters.text, context_handler(TelegramContext.plain_input)))
 
         # log all errors
@@ -767,6 +903,7 @@ class TelegramNetwork(Network):
                 print("Telegram user {} blocked me or is no longer active; removing them from SN monitoring ({})".format(chatid, e), flush=True)
 
                 pgsql.cursor().execute("DELETE FROM service_nodes WHERE uid = (SELECT id FROM users WHERE telegram_id = %s)", (chatid,))
+                uidcache.invalidate('telegram', chatid)
             else:
                 print("Error sending Telegram message to {}: {}".format(chatid, e), flush=True)
             return False
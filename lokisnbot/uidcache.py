@@ -0,0 +1,82 @@
+# Shared Telegram/Discord cache of external user ids to internal (users.id) uids
+
+from collections import OrderedDict
+import threading
+
+from . import pgsql
+from .constants import UID_CACHE_SIZE
+
+# network: the users table column holding the network's user id
+id_columns = { 'telegram': 'telegram_id', 'discord': 'discord_id' }
+
+# (network, external id): uid, in least-to-most recently used order
+cache = OrderedDict()
+lock = threading.Lock()
+
+
+def _put(network, ext_id, uid):
+    key = (network, ext_id)
+    cache[key] = uid
+    cache.move_to_end(key)
+    while len(cache) > UID_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def preload():
+    """Bulk loads existing users' uids (up to the cache size limit) into the cache.  Called at
+    startup so that known users don't need any query at all to look up their uid."""
+    cur = pgsql.cursor()
+    cur.execute("SELECT id, telegram_id, discord_id FROM users LIMIT %s", (UID_CACHE_SIZE,))
+    with lock:
+        for uid, telegram_id, discord_id in cur:
+            if telegram_id is not None:
+                _put('telegram', telegram_id, uid)
+            if discord_id is not None:
+                _put('discord', discord_id, uid)
+
+
+def get(network, ext_id):
+    """Returns the uid for the given network ('telegram' or 'discord') user id, creating the users
+    row if the user doesn't exist yet.  Uncached users take a single query."""
+    with lock:
+        uid = cache.get((network, ext_id))
+        if uid is not None:
+            cache.move_to_end((network, ext_id))
+            return uid
+
+    col = id_columns[network]
+    cur = pgsql.cursor()
+    # Insert-or-select in one round-trip (the SELECT doesn't see the INSERT, so we get exactly one
+    # row back either way):
+    cur.execute("WITH ins AS (INSERT INTO users ("+col+") VALUES (%s) ON CONFLICT DO NOTHING RETURNING id) "
+            "SELECT id FROM ins UNION ALL SELECT id FROM users WHERE "+col+" = %s", (ext_id, ext_id))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    with lock:
+        _put(network, ext_id, row[0])
+    return row[0]
+
+
+def find(network, ext_id):
+    """Like get(), but returns None instead of creating the users row if the user doesn't exist"""
+    with lock:
+        uid = cache.get((network, ext_id))
+        if uid is not None:
+            cache.move_to_end((network, ext_id))
+            return uid
+
+    cur = pgsql.cursor()
+    cur.execute("SELECT id FROM users WHERE "+id_columns[network]+" = %s", (ext_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    with lock:
+        _put(network, ext_id, row[0])
+    return row[0]
+
+
+def invalidate(network, ext_id):
+    """Drops a user from the cache"""
+    with lock:
+        cache.pop((network, ext_id), None)